@@ -1,14 +1,13 @@
 # app.py (in project root)
 
-from flask import Flask, request, jsonify, render_template, make_response, send_from_directory
+from flask import Flask, request, jsonify, render_template, make_response, send_from_directory, abort, g, url_for
 import os
-import pandas as pd
+import gc
 import sys
-import werkzeug.utils
-import datetime
+import json
+import hmac
 import time
-from threading import Thread
-import mimetypes
+import datetime
 
 # --- Add src directory to Python path ---
 # This allows importing modules from 'src' when running app.py from the root
@@ -19,8 +18,14 @@ if src_dir not in sys.path:
 # --- Import Identification Logic ---
 try:
     # Now imports should work relative to the src directory
-    from identification import find_best_match, get_bottle_details, INITIALIZATION_SUCCESSFUL
+    from identification import (find_best_match_from_bytes, identify_batch, get_bottle_details,
+                                get_bottle_details_json, get_cache_stats, get_details_stats, get_reference_stats,
+                                get_shard_stats, reload_catalogue, INITIALIZATION_SUCCESSFUL)
     import config # If needed for paths etc. directly here (unlikely now)
+    import metrics
+    from job_queue import JobQueue, QueueFullError
+    from result_cache import content_key
+    from shelf_identification import identify_shelf_from_bytes, count_bottles
 except ModuleNotFoundError as e:
      print(f"Error importing identification module: {e}")
      print("Ensure 'src' directory and its contents (config.py, identification.py, __init__.py) exist.")
@@ -28,42 +33,241 @@ except ModuleNotFoundError as e:
 
 # --- Flask App Setup ---
 app = Flask(__name__, template_folder='templates', static_folder='static')
-app.config['MAX_CONTENT_LENGTH'] = config.MAX_UPLOAD_SIZE
-app.config['UPLOAD_FOLDER'] = '_temp_uploads'
-
-# Ensure upload directory exists
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-
-def cleanup_old_files():
-    """Clean up old temporary files periodically."""
-    while True:
-        current_time = time.time()
-        for filename in os.listdir(app.config['UPLOAD_FOLDER']):
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            try:
-                if os.path.getmtime(filepath) < current_time - config.TEMP_FILE_CLEANUP_AGE:
-                    os.remove(filepath)
-            except OSError:
-                continue
-        time.sleep(300)  # Run every 5 minutes
+# Batch requests carry several images; single-image routes enforce MAX_UPLOAD_SIZE themselves
+app.config['MAX_CONTENT_LENGTH'] = max(config.MAX_UPLOAD_SIZE, config.MAX_BATCH_UPLOAD_SIZE)
+
+# --- Identification Queue ---
+# Matching runs on this worker's bounded job queue rather than in the request thread,
+# so overload is answered with a quick 503 instead of requests queueing unseen
+identify_jobs = JobQueue()
+
+# --- Metrics (served at /metrics) ---
+IDENTIFY_ENDPOINTS = {'identify_bottle_api', 'identify_batch_api', 'identify_shelf_api'}
+REQUEST_LATENCY = metrics.histogram('whisky_http_request_duration_seconds',
+                                    'Time to answer an HTTP request.', ('endpoint',))
+REQUESTS = metrics.counter('whisky_http_requests_total', 'HTTP requests answered.', ('endpoint', 'status'))
+STAGE_LATENCY = metrics.histogram('whisky_identify_stage_duration_seconds',
+                                  'Time spent in each identification stage, per image.', ('stage',))
+CLIENT_LATENCY = metrics.histogram('whisky_client_identify_duration_seconds',
+                                   'Client-perceived /identify time reported by the frontend.', ('part',))
+IN_FLIGHT = metrics.gauge('whisky_identify_in_flight', 'Identification requests being answered.')
+metrics.gauge('whisky_identify_queue_depth', 'Identification jobs queued or running in this worker.',
+              callback=lambda: identify_jobs.stats()['depth'])
+metrics.callback_counter('whisky_identify_jobs_total', 'Identification jobs by outcome.',
+                         lambda: {(outcome,): identify_jobs.stats()[outcome]
+                                  for outcome in ('submitted', 'coalesced', 'rejected', 'completed', 'failed')},
+                         ('outcome',))
+metrics.gauge('whisky_reference_bottles', 'Bottles in the loaded reference set.',
+              callback=lambda: get_reference_stats()['bottles'])
+metrics.gauge('whisky_reference_descriptors', 'ORB descriptors in the loaded reference set.',
+              callback=lambda: get_reference_stats()['descriptors'])
+metrics.gauge('whisky_reference_loaded_timestamp_seconds', 'When the serving catalogue was loaded, per build.',
+              ('build_id',), callback=lambda: {(get_reference_stats()['build_id'],): get_reference_stats()['loaded_at']})
+metrics.callback_counter('whisky_result_cache_lookups_total', 'Result cache lookups by outcome.',
+                         lambda: {(outcome,): get_cache_stats()[counter]
+                                  for outcome, counter in (('exact_hit', 'exact_hits'),
+                                                           ('perceptual_hit', 'perceptual_hits'),
+                                                           ('miss', 'misses'))}, ('result',))
+metrics.gauge('whisky_result_cache_hit_ratio', 'Share of result cache lookups answered from the cache.',
+              callback=lambda: get_cache_stats()['hit_rate'])
+metrics.gauge('whisky_result_cache_entries', 'Results held in the result cache.',
+              callback=lambda: get_cache_stats()['size'])
+metrics.callback_counter('whisky_details_lookups_total', 'Bottle details lookups by outcome.',
+                         lambda: {(outcome,): get_details_stats()[outcome] for outcome in ('found', 'missing')},
+                         ('result',))
+metrics.callback_counter('whisky_shard_requests_total', 'Requests to shard servers by outcome (sharded catalogue).',
+                         lambda: {(address, outcome): counts[outcome] for address, counts in get_shard_stats().items()
+                                  for outcome in ('ok', 'error', 'timeout')}, ('shard', 'outcome'))
+
+def elapsed_ms(start):
+    return round(1000 * (time.perf_counter() - start), 2)
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    if request.endpoint in IDENTIFY_ENDPOINTS:
+        IN_FLIGHT.inc()
+        g.in_flight = True
+
+@app.after_request
+def record_request_metrics(response):
+    """Records request latency, and for /identify its stages, also sent as a Server-Timing header."""
+    if 'request_start' not in g or request.endpoint == 'static':
+        return response
+    endpoint = request.endpoint or 'unmatched'
+    REQUEST_LATENCY.observe(time.perf_counter() - g.request_start, endpoint=endpoint)
+    REQUESTS.inc(endpoint=endpoint, status=response.status_code)
+
+    timings = g.get('timings')
+    if timings is not None:
+        # 'total' is normally measured just before the body was built (see stamp_total)
+        timings.setdefault('total', elapsed_ms(g.request_start))
+        for stage, duration_ms in timings.items():
+            if stage != 'total':
+                STAGE_LATENCY.observe(duration_ms / 1000, stage=stage)
+        response.headers['Server-Timing'] = metrics.server_timing_header(timings)
+    return response
+
+@app.teardown_request
+def finish_request(error=None):
+    if g.pop('in_flight', False):
+        IN_FLIGHT.dec()
+
+# Leading bytes of each accepted upload format (WebP is checked separately: RIFF....WEBP)
+IMAGE_SIGNATURES = (
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'BM', 'image/bmp'),
+)
+
+def sniff_image_type(header):
+    """Returns the MIME type of an image from its first bytes, or None for unsupported content."""
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'image/webp'
+    for signature, mime_type in IMAGE_SIGNATURES:
+        if header.startswith(signature):
+            return mime_type
+    return None
 
 def is_valid_image(file):
-    """Check if the uploaded file is a valid image."""
-    if not file or not file.filename:
-        return False
-    
-    # Check file extension
-    allowed_extensions = {'.jpg', '.jpeg', '.png', '.gif', '.bmp'}
-    ext = os.path.splitext(file.filename)[1].lower()
-    if ext not in allowed_extensions:
-        return False
-    
-    # Check MIME type
-    try:
-        mime_type = mimetypes.guess_type(file.filename)[0]
-        return mime_type and mime_type.startswith('image/')
-    except:
+    """
+    Check if the uploaded file is a valid image: JPEG, PNG, GIF, BMP or WebP, judged by
+    its content, as canvas captures and pre-processed uploads may carry any name.
+    """
+    if not file:
         return False
+    header = file.stream.read(16)
+    file.stream.seek(0)
+    return sniff_image_type(header) is not None
+
+def match_info(score, matches_count):
+    return {'_match_confidence_score': score, '_match_good_matches': matches_count}
+
+def match_result_data(bottle_id, score, matches_count):
+    """Builds the JSON-ready details dict for a matched bottle, or None if details are unavailable."""
+    details = get_bottle_details(bottle_id)
+    if details is None:
+        return None
+    return dict(details, **match_info(score, matches_count))
+
+def stamp_total(timings):
+    """
+    Adds 'total', the time since the request started, to the request's own timings
+    (g.timings) just before its body is built, so the body and Server-Timing agree.
+    Timings of a polled job are left alone: its request has long finished.
+    """
+    if timings is not None and g.get('timings') is timings:
+        timings['total'] = elapsed_ms(g.request_start)
+    return timings
+
+def match_response(data, timings):
+    """Builds the successful /identify response around a bottle's pre-serialized details."""
+    stamp_total(timings)
+    body = b''.join([b'{"success":true,"data":', data, b',"timing_ms":',
+                     json.dumps(timings, separators=(',', ':')).encode('utf-8'), b'}\n'])
+    return app.response_class(body, mimetype='application/json')
+
+def identification_response(result, timings):
+    """Builds the /identify response for a (bottle_id, score, matches_count) result."""
+    bottle_id, score, matches_count = result
+    if bottle_id is None:
+        return jsonify({
+            'success': False,
+            'error': 'No matching bottle found.',
+            'timing_ms': stamp_total(timings)
+        }), 404
+
+    start = time.perf_counter()
+    data = get_bottle_details_json(bottle_id, match_info(score, matches_count))
+    timings['details'] = elapsed_ms(start)
+    if data is None:
+        return jsonify({
+            'success': False,
+            'error': f'Match found (ID: {bottle_id}) but details unavailable.'
+        }), 500
+    return match_response(data, timings)
+
+def batch_response(uploads, matches):
+    """
+    Builds the /identify/batch response: one result per upload, in upload order.
+
+    Args:
+        uploads (list): {'filename', 'valid'} for each uploaded file.
+        matches (list): identify_batch results for the valid uploads, in order.
+    """
+    matches = iter(matches)
+    results = []
+    for upload in uploads:
+        if not upload['valid']:
+            results.append({'success': False, 'filename': upload['filename'],
+                            'error': 'Invalid file type. Please upload a valid image file.'})
+            continue
+
+        match = next(matches)
+        result = {'filename': upload['filename'], 'timing_ms': match['timing_ms']}
+        if match['id'] is None:
+            result.update(success=False, error=match['error'] or 'No matching bottle found.')
+        else:
+            result_data = match_result_data(match['id'], match['score'], match['matches_count'])
+            if result_data is None:
+                result.update(success=False, error=f"Match found (ID: {match['id']}) but details unavailable.")
+            else:
+                result.update(success=True, data=result_data)
+        results.append(result)
+    return jsonify({'success': True, 'results': results})
+
+def shelf_response(result, timings):
+    """Builds the /identify/shelf response from an identify_shelf_from_bytes result, adding 'details' to timings."""
+    if result['error']:
+        return jsonify({'success': False, 'error': result['error'], 'timing_ms': stamp_total(timings)}), 400
+
+    start = time.perf_counter()
+    names = {}
+    for bottle in result['bottles']:
+        if bottle['id'] not in names:
+            details = get_bottle_details(bottle['id']) or {}
+            names[bottle['id']] = details.get(config.COL_NAME)
+    timings['details'] = elapsed_ms(start)
+    stamp_total(timings)
+    return jsonify({
+        'success': True,
+        'bottles': [dict(bottle, name=names[bottle['id']]) for bottle in result['bottles']],
+        'inventory': [{'id': bottle_id, 'name': names[bottle_id], 'count': count}
+                      for bottle_id, count in count_bottles(result['bottles'])],
+        'regions': result['regions'],
+        'timing_ms': timings
+    })
+
+def shelf_stage_timings(timings):
+    """Shelf stages renamed shelf_<stage>, kept apart from single-bottle stages in the metrics and Server-Timing."""
+    return {stage if stage == 'total' else f'shelf_{stage}': duration_ms for stage, duration_ms in timings.items()}
+
+def wants_async():
+    """True if the client asked for a job ID instead of the result (?async=1 or Prefer: respond-async)."""
+    return (request.args.get('async', '') not in ('', '0', 'false')
+            or 'respond-async' in request.headers.get('Prefer', ''))
+
+def job_pending_response(job_id, status):
+    """202 pointing at GET /identify/<job_id>, where the result can be polled."""
+    poll_url = url_for('identify_job_api', job_id=job_id)
+    response = jsonify({'success': True, 'job_id': job_id, 'status': status, 'poll_url': poll_url})
+    response.status_code = 202
+    response.headers['Location'] = poll_url
+    response.headers['Retry-After'] = '1'
+    return response
+
+def queue_full_response(error):
+    """503 telling the client when the identification queue should have room again."""
+    response = jsonify({
+        'success': False,
+        'error': 'The server is busy. Please try again shortly.',
+        'retry_after': error.retry_after
+    })
+    response.status_code = 503
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
 
 # --- Routes ---
 @app.route('/')
@@ -74,6 +278,24 @@ def index():
                          init_error=not INITIALIZATION_SUCCESSFUL,
                          current_year=current_year)
 
+@app.route('/capture-settings')
+def capture_settings_api():
+    """
+    How clients should prepare uploads. Images are processed in grayscale with
+    the longest side at most max_image_size, so extra pixels and colour only
+    cost upload and decode time.
+    """
+    response = jsonify({
+        'max_image_size': config.MAX_IMAGE_SIZE,
+        'shelf_max_image_size': config.SHELF_MAX_IMAGE_SIZE,
+        'grayscale': True,
+        'formats': list(config.UPLOAD_FORMATS),
+        'quality': config.UPLOAD_QUALITY,
+        'max_upload_size': config.MAX_UPLOAD_SIZE,
+    })
+    response.headers['Cache-Control'] = 'public, max-age=3600'
+    return response
+
 @app.route('/identify', methods=['POST'])
 def identify_bottle_api():
     """API endpoint to handle image upload and identification."""
@@ -83,6 +305,9 @@ def identify_bottle_api():
             'error': 'Server Error: Identification module not initialized.'
         }), 500
 
+    if request.content_length and request.content_length > config.MAX_UPLOAD_SIZE:
+        abort(413)
+
     # Validate request
     if 'bottle_image' not in request.files:
         return jsonify({
@@ -100,65 +325,211 @@ def identify_bottle_api():
         }), 400
 
     try:
-        # Generate secure filename with random component
-        filename = werkzeug.utils.secure_filename(f"upload_{os.urandom(8).hex()}_{file.filename}")
-        temp_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-
-        # Save and process file
-        file.save(temp_path)
-
-        try:
-            # Call identification logic
-            bottle_id, score, matches_count = find_best_match(temp_path)
-
-            if bottle_id is not None:
-                details = get_bottle_details(bottle_id)
-                if details is not None:
-                    # Convert details to dict and add match info
-                    result_data = details.to_dict()
-                    result_data['_match_confidence_score'] = score
-                    result_data['_match_good_matches'] = matches_count
-
-                    # Convert numpy types to Python types
-                    for key, value in result_data.items():
-                        if hasattr(value, 'item'):
-                            result_data[key] = value.item()
-                        elif pd.isna(value):
-                            result_data[key] = None
-
-                    return jsonify({'success': True, 'data': result_data})
-                else:
-                    return jsonify({
-                        'success': False,
-                        'error': f'Match found (ID: {bottle_id}) but details unavailable.'
-                    }), 500
-            else:
-                return jsonify({
-                    'success': False,
-                    'error': 'No matching bottle found.'
-                }), 404
-
-        except Exception as e:
-            app.logger.error(f"Error during identification process: {e}", exc_info=True)
-            return jsonify({
-                'success': False,
-                'error': 'An internal error occurred during identification.'
-            }), 500
-        finally:
-            # Clean up the temporary file
-            try:
-                if os.path.exists(temp_path):
-                    os.remove(temp_path)
-            except OSError as e:
-                app.logger.error(f"Error removing temp file {temp_path}: {e}")
+        # Decode straight from the request buffer; nothing is written to disk
+        image_bytes = file.read()
+
+        # Queue the identification; an identical image already queued or running is
+        # shared rather than matched twice. timings holds the cost of each stage that
+        # ran, starting with receiving and parsing the upload
+        timings = g.timings = {'upload': elapsed_ms(g.request_start)}
+        job, _ = identify_jobs.submit(find_best_match_from_bytes, image_bytes, key=content_key(image_bytes))
+
+        # Asynchronous clients, and requests that would outlive the worker timeout, poll for the result
+        if wants_async() or not job.wait(config.IDENTIFY_SYNC_TIMEOUT):
+            identify_jobs.keep(job)
+            return job_pending_response(job.id, job.status)
+        if job.status == 'failed':
+            raise RuntimeError(job.error)
+        timings.update(job.timings)
+        return identification_response(job.result, timings)
 
+    except QueueFullError as e:
+        return queue_full_response(e)
     except Exception as e:
-        app.logger.error(f"Error handling upload: {e}", exc_info=True)
+        app.logger.error(f"Error during identification process: {e}", exc_info=True)
         return jsonify({
             'success': False,
-            'error': 'An error occurred while processing the upload.'
+            'error': 'An internal error occurred during identification.'
+        }), 500
+
+@app.route('/identify/batch', methods=['POST'])
+def identify_batch_api():
+    """
+    API endpoint identifying several images ('bottle_images' parts) in one request.
+    Results are returned in upload order, each with its own timing.
+    """
+    if not INITIALIZATION_SUCCESSFUL:
+        return jsonify({
+            'success': False,
+            'error': 'Server Error: Identification module not initialized.'
         }), 500
 
+    files = request.files.getlist('bottle_images')
+    if not files:
+        return jsonify({
+            'success': False,
+            'error': 'No image files in the request.'
+        }), 400
+    if len(files) > config.MAX_BATCH_IMAGES:
+        return jsonify({
+            'success': False,
+            'error': f'Too many images. Maximum is {config.MAX_BATCH_IMAGES} per request.'
+        }), 400
+
+    try:
+        # Invalid files keep their slot in the results so indexes line up with the upload
+        uploads = [{'filename': file.filename, 'valid': is_valid_image(file)} for file in files]
+        job, _ = identify_jobs.submit(identify_batch, [file.read() for file, upload in zip(files, uploads)
+                                                       if upload['valid']])
+        # Work that outlives the worker timeout keeps running; the client polls for it
+        if not job.wait(config.IDENTIFY_SYNC_TIMEOUT):
+            identify_jobs.keep(job, kind='batch', context={'uploads': uploads})
+            return job_pending_response(job.id, job.status)
+        if job.status == 'failed':
+            raise RuntimeError(job.error)
+        for match in job.result:
+            for stage in ('decode', 'preprocess', 'detect', 'match'):
+                if stage in match['timing_ms']:
+                    STAGE_LATENCY.observe(match['timing_ms'][stage] / 1000, stage=stage)
+        return batch_response(uploads, job.result)
+
+    except QueueFullError as e:
+        return queue_full_response(e)
+    except Exception as e:
+        app.logger.error(f"Error during batch identification: {e}", exc_info=True)
+        return jsonify({
+            'success': False,
+            'error': 'An internal error occurred during identification.'
+        }), 500
+
+@app.route('/identify/shelf', methods=['POST'])
+def identify_shelf_api():
+    """
+    API endpoint identifying every bottle in one shelf photo ('bottle_image'),
+    with bounding boxes and an inventory count per bottle.
+    """
+    if not INITIALIZATION_SUCCESSFUL:
+        return jsonify({
+            'success': False,
+            'error': 'Server Error: Identification module not initialized.'
+        }), 500
+
+    if request.content_length and request.content_length > config.MAX_UPLOAD_SIZE:
+        abort(413)
+
+    file = request.files.get('bottle_image')
+    if file is None:
+        return jsonify({
+            'success': False,
+            'error': 'No image file part in the request.'
+        }), 400
+    if not is_valid_image(file):
+        return jsonify({
+            'success': False,
+            'error': 'Invalid file type. Please upload a valid image file.'
+        }), 400
+
+    try:
+        image_bytes = file.read()
+        timings = {'upload': elapsed_ms(g.request_start)}
+        job, _ = identify_jobs.submit(identify_shelf_from_bytes, image_bytes, key=('shelf', content_key(image_bytes)))
+        # Work that outlives the worker timeout keeps running; the client polls for it
+        if not job.wait(config.IDENTIFY_SYNC_TIMEOUT):
+            identify_jobs.keep(job, kind='shelf')
+            return job_pending_response(job.id, job.status)
+        if job.status == 'failed':
+            raise RuntimeError(job.error)
+        timings.update(job.timings)
+        g.timings = timings
+        response = shelf_response(job.result, timings)
+        g.timings = shelf_stage_timings(timings)
+        return response
+
+    except QueueFullError as e:
+        return queue_full_response(e)
+    except Exception as e:
+        app.logger.error(f"Error during shelf identification: {e}", exc_info=True)
+        return jsonify({
+            'success': False,
+            'error': 'An internal error occurred during identification.'
+        }), 500
+
+@app.route('/identify/<job_id>')
+def identify_job_api(job_id):
+    """
+    Polls an identification job started by POST /identify (see wants_async), or by
+    /identify/batch or /identify/shelf when it outlived IDENTIFY_SYNC_TIMEOUT.
+    """
+    record = identify_jobs.get(job_id)
+    if record is None:
+        return jsonify({
+            'success': False,
+            'error': 'Unknown or expired identification job.'
+        }), 404
+    if record['status'] in ('queued', 'running'):
+        return job_pending_response(job_id, record['status'])
+    if record['status'] == 'failed':
+        app.logger.error(f"Identification job {job_id} failed: {record['error']}")
+        return jsonify({
+            'success': False,
+            'error': 'An internal error occurred during identification.'
+        }), 500
+    kind = record.get('kind') or 'identify'
+    timings = dict(record['timings'])
+    if record.get('submitted_at') and record.get('finished_at'):
+        # The job from submission to result; the request that submitted it has long finished
+        timings['total'] = round(1000 * (record['finished_at'] - record['submitted_at']), 2)
+    if kind == 'batch':
+        response = batch_response(record['context']['uploads'], record['result'])
+    elif kind == 'shelf':
+        response = shelf_response(record['result'], timings)
+        timings = shelf_stage_timings(timings)
+    else:
+        response = identification_response(record['result'], timings)
+    # The job's stages, as sent with results answered at once (see record_request_metrics)
+    response = make_response(response)
+    response.headers['Server-Timing'] = metrics.server_timing_header(timings)
+    return response
+
+@app.route('/cache/stats')
+def cache_stats_api():
+    """Hit/miss counters of the identification result cache."""
+    return jsonify(get_cache_stats())
+
+@app.route('/metrics')
+def metrics_api():
+    """Latency histograms, queue depth, cache and reference-set gauges in Prometheus text format."""
+    return app.response_class(metrics.REGISTRY.render(), mimetype=None, content_type=metrics.CONTENT_TYPE)
+
+@app.route('/metrics/client', methods=['POST'])
+def client_timing_api():
+    """Client-perceived /identify timings sent by the frontend (see reportTiming in main.js)."""
+    report = request.get_json(silent=True, force=True) or {}
+    for part, key in (('total', 'client_ms'), ('network', 'network_ms')):
+        value = report.get(key)
+        # Ignore anything that isn't a plausible duration
+        if isinstance(value, (int, float)) and 0 <= value < 600000:
+            CLIENT_LATENCY.observe(value / 1000, part=part)
+    return '', 204
+
+@app.route('/admin/reload', methods=['POST'])
+def reload_catalogue_api():
+    """
+    Reloads the reference catalogue in the worker that receives the request
+    (?force=1 reloads even if the files look unchanged). The other workers pick
+    up the new files through their catalogue watcher. Requires ADMIN_TOKEN.
+    """
+    if not config.ADMIN_TOKEN:
+        abort(404)
+    supplied = request.headers.get('Authorization', '')
+    if not hmac.compare_digest(supplied.encode('utf-8'), f"Bearer {config.ADMIN_TOKEN}".encode('utf-8')):
+        return jsonify({'success': False, 'error': 'Unauthorized'}), 401
+
+    reloaded, message = reload_catalogue(force=request.args.get('force', '') not in ('', '0', 'false'))
+    failed = message.startswith('Reload failed')
+    return jsonify({'success': not failed, 'reloaded': reloaded, 'message': message,
+                    'catalogue': get_reference_stats()}), 500 if failed else 200
+
 @app.route('/static/js/service-worker.js')
 def serve_service_worker():
     response = make_response(send_from_directory('static/js', 'service-worker.js'))
@@ -186,6 +557,12 @@ def internal_server_error(error):
         'error': 'An internal server error occurred.'
     }), 500
 
+# --- Preloading ---
+# Under gunicorn --preload everything above runs once in the master and workers are forked
+# from it. Freezing moves the loaded catalogue out of the garbage collector's view, so
+# collections in the workers don't write to (and so copy) the shared pages.
+gc.freeze()
+
 # --- Main Execution Guard ---
 if __name__ == '__main__':
     if not INITIALIZATION_SUCCESSFUL:
@@ -197,10 +574,6 @@ if __name__ == '__main__':
     else:
         print("Identification module initialized successfully.")
 
-    # Start cleanup thread
-    cleanup_thread = Thread(target=cleanup_old_files, daemon=True)
-    cleanup_thread.start()
-
     # Start server
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=False)
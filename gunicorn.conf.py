@@ -0,0 +1,15 @@
+# gunicorn.conf.py (in project root; gunicorn reads it from the working directory)
+
+import os
+import sys
+
+src_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src')
+if src_dir not in sys.path:
+    sys.path.insert(0, src_dir)
+
+# Module-level names are read as gunicorn settings, so import only the values ('config' is one)
+from config import WEB_THREADS
+
+# Request threads per worker, sized by the identification queue (see config.WEB_THREADS);
+# the CPU-heavy work runs within the matching engine's budget, not in these threads
+threads = WEB_THREADS
@@ -0,0 +1,330 @@
+# src/ann_index.py
+
+import os
+import sys
+import json
+import time
+import numpy as np
+import cv2
+
+# Import configuration variables
+try:
+    import config
+except ModuleNotFoundError:
+    print("Error: config.py not found. Make sure it's in the 'src' directory.")
+    sys.exit(1)
+
+# Number of set bits for every possible byte value, used for vectorized Hamming distances
+POPCOUNT_TABLE = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1).astype(np.uint16)
+FLANN_INDEX_LSH = 6
+STACKED_BLOCK_ROWS = 1 << 17     # Rows per exact-search task (see matching_engine.knn_sharded)
+
+# Saved indexes record the build ID of the feature store they index: a store replaced
+# after its index was written (or the other way round) must not be paired with it, as the
+# index's rows would point into the wrong descriptors. Files are renamed into place whole.
+
+def meta_path(path):
+    """Sidecar of an index file format that can't hold metadata itself (FLANN)."""
+    return f"{path}.json"
+
+def _check_build(kind, saved_build_id, saved_count, descriptors, build_id):
+    if build_id is not None and saved_build_id != build_id:
+        raise ValueError(f"{kind} index was built for feature store build {saved_build_id}, not {build_id}")
+    if saved_count != len(descriptors):
+        raise ValueError(f"{kind} index does not match the current reference descriptors")
+
+def hamming_distances(a, b):
+    """
+    Row-wise Hamming distance between two equally shaped uint8 descriptor arrays.
+    """
+    return POPCOUNT_TABLE[np.bitwise_xor(a, b)].sum(axis=1)
+
+def hamming_knn(des_query, train, k=2, offset=0):
+    """
+    Exact Hamming k-NN of the query descriptors in train. cv2.batchDistance returns
+    the neighbours as index and distance arrays, so no per-match DMatch objects
+    are built in Python.
+
+    Args:
+        offset (int): Added to the returned rows, e.g. the first row of a train block.
+
+    Returns:
+        tuple: (rows, distances) arrays of shape (n_query, k); missing neighbours
+               (train has fewer than k rows) are marked with row -1.
+    """
+    rows = np.full((len(des_query), k), -1, dtype=np.int64)
+    distances = np.full((len(des_query), k), np.inf)
+    if len(des_query) and len(train):
+        found_distances, found_rows = cv2.batchDistance(np.ascontiguousarray(des_query), np.ascontiguousarray(train),
+                                                        cv2.CV_32S, normType=cv2.NORM_HAMMING, K=k)
+        found = found_rows.shape[1]  # K is capped at the number of train rows
+        rows[:, :found] = found_rows + offset
+        distances[:, :found] = found_distances
+    return rows, distances
+
+class BruteForceIndex:
+    """
+    Exact Hamming k-NN over the stacked reference matrix (see hamming_knn).
+    """
+    kind = 'brute'
+
+    def __init__(self, descriptors):
+        self.descriptors = descriptors
+
+    def knn(self, des_query, k=2):
+        """
+        Returns (rows, distances) arrays of shape (n_query, k); missing
+        neighbours are marked with row -1.
+        """
+        return hamming_knn(des_query, self.descriptors, k)
+
+    def save(self, path, build_id=None):
+        """Nothing to persist: the brute-force index is the descriptor matrix itself."""
+        return None
+
+class FlannLshIndex:
+    """
+    Approximate k-NN using FLANN's locality-sensitive hashing index for binary descriptors.
+    """
+    kind = 'flann_lsh'
+
+    def __init__(self, descriptors, index=None):
+        self.descriptors = descriptors  # FLANN keeps a pointer, so the array must stay alive
+        if index is None:
+            index = cv2.flann_Index(descriptors, dict(
+                algorithm=FLANN_INDEX_LSH,
+                table_number=config.LSH_TABLE_NUMBER,
+                key_size=config.LSH_KEY_SIZE,
+                multi_probe_level=config.LSH_MULTI_PROBE_LEVEL
+            ))
+        self.index = index
+
+    def knn(self, des_query, k=2):
+        """
+        Returns (rows, distances) arrays of shape (n_query, k); missing
+        neighbours are marked with row -1.
+        """
+        rows, distances = self.index.knnSearch(des_query, k, params=dict(checks=config.LSH_CHECKS))
+        rows = rows.astype(np.int64)
+        distances = distances.astype(np.float64)
+        distances[rows < 0] = np.inf
+        return rows, distances
+
+    def save(self, path, build_id=None):
+        # The sidecar identifies the index file by size and mtime (kept by the rename), so
+        # an index and a sidecar from different runs are never taken for a pair
+        tmp_path = f"{path}.tmp-{os.getpid()}"
+        self.index.save(tmp_path)
+        stat = os.stat(tmp_path)
+        meta = {'build_id': build_id, 'num_descriptors': len(self.descriptors),
+                'index_file': [stat.st_size, stat.st_mtime_ns]}
+        with open(f"{tmp_path}.json", 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        os.replace(f"{tmp_path}.json", meta_path(path))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, descriptors, path, build_id=None):
+        try:
+            with open(meta_path(path), 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            raise ValueError(f"FLANN index '{path}' has no readable '{meta_path(path)}'")
+        stat = os.stat(path)
+        if meta.get('index_file') != [stat.st_size, stat.st_mtime_ns]:
+            raise ValueError(f"'{meta_path(path)}' describes another version of '{path}'")
+        _check_build('FLANN', meta.get('build_id'), meta.get('num_descriptors'), descriptors, build_id)
+        index = cv2.flann_Index()
+        if not index.load(descriptors, path):
+            raise ValueError(f"Could not load FLANN index from '{path}'")
+        return cls(descriptors, index)
+
+class MultiIndexHashingIndex:
+    """
+    Pure-NumPy multi-index hashing: each 256-bit descriptor is split into
+    MIH_NUM_TABLES disjoint substrings, each substring is an exact-match hash
+    key into its own sorted table. Candidates that share at least one substring
+    with the query are re-ranked by full Hamming distance.
+    """
+    kind = 'mih'
+
+    def __init__(self, descriptors, sorted_keys=None, order=None):
+        self.descriptors = descriptors
+        self.num_tables = config.MIH_NUM_TABLES
+        if sorted_keys is None or order is None:
+            keys = self._substring_keys(descriptors)
+            order = np.argsort(keys, axis=0, kind='stable').astype(np.int64)
+            sorted_keys = np.take_along_axis(keys, order, axis=0)
+        self.sorted_keys = sorted_keys  # (n_descriptors, num_tables)
+        self.order = order              # Row of each sorted key in descriptors
+
+    def _substring_keys(self, descriptors):
+        """
+        Packs each descriptor substring into one integer key per table.
+        """
+        n_bytes = descriptors.shape[1]
+        if n_bytes % self.num_tables != 0:
+            raise ValueError(f"MIH_NUM_TABLES={self.num_tables} must divide the descriptor size ({n_bytes} bytes)")
+        chunk = n_bytes // self.num_tables
+        parts = descriptors.reshape(len(descriptors), self.num_tables, chunk).astype(np.uint64)
+        weights = np.uint64(256) ** np.arange(chunk, dtype=np.uint64)
+        return (parts * weights).sum(axis=2, dtype=np.uint64)
+
+    def knn(self, des_query, k=2):
+        """
+        Returns (rows, distances) arrays of shape (n_query, k); missing
+        neighbours are marked with row -1.
+        """
+        n_query = len(des_query)
+        rows = np.full((n_query, k), -1, dtype=np.int64)
+        distances = np.full((n_query, k), np.inf)
+        query_keys = self._substring_keys(des_query)
+
+        # Gather (query, candidate) pairs from every table's matching bucket
+        pair_queries = []
+        pair_candidates = []
+        for table in range(self.num_tables):
+            column = self.sorted_keys[:, table]
+            lo = np.searchsorted(column, query_keys[:, table], side='left')
+            hi = np.searchsorted(column, query_keys[:, table], side='right')
+            sizes = hi - lo
+            # Overfull buckets (e.g. blank label regions) carry no information
+            sizes[sizes > config.MIH_MAX_BUCKET] = 0
+            if not sizes.any():
+                continue
+            starts = np.repeat(lo - np.cumsum(sizes) + sizes, sizes)
+            positions = starts + np.arange(sizes.sum())
+            pair_queries.append(np.repeat(np.arange(n_query), sizes))
+            pair_candidates.append(self.order[positions, table])
+
+        if not pair_queries:
+            return rows, distances
+
+        pairs = np.unique(np.concatenate(pair_queries) * len(self.descriptors) + np.concatenate(pair_candidates))
+        pair_q = pairs // len(self.descriptors)
+        pair_c = pairs % len(self.descriptors)
+        pair_d = hamming_distances(des_query[pair_q], self.descriptors[pair_c])
+
+        # Keep the k nearest candidates per query
+        ranked = np.lexsort((pair_d, pair_q))
+        pair_q, pair_c, pair_d = pair_q[ranked], pair_c[ranked], pair_d[ranked]
+        first = np.searchsorted(pair_q, pair_q, side='left')
+        rank = np.arange(len(pair_q)) - first
+        keep = rank < k
+        rows[pair_q[keep], rank[keep]] = pair_c[keep]
+        distances[pair_q[keep], rank[keep]] = pair_d[keep]
+        return rows, distances
+
+    def save(self, path, build_id=None):
+        tmp_path = f"{path}.tmp-{os.getpid()}"
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, sorted_keys=self.sorted_keys, order=self.order, num_tables=self.num_tables,
+                     num_descriptors=len(self.descriptors), build_id=str(build_id or ''))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, descriptors, path, build_id=None):
+        with np.load(path) as data:
+            if int(data['num_tables']) != config.MIH_NUM_TABLES:
+                raise ValueError("MIH index was built with a different MIH_NUM_TABLES")
+            saved_build_id = str(data['build_id']) if 'build_id' in data.files else ''
+            _check_build('MIH', saved_build_id or None, int(data['num_descriptors']), descriptors, build_id)
+            return cls(descriptors, data['sorted_keys'], data['order'])
+
+INDEX_TYPES = {
+    BruteForceIndex.kind: BruteForceIndex,
+    FlannLshIndex.kind: FlannLshIndex,
+    MultiIndexHashingIndex.kind: MultiIndexHashingIndex,
+}
+
+def build_index(descriptors, index_type=None):
+    """
+    Builds the descriptor index selected by config.ANN_INDEX_TYPE.
+    """
+    index_type = index_type or config.ANN_INDEX_TYPE
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown ANN_INDEX_TYPE '{index_type}'. Choose from {sorted(INDEX_TYPES)}.")
+    return INDEX_TYPES[index_type](descriptors)
+
+def load_index(descriptors, index_type=None, path=None, build_id=None):
+    """
+    Loads a prebuilt index written by data_preparation.py, building it in
+    memory instead if the file is missing or stale.
+
+    Args:
+        build_id (str): Build ID of the feature store the descriptors come from; an
+            index saved for any other build is stale.
+    """
+    index_type = index_type or config.ANN_INDEX_TYPE
+    path = path or config.ANN_INDEX_FILE
+    index_cls = INDEX_TYPES.get(index_type)
+    if index_cls is not None and hasattr(index_cls, 'load') and os.path.exists(path):
+        try:
+            index = index_cls.load(descriptors, path, build_id)
+            print(f"Loaded '{index_type}' descriptor index from '{path}'.")
+            return index
+        except Exception as e:
+            print(f"Warning: Could not load descriptor index '{path}' ({e}). Rebuilding in memory.")
+    return build_index(descriptors, index_type)
+
+def measure_recall(index, reference_index, query_sets, k=1):
+    """
+    Compares an approximate index against exact brute force.
+
+    Returns:
+        dict: Fraction of query descriptors whose exact top-k neighbours were
+              found, plus the mean query latency of both indexes.
+    """
+    hits = 0
+    total = 0
+    index_time = 0.0
+    exact_time = 0.0
+    for des_query in query_sets:
+        start = time.perf_counter()
+        rows, _ = index.knn(des_query, k)
+        index_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        exact_rows, _ = reference_index.knn(des_query, k)
+        exact_time += time.perf_counter() - start
+
+        for found, exact in zip(rows, exact_rows):
+            hits += len(set(found[found >= 0]) & set(exact[exact >= 0]))
+            total += int((exact >= 0).sum())
+
+    n_queries = max(len(query_sets), 1)
+    return {
+        'recall': hits / total if total else 0.0,
+        'index_ms': 1000 * index_time / n_queries,
+        'brute_force_ms': 1000 * exact_time / n_queries,
+    }
+
+# --- Recall check: python src/ann_index.py [num_query_images] ---
+if __name__ == "__main__":
+    import random
+    import feature_pipeline
+    from feature_store import open_feature_store
+
+    num_queries = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    descriptors = open_feature_store().descriptors
+
+    image_files = sorted(os.listdir(config.IMAGE_DOWNLOAD_DIR))
+    image_files = [name for name in image_files if not name.startswith('.')]
+    detector = feature_pipeline.create_detector(config.N_FEATURES_QUERY)
+    query_sets = []
+    for name in random.Random(0).sample(image_files, min(num_queries, len(image_files))):
+        img = cv2.imread(os.path.join(config.IMAGE_DOWNLOAD_DIR, name), cv2.IMREAD_GRAYSCALE)
+        if img is None:
+            continue
+        # Mild rotation so queries are not bit-identical to the references
+        h, w = img.shape
+        img = cv2.warpAffine(img, cv2.getRotationMatrix2D((w / 2, h / 2), 10, 0.9), (w, h))
+        _, des = feature_pipeline.extract(img, detector)
+        if des is not None:
+            query_sets.append(des)
+
+    exact = BruteForceIndex(descriptors)
+    print(f"Checking '{config.ANN_INDEX_TYPE}' against brute force on {len(query_sets)} query images...")
+    result = measure_recall(load_index(descriptors), exact, query_sets)
+    print(f"  Recall@1: {result['recall']:.3f}")
+    print(f"  Mean query time: {result['index_ms']:.1f} ms (brute force: {result['brute_force_ms']:.1f} ms)")
@@ -0,0 +1,336 @@
+# src/benchmark.py
+
+import os
+import sys
+import ast
+import json
+import time
+import random
+import argparse
+import platform
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import cv2
+
+# Import configuration variables
+try:
+    import config
+except ModuleNotFoundError:
+    print("Error: config.py not found. Make sure it's in the 'src' directory.")
+    sys.exit(1)
+
+try:
+    import resource  # Not available on Windows
+except ImportError:
+    resource = None
+
+# Accuracy and speed of the identification pipeline on perturbed copies of the catalogue
+# images. Every perturbation is applied to the original image and the result is JPEG
+# encoded, so queries go through the same decode path as uploads.
+#
+#   python src/benchmark.py --images 50 --concurrency 1,4,8 --set MATCHER_ENGINE=shortlist --output run.json
+#
+# Results are written as JSON so runs can be compared across commits and settings.
+
+JPEG_QUALITY = 90          # Encoding quality for queries that are not JPEG-degraded on purpose
+LOW_JPEG_QUALITY = 35      # Quality for the 'jpeg' perturbation
+TOP_K = 5
+
+def _rotate(img, angle=15):
+    h, w = img.shape[:2]
+    matrix = cv2.getRotationMatrix2D((w / 2, h / 2), angle, 1.0)
+    # Grow the canvas so the rotated bottle is not clipped
+    cos, sin = abs(matrix[0, 0]), abs(matrix[0, 1])
+    new_w, new_h = int(h * sin + w * cos), int(h * cos + w * sin)
+    matrix[0, 2] += (new_w - w) / 2
+    matrix[1, 2] += (new_h - h) / 2
+    return cv2.warpAffine(img, matrix, (new_w, new_h), borderValue=(255, 255, 255))
+
+def _scale(img, factor=0.5):
+    h, w = img.shape[:2]
+    return cv2.resize(img, (max(1, int(w * factor)), max(1, int(h * factor))), interpolation=cv2.INTER_AREA)
+
+def _blur(img, sigma=2.0):
+    return cv2.GaussianBlur(img, (0, 0), sigma)
+
+def _crop(img, keep=0.8):
+    h, w = img.shape[:2]
+    top, left = int(h * (1 - keep) / 2), int(w * (1 - keep) / 2)
+    return img[top:h - top, left:w - left]
+
+# name -> (transform, JPEG quality of the encoded query)
+PERTURBATIONS = {
+    'rotation': (_rotate, JPEG_QUALITY),
+    'scale': (_scale, JPEG_QUALITY),
+    'blur': (_blur, JPEG_QUALITY),
+    'crop': (_crop, JPEG_QUALITY),
+    'jpeg': (lambda img: img, LOW_JPEG_QUALITY),
+    'combined': (lambda img: _blur(_crop(_scale(_rotate(img, 10), 0.6)), 1.0), LOW_JPEG_QUALITY),
+}
+
+def apply_overrides(assignments):
+    """Applies NAME=VALUE settings to config; values are Python literals, or plain strings."""
+    overrides = {}
+    for assignment in assignments:
+        name, sep, raw = assignment.partition('=')
+        if not sep or not hasattr(config, name):
+            raise ValueError(f"Unknown config setting in '{assignment}'")
+        try:
+            value = ast.literal_eval(raw)
+        except (ValueError, SyntaxError):
+            value = raw
+        setattr(config, name, value)
+        overrides[name] = value
+    return overrides
+
+def config_snapshot():
+    """Every plain setting in config.py (paths excluded), for the JSON report."""
+    return {
+        name: getattr(config, name) for name in dir(config)
+        if name.isupper() and isinstance(getattr(config, name), (bool, int, float, str))
+        and not name.endswith(('_FILE', '_DIR', '_PATH', '_ROOT'))
+    }
+
+def git_revision():
+    """Current commit and whether the working tree has changes, or None outside a git checkout."""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=config.PROJECT_ROOT,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=config.PROJECT_ROOT,
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return {'commit': commit, 'dirty': bool(status)}
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB, or None where unsupported."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return round(peak / (1024 * 1024 if platform.system() == 'Darwin' else 1024), 1)
+
+def measure_cold_start(runs):
+    """
+    Times fresh interpreters importing the web app, i.e. a worker booting
+    without --preload: imports, catalogue snapshot and engine start-up.
+    --set overrides don't apply to these runs.
+    """
+    durations = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        completed = subprocess.run([sys.executable, '-c', 'import app'], cwd=config.PROJECT_ROOT,
+                                   capture_output=True, text=True)
+        if completed.returncode != 0:
+            print(f"Warning: Cold-start run failed: {completed.stderr.strip()[-500:]}")
+            return None
+        durations.append(time.perf_counter() - start)
+    median = float(np.median(durations))
+    return {
+        'runs_s': [round(duration, 3) for duration in durations],
+        'median_s': round(median, 3),
+        'target_s': config.COLD_START_TARGET_SECONDS,
+        'within_target': median <= config.COLD_START_TARGET_SECONDS,
+    }
+
+def latency_summary(latencies_ms):
+    latencies_ms = np.asarray(latencies_ms, dtype=np.float64)
+    if not len(latencies_ms):
+        return {}
+    return {
+        'mean': round(float(latencies_ms.mean()), 2),
+        'p50': round(float(np.percentile(latencies_ms, 50)), 2),
+        'p95': round(float(np.percentile(latencies_ms, 95)), 2),
+        'p99': round(float(np.percentile(latencies_ms, 99)), 2),
+        'max': round(float(latencies_ms.max()), 2),
+    }
+
+def build_queries(image_files, perturbations):
+    """
+    Returns:
+        list: (true bottle ID as str, perturbation name, encoded JPEG bytes)
+    """
+    queries = []
+    for path in image_files:
+        img = cv2.imread(path, cv2.IMREAD_COLOR)
+        if img is None:
+            print(f"Warning: Could not read '{path}', skipped.")
+            continue
+        bottle_id = os.path.splitext(os.path.basename(path))[0]
+        for name in perturbations:
+            transform, quality = PERTURBATIONS[name]
+            ok, encoded = cv2.imencode('.jpg', transform(img), [cv2.IMWRITE_JPEG_QUALITY, quality])
+            if ok:
+                queries.append((bottle_id, name, encoded.tobytes()))
+    return queries
+
+def run_accuracy(identification, queries):
+    """
+    Identifies each query in turn, recording the rank of the true bottle and
+    the time spent in each stage.
+    """
+    catalogue = identification.current_catalogue()
+    results = []
+    for bottle_id, perturbation, image_bytes in queries:
+        timings = {}
+        start = time.perf_counter()
+        img = identification.decode_image(image_bytes)
+        timings['decode'] = 1000 * (time.perf_counter() - start)
+        points_query, des_query = identification.extract_query_features(img, timings) if img is not None else (None, None)
+        match_start = time.perf_counter()
+        predicted, ranked = None, []
+        if des_query is not None and len(des_query) >= config.MIN_MATCH_COUNT:
+            scores, n_matched = identification.score_references(des_query, points_query, catalogue)
+            predicted = identification.best_from_votes(scores, n_matched, catalogue)[0]
+            ranked = [catalogue.ids[idx] for idx in np.argsort(-scores, kind='stable')[:TOP_K]
+                      if scores[idx] > 0]
+        timings['match'] = 1000 * (time.perf_counter() - match_start)
+        results.append({
+            'perturbation': perturbation,
+            'top1': predicted is not None and str(predicted) == bottle_id,
+            'top5': bottle_id in [str(candidate) for candidate in ranked],
+            'latency_ms': 1000 * (time.perf_counter() - start),
+            'timings': timings,
+        })
+    return results
+
+def run_throughput(identification, queries, concurrency):
+    """Runs every query through find_best_match_from_bytes from `concurrency` caller threads."""
+    def timed(query):
+        start = time.perf_counter()
+        identification.find_best_match_from_bytes(query[2])
+        return 1000 * (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as callers:
+        latencies = list(callers.map(timed, queries))
+    elapsed = time.perf_counter() - start
+    return {
+        'concurrency': concurrency,
+        'queries_per_s': round(len(queries) / elapsed, 3),
+        'latency_ms': latency_summary(latencies),
+    }
+
+def accuracy_summary(results):
+    def rates(subset):
+        return {
+            'queries': len(subset),
+            'top1': round(sum(r['top1'] for r in subset) / len(subset), 4) if subset else None,
+            'top5': round(sum(r['top5'] for r in subset) / len(subset), 4) if subset else None,
+        }
+    summary = rates(results)
+    summary['by_perturbation'] = {
+        name: rates([r for r in results if r['perturbation'] == name])
+        for name in dict.fromkeys(r['perturbation'] for r in results)
+    }
+    return summary
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark accuracy, latency, throughput and memory of bottle identification.")
+    parser.add_argument('--images', type=int, default=50, help="Catalogue images to sample (0 = all). Default: 50")
+    parser.add_argument('--perturbations', default=','.join(PERTURBATIONS),
+                        help=f"Comma-separated subset of: {', '.join(PERTURBATIONS)}")
+    parser.add_argument('--concurrency', default='1,4',
+                        help="Comma-separated caller counts for the throughput runs (empty to skip). Default: 1,4")
+    parser.add_argument('--set', dest='overrides', action='append', default=[], metavar='NAME=VALUE',
+                        help="Override a config.py setting, e.g. --set MATCHER_ENGINE=shortlist (repeatable)")
+    parser.add_argument('--cold-starts', type=int, default=3,
+                        help="Fresh-interpreter 'import app' runs timed for cold start (0 to skip). Default: 3")
+    parser.add_argument('--seed', type=int, default=0, help="Seed for sampling images. Default: 0")
+    parser.add_argument('--output', help="Write the JSON report here instead of printing it")
+    args = parser.parse_args(argv)
+
+    perturbations = [name.strip() for name in args.perturbations.split(',') if name.strip()]
+    unknown = [name for name in perturbations if name not in PERTURBATIONS]
+    if unknown:
+        parser.error(f"Unknown perturbation(s): {', '.join(unknown)}")
+    concurrency_levels = [int(level) for level in args.concurrency.split(',') if level.strip()]
+    try:
+        # Repeat lookups would measure the cache, not the matcher
+        config.RESULT_CACHE_ENABLED = False
+        overrides = apply_overrides(args.overrides)
+    except ValueError as e:
+        parser.error(str(e))
+
+    # Settings are read while identification initializes, so overrides go in first
+    start = time.perf_counter()
+    import identification
+    init_seconds = time.perf_counter() - start
+    if not identification.INITIALIZATION_SUCCESSFUL:
+        print("Exiting because matcher initialization failed. Please check previous errors.")
+        return 1
+
+    # Only images of bottles that are in the feature store have a right answer
+    known_ids = {str(bottle_id) for bottle_id in identification.current_catalogue().ids}
+    image_files = sorted(
+        os.path.join(config.IMAGE_DOWNLOAD_DIR, name) for name in os.listdir(config.IMAGE_DOWNLOAD_DIR)
+        if not name.startswith('.') and os.path.splitext(name)[0] in known_ids
+    )
+    if args.images and args.images < len(image_files):
+        image_files = sorted(random.Random(args.seed).sample(image_files, args.images))
+    queries = build_queries(image_files, perturbations)
+    if not queries:
+        print("Error: No benchmark queries could be built.")
+        return 1
+    print(f"Benchmarking {len(queries)} queries ({len(image_files)} images x {len(perturbations)} perturbations), "
+          f"MATCHER_ENGINE='{config.MATCHER_ENGINE}', MATCHING_BACKEND='{config.MATCHING_BACKEND}', "
+          f"{len(identification.current_catalogue().descriptors)} reference descriptors")
+
+    identification.find_best_match_from_bytes(queries[0][2])  # Warm up (pools, page cache)
+    results = run_accuracy(identification, queries)
+    throughput = []
+    for level in concurrency_levels:
+        throughput.append(run_throughput(identification, queries, level))
+        print(f"  {level} caller(s): {throughput[-1]['queries_per_s']:.2f} queries/s")
+
+    cold_start = measure_cold_start(args.cold_starts) if args.cold_starts > 0 else None
+    if cold_start is not None:
+        print(f"  cold start: median {cold_start['median_s']:.2f} s "
+              f"({'within' if cold_start['within_target'] else 'OVER'} the {cold_start['target_s']} s target)")
+
+    accuracy = accuracy_summary(results)
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'git': git_revision(),
+        'store_build_id': identification.current_catalogue().build_id,
+        'references': len(identification.current_catalogue()),
+        'descriptors': len(identification.current_catalogue().descriptors),
+        'pruning': identification.current_catalogue().features.pruning,
+        'overrides': overrides,
+        'config': config_snapshot(),
+        'engine': {'kind': identification.engine.kind, 'workers': identification.engine.workers,
+                   'cv2_threads': identification.engine.cv2_threads},
+        'seed': args.seed,
+        'images': len(image_files),
+        'perturbations': perturbations,
+        'accuracy': accuracy,
+        'latency_ms': latency_summary([r['latency_ms'] for r in results]),
+        'stage_mean_ms': {
+            stage: round(float(np.mean([r['timings'][stage] for r in results if stage in r['timings']])), 2)
+            for stage in ('decode', 'preprocess', 'detect', 'match')
+            if any(stage in r['timings'] for r in results)
+        },
+        'throughput': throughput,
+        'init_seconds': round(init_seconds, 3),
+        'cold_start': cold_start,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+    identification.engine.shutdown()
+
+    print(f"  top-1 {accuracy['top1']:.1%}, top-5 {accuracy['top5']:.1%}, latency p50 {report['latency_ms']['p50']:.1f} ms, "
+          f"p95 {report['latency_ms']['p95']:.1f} ms, p99 {report['latency_ms']['p99']:.1f} ms, peak RSS {report['peak_rss_mb']} MB")
+    for name, rates in accuracy['by_perturbation'].items():
+        print(f"    {name:<10} top-1 {rates['top1']:.1%}, top-5 {rates['top5']:.1%} ({rates['queries']} queries)")
+
+    report_json = json.dumps(report, indent=2, default=str)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(report_json + '\n')
+        print(f"Report written to '{args.output}'")
+    else:
+        print(report_json)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
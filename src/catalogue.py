@@ -0,0 +1,102 @@
+# src/catalogue.py
+
+import os
+import sys
+import time
+import numpy as np
+
+# Import configuration variables
+try:
+    import config
+except ModuleNotFoundError:
+    print("Error: config.py not found. Make sure it's in the 'src' directory.")
+    sys.exit(1)
+
+import feature_pipeline
+from ann_index import load_index
+from details_store import DetailsStore, open_details_store
+from feature_store import open_feature_store
+from global_signature import load_vocabulary
+
+class Catalogue:
+    """
+    One consistent version of the reference set: the feature store plus
+    everything derived from it (descriptor index, visual vocabulary, bottle
+    details). Never modified after loading; identification swaps in a new
+    Catalogue to reload, while requests keep using the one they started with.
+    """
+
+    def __init__(self, features, index, vocabulary, details):
+        self.features = features              # FeatureStore; indexable like a list of reference dicts
+        self.ids = features.ids               # Bottle ID for each reference
+        self.descriptors = features.descriptors  # All reference descriptors, memory-mapped
+        self.owner_ids = features.owner_ids   # Descriptor row -> reference index
+        self.index = index                    # k-NN index over descriptors (see ann_index.py), or None
+        self.vocabulary = vocabulary          # Global signatures for shortlisting, or None
+        self.details = details                # DetailsStore (see details_store.py)
+        self.build_id = features.build_id
+        self.loaded_at = time.time()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def stats(self):
+        return {
+            'bottles': len(self.ids),
+            'descriptors': len(self.descriptors),
+            'build_id': self.build_id,
+            'loaded_at': self.loaded_at,
+        }
+
+def file_signature(path=None):
+    """Cheap change detector for the feature store file (inode, size, mtime), or None if missing."""
+    try:
+        stat = os.stat(path or config.FEATURES_FILE)
+    except OSError:
+        return None
+    return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+def load_catalogue(path=None, matching=True, prefault=False):
+    """
+    Opens a feature store and builds everything matching needs from it.
+    Descriptor pages are read on first use, so loading time doesn't grow with
+    the catalogue. The index and vocabulary files are only used if they were saved
+    for this store's build; otherwise the index is rebuilt in memory and shortlisting
+    is disabled.
+
+    Args:
+        matching (bool): False where shard servers do the matching (see sharding.py):
+            only IDs and details are needed, so the index, the vocabulary and the
+            descriptor pages are left alone.
+        prefault (bool): Read every descriptor page now, so the first queries against
+            the catalogue don't pay for page faults. Worth it for a background reload,
+            which finishes before the catalogue is swapped in.
+
+    Raises:
+        ValueError: If the store is empty or was built with a different feature pipeline.
+    """
+    path = path or config.FEATURES_FILE
+    features = open_feature_store(path)
+    if not len(features):
+        raise ValueError(f"Feature file '{path}' is empty or invalid.")
+
+    # Queries must go through the same pipeline the references were extracted with
+    mismatches = feature_pipeline.param_mismatches(features.pipeline)
+    if mismatches:
+        for name, stored, current in mismatches:
+            print(f"Error: Feature store was built with {name}={stored!r}, config has {current!r}.")
+        raise ValueError("Re-run data_preparation.py to rebuild the feature store with the current settings.")
+
+    index, vocabulary = None, None
+    if matching:
+        index = load_index(features.descriptors, build_id=features.build_id)
+        if config.MATCHER_ENGINE in ('shortlist', 'per_reference'):
+            vocabulary = load_vocabulary(features)
+
+    # Bottle details: from the catalogue snapshot (the feature store) when it carries them,
+    # else from the details file, both prepared by data_preparation.py
+    details = DetailsStore.from_feature_store(features) or open_details_store()
+
+    if prefault and matching and len(features.descriptors):
+        np.asarray(features.descriptors).max()  # Fault the mapped pages in
+    return Catalogue(features, index, vocabulary, details)
@@ -1,6 +1,7 @@
 # src/config.py
 
 import os
+import tempfile
 import multiprocessing
 
 # Get the project root directory (one level up from src)
@@ -10,11 +11,17 @@ PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 # IMPORTANT: Make sure 'your_dataset.xlsx' is the correct name of your Excel file
 EXCEL_FILE_PATH = os.path.join(PROJECT_ROOT, 'data', 'bottle_dataset.xlsx')
 IMAGE_DOWNLOAD_DIR = os.path.join(PROJECT_ROOT, 'whisky_images')  # Absolute path to image directory
-FEATURES_FILE = os.path.join(PROJECT_ROOT, 'bottle_features.pkl')  # Absolute path to features file
+DOWNLOAD_MANIFEST_FILE = os.path.join(PROJECT_ROOT, 'data', 'image_manifest.json')  # ETags / resume state for downloads
+FEATURES_FILE = os.path.join(PROJECT_ROOT, 'bottle_features.store')  # Memory-mapped feature store (see feature_store.py)
+RAW_FEATURES_FILE = os.path.join(PROJECT_ROOT, 'bottle_features.raw.store')  # Unpruned features, reused by incremental rebuilds
+ANN_INDEX_FILE = os.path.join(PROJECT_ROOT, 'bottle_ann_index.bin')  # Prebuilt descriptor index
+VOCABULARY_FILE = os.path.join(PROJECT_ROOT, 'bottle_vocabulary.npz')  # Visual vocabulary + per-bottle signatures
+DETAILS_FILE = os.path.join(PROJECT_ROOT, 'bottle_details.json')  # JSON-ready bottle details (see details_store.py)
 
 # --- Feature Extraction Parameters (ORB) ---
 # Optimized for better accuracy while maintaining performance
 N_FEATURES_ORB = 1500  # Reduced from 2000 for better performance while maintaining accuracy
+N_FEATURES_QUERY = 750   # ORB features per query image; kept low as GEOMETRIC_VERIFICATION restores accuracy
 SCALE_FACTOR = 1.2    # Scale factor between levels in the scale pyramid
 N_LEVELS = 8         # Number of pyramid levels
 EDGE_THRESHOLD = 31  # Size of the border where features are not detected
@@ -22,15 +29,157 @@ FIRST_LEVEL = 0     # Level of pyramid to put source image
 WTA_K = 2           # Number of points to produce each element of the oriented BRIEF descriptor
 PATCH_SIZE = 31     # Size of the patch used by the oriented BRIEF descriptor
 FAST_THRESHOLD = 20 # FAST detector threshold
+CLAHE_CLIP_LIMIT = 2.0  # Contrast limit of the CLAHE applied before detection
+CLAHE_TILE_GRID = 8     # CLAHE tiles per image side
+# These, MAX_IMAGE_SIZE and N_FEATURES_ORB are stamped into the feature store; changing any
+# of them (except N_FEATURES_QUERY) requires re-running data_preparation.py
 
 # --- Matching Parameters ---
 MATCHER_THRESHOLD = 0.75  # Lowe's ratio test threshold
 MIN_MATCH_COUNT = 10     # Minimum number of good matches required
+# Reported confidence (0-1): (1 - second / best) * best / query descriptors, i.e. the
+# best-to-runner-up vote ratio mapped to 0 for a tie and 1 with no runner-up, weighted by the
+# share of the query that voted for the winner (see identification.best_from_votes)
+# Matching engine: 'stacked' runs one k-NN pass against all reference descriptors
+# concatenated into a single matrix; 'shortlist' first ranks bottles by global image
+# signature and ratio-test matches only the top SHORTLIST_SIZE; 'per_reference' matches
+# each bottle separately (legacy)
+MATCHER_ENGINE = 'stacked'
+
+# --- Early Termination ---
+# Query descriptors (strongest keypoints first, 'stacked' engine) or candidate references
+# (best shortlist rank first, 'shortlist' / 'per_reference') are matched in steps, and
+# matching stops once the leading bottle is EARLY_TERMINATION_MARGIN good matches ahead of
+# the best score expected of any other bottle (see identification.can_stop_early):
+# 'bound' - the most any other bottle could still reach; same result as matching
+#           everything, but seldom stops early (stacked: p50 6.4 s, as without it)
+# 'projected' - heuristic projection of the runner-up's rate; on 200 rotation/scale
+#           queries the same top-1/top-5 accuracy as 'bound' at p50 1.45 s
+# False matches everything
+EARLY_TERMINATION = 'projected'
+EARLY_TERMINATION_MARGIN = 10   # Required lead, in good matches
+EARLY_TERMINATION_CHUNK = 128   # Query descriptors matched per step ('stacked' engine)
+
+# --- Geometric Verification ---
+# The GEOMETRIC_TOP_K bottles with the most good matches are re-ranked by how many of those
+# matches fit one RANSAC homography between reference and query keypoints. This separates
+# near-identical labels (e.g. bottles from the same distillery) that tie on match count.
+GEOMETRIC_VERIFICATION = True
+GEOMETRIC_TOP_K = 5
+RANSAC_REPROJECTION_THRESHOLD = 8.0   # Max reprojection error, in query pixels, for an inlier
+
+# --- Two-Stage Retrieval ('shortlist' engine) ---
+# Check shortlist recall after tuning with: python src/global_signature.py
+SHORTLIST_SIZE = 20                  # Candidates passed on to ORB ratio-test matching
+VOCABULARY_SIZE = 1024               # Number of visual words
+VOCABULARY_TRAINING_SAMPLE = 200000  # Reference descriptors sampled to train the vocabulary
+
+# --- Descriptor Index (used by the 'stacked' engine) ---
+# 'brute' is exact Hamming search; 'flann_lsh' and 'mih' are approximate and much faster on
+# large catalogues. Check accuracy after tuning with: python src/ann_index.py
+ANN_INDEX_TYPE = 'brute'
+LSH_TABLE_NUMBER = 12       # FLANN LSH: number of hash tables
+LSH_KEY_SIZE = 20           # FLANN LSH: hash key length in bits
+LSH_MULTI_PROBE_LEVEL = 2   # FLANN LSH: neighbouring buckets probed per table
+LSH_CHECKS = 64             # FLANN LSH: max candidates checked per query descriptor
+MIH_NUM_TABLES = 16         # Multi-index hashing: substrings per descriptor (must divide 32 bytes)
+MIH_MAX_BUCKET = 2000       # Multi-index hashing: buckets larger than this are ignored
+
+# --- Descriptor Pruning (data_preparation.py; see src/descriptor_pruning.py) ---
+# Drops reference descriptors that repeat within a bottle or closely match many other bottles,
+# then keeps at most PRUNE_MAX_DESCRIPTORS per bottle, so there is less to match per query.
+# Compare accuracy with: python src/benchmark.py --set FEATURES_FILE=<pruned or raw store>
+PRUNE_DESCRIPTORS = True
+PRUNE_MAX_DESCRIPTORS = 1000    # Per-bottle budget after pruning
+PRUNE_MIN_DESCRIPTORS = 100     # Bottles keep at least this many, shared or not (if they have them)
+PRUNE_DUPLICATE_DISTANCE = 24   # Max Hamming distance (of 256 bits) at which two descriptors of a bottle are duplicates
+PRUNE_SHARED_DISTANCE = 40      # Max Hamming distance at which a descriptor counts as shared with another bottle
+PRUNE_MAX_SHARED_BOTTLES = 5    # Descriptors shared with this many other bottles are dropped
+PRUNE_NEIGHBOURS = 8            # Nearest neighbours examined per descriptor
+PRUNE_LSH_TABLES = 24           # Neighbour search (FLANN LSH): hash tables
+PRUNE_LSH_KEY_SIZE = 20         # Neighbour search: hash key length in bits
+PRUNE_LSH_PROBE_LEVEL = 1       # Neighbour search: neighbouring buckets probed per table
 
 # --- Performance Optimization ---
-MAX_IMAGE_SIZE = 1024    # Maximum image dimension for processing
-NUM_WORKERS = min(multiprocessing.cpu_count(), 4)  # Number of worker threads
-CACHE_SIZE = 100         # Size of the LRU cache for bottle details
+MAX_IMAGE_SIZE = 1024    # Images are resized to this before detection (indexing and queries)
+NUM_WORKERS = min(multiprocessing.cpu_count(), 4)  # Max parallel matching tasks per process
+COLD_START_TARGET_SECONDS = 2.0  # Budget for a fresh 'import app' (worker boot), checked by src/benchmark.py
+
+# --- Matching Engine ---
+# 'threads' fans matching tasks out over a thread pool, 'processes' over a pool of spawned
+# processes that memory-map the feature store, and 'inline' runs them in the request thread
+# while OpenCV parallelises internally. Every backend keeps
+# (parallel tasks x cv2.setNumThreads) within this process's share of CPU_BUDGET, query
+# feature extraction included.
+# Compare backends under load with: python src/matching_engine.py
+MATCHING_BACKEND = 'threads'
+CPU_BUDGET = multiprocessing.cpu_count()               # Cores the whole service may use for matching
+WEB_WORKERS = int(os.environ.get('WEB_CONCURRENCY', 1))  # gunicorn worker processes sharing CPU_BUDGET
+
+# --- Sharded Matching (catalogues too large for one process; see src/shard_server.py) ---
+# data_preparation.py --shards N splits the catalogue into N shard stores. Each is served by
+# a matcher process (python src/shard_server.py starts one per shard on this host); with
+# SHARD_ADDRESSES set, web workers send every query to all shards and merge their best
+# candidates instead of matching themselves.
+SHARD_COUNT = int(os.environ.get('SHARD_COUNT', 0))  # Default for data_preparation.py --shards (0 = no shards)
+SHARD_ADDRESSES = [address for address in os.environ.get('SHARD_ADDRESSES', '').split(',') if address]  # 'unix:/path' or 'host:port'
+SHARD_SOCKET_DIR = os.path.join(tempfile.gettempdir(), 'whisky-goggles-shards')  # Unix sockets of locally started shards
+SHARD_TIMEOUT = 10.0  # Seconds to wait for each shard; queries are answered from the shards that replied in time
+SHARD_TOP_K = 10      # Best candidates each shard returns per query
+
+# --- Result Cache (repeat / near-identical uploads) ---
+RESULT_CACHE_ENABLED = True
+RESULT_CACHE_SIZE = 256               # Max cached identification results
+RESULT_CACHE_TTL = 600                # Seconds a cached result stays valid (0 = no expiry)
+RESULT_CACHE_HAMMING_TOLERANCE = 8    # Max differing bits (of 256) for a perceptual-hash hit
+RESULT_CACHE_MAX_PIXEL_DIFF = 1.5     # Max mean 32x32 thumbnail difference (0-255) to confirm a hit
+
+# --- Metrics (/metrics endpoint, Prometheus text format) ---
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # Histogram bounds, seconds
+
+# --- Request Queue (per web worker; see src/job_queue.py) ---
+IDENTIFY_WORKERS = 2          # Identification jobs run at once; further ones wait in the queue
+IDENTIFY_QUEUE_DEPTH = 8      # Max jobs queued or running; beyond that /identify answers 503 with Retry-After
+IDENTIFY_SYNC_TIMEOUT = 60    # Seconds /identify waits before answering 202 with a job to poll (below gunicorn --timeout)
+JOB_RESULT_TTL = 300          # Seconds a finished job can still be polled at GET /identify/<job_id>
+JOB_DIR = os.path.join(tempfile.gettempdir(), 'whisky-goggles-jobs')  # Pollable jobs, shared by all workers
+# gunicorn threads per worker (see gunicorn.conf.py). They don't use the CPU budget: they
+# receive uploads and wait on the queue, which turns away requests beyond its depth, so one
+# thread per job the queue holds, plus a few for polls, /metrics and static files
+WEB_THREADS = IDENTIFY_QUEUE_DEPTH + 2
+
+# --- Shelf Mode (several bottles per photo; POST /identify/shelf) ---
+# A shelf photo is matched with thousands of descriptors, so it wants the 'shortlist' engine
+# or an approximate ANN_INDEX_TYPE; an exact 'brute' index takes seconds per thousand on one core.
+SHELF_MAX_IMAGE_SIZE = 2048          # Shelf photos keep more resolution, as each bottle covers only part of them
+SHELF_N_FEATURES = 6000              # ORB features detected once over the whole shelf photo
+SHELF_GRID_CELLS = 48                # Keypoint density grid cells along the longest side, for segmentation
+SHELF_DENSITY_THRESHOLD = 1.0        # Grid cells at least this multiple of the mean density are bottle candidates
+SHELF_MIN_REGION_KEYPOINTS = 40      # Keypoint clusters smaller than this are not matched
+SHELF_SPLIT_FRACTION = 0.15          # Regions are split at columns with fewer keypoints than this share of their median
+SHELF_REGION_FEATURES = 1000         # Strongest keypoints of a region it is matched with (weak ones dilute the shortlist)
+SHELF_MAX_BOTTLES_PER_REGION = 4     # Matching rounds per region; bottles standing close together share a region
+SHELF_MAX_BOTTLES = 60               # Max bottles reported per photo
+
+# --- Catalogue Reload (new feature store without restarting workers) ---
+CATALOGUE_WATCH_INTERVAL = 10  # Seconds between checks for changed catalogue files (0 = no watcher)
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')  # Bearer token for POST /admin/reload; endpoint disabled if unset
+
+# --- Live Recognition (src/webcam_identify.py --continuous) ---
+LIVE_MAX_RECOGNITIONS_PER_SECOND = 4  # Frames matched per second at most; the preview keeps the full frame rate
+LIVE_GATE_WIDTH = 320                 # Frames are checked for motion and focus at this width
+LIVE_MOTION_THRESHOLD = 6.0           # Max mean pixel change (0-255) from the previous frame for a steady view
+LIVE_SHARPNESS_THRESHOLD = 60.0       # Min variance of the Laplacian for a frame to count as in focus
+LIVE_VOTE_WINDOW = 5                  # Recent recognitions considered when confirming a bottle
+LIVE_VOTES_TO_CONFIRM = 3             # Recognitions of the same bottle within the window that confirm it
+
+# --- Image Download ---
+DOWNLOAD_WORKERS = 16           # Concurrent downloads (threads sharing one pooled session)
+DOWNLOAD_PER_HOST_LIMIT = 8     # Max concurrent requests against any one host
+DOWNLOAD_MAX_RETRIES = 3        # Retries for connection errors, 429 and 5xx responses
+DOWNLOAD_BACKOFF_SECONDS = 0.5  # Initial retry delay, doubled on each attempt
+DOWNLOAD_TIMEOUT = 20           # Per-request timeout in seconds
+DOWNLOAD_REVALIDATE = True      # Re-check existing images with ETag/Last-Modified conditional requests
 
 # --- Dataset Column Names (Adjust if your Excel file uses different names) ---
 COL_ID = 'id'
@@ -38,5 +187,8 @@ COL_NAME = 'name'
 COL_IMAGE_URL = 'image_url'
 
 # --- Production Settings ---
-TEMP_FILE_CLEANUP_AGE = 300  # Clean up temp files older than 5 minutes (300 seconds)
 MAX_UPLOAD_SIZE = 10 * 1024 * 1024  # 10MB max upload size
+UPLOAD_FORMATS = ('image/webp', 'image/jpeg')  # Encodings clients should prepare uploads in, preferred first
+UPLOAD_QUALITY = 0.85                          # Lossy encoding quality (0-1) advertised to clients
+MAX_BATCH_IMAGES = 32                      # Max images per /identify/batch request
+MAX_BATCH_UPLOAD_SIZE = 64 * 1024 * 1024   # 64MB max total size of a /identify/batch request
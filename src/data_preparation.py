@@ -1,13 +1,13 @@
 # src/data_preparation.py
 
 import pandas as pd
-import requests
 import cv2
 import numpy as np
-import pickle
 import os
 import time
-from pathlib import Path
+import json
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import sys
 
 # Import configuration variables
@@ -17,128 +17,303 @@ except ModuleNotFoundError:
     print("Error: config.py not found. Make sure it's in the 'src' directory.")
     sys.exit(1)
 
+import ann_index
+import sharding
+import descriptor_pruning
+from image_downloader import ImageDownloader
+from feature_store import write_feature_store, open_feature_store, normalize_id
+from details_store import write_details_file, details_from_dataframe, record_body
+import feature_pipeline
+from global_signature import VisualVocabulary
+
 def download_images(df_bottles):
     """Downloads images specified in the dataframe."""
     print(f"\n--- Starting Image Downloads to '{config.IMAGE_DOWNLOAD_DIR}' ---")
-    os.makedirs(config.IMAGE_DOWNLOAD_DIR, exist_ok=True)
-    download_count = 0
-    download_errors = 0
-    image_paths = {} # Dictionary to store {id: path}
-
-    for index, row in df_bottles.iterrows():
-        bottle_id = row[config.COL_ID]
-        image_url = row[config.COL_IMAGE_URL]
-
+    jobs = []
+    invalid_urls = 0
+    for bottle_id, image_url in zip(df_bottles[config.COL_ID], df_bottles[config.COL_IMAGE_URL]):
         if not image_url or not isinstance(image_url, str):
             print(f"Warning: Invalid or missing URL for ID {bottle_id}. Skipping.")
-            download_errors += 1
+            invalid_urls += 1
             continue
+        jobs.append((bottle_id, image_url))
 
-        try:
-            # Create a filename using the bottle ID
-            file_extension = Path(image_url).suffix if Path(image_url).suffix else '.jpg'
-            safe_id_str = str(bottle_id).replace('/','_').replace('\\','_').replace(':','_') # Sanitize common problematic chars
-            image_filename = f"{safe_id_str}{file_extension}"
-            # Construct path relative to the project root
-            image_path = os.path.join(config.IMAGE_DOWNLOAD_DIR, image_filename)
-
-            if not os.path.exists(image_path):
-                try:
-                    response = requests.get(image_url, stream=True, timeout=20) # Increased timeout
-                    response.raise_for_status()
-
-                    with open(image_path, 'wb') as f:
-                        for chunk in response.iter_content(chunk_size=8192):
-                            f.write(chunk)
-                    download_count += 1
-                    image_paths[bottle_id] = image_path # Store path on success
-                    # print(f"Downloaded: {image_filename}") # Verbose output
-                    time.sleep(0.05) # Small delay
-
-                except requests.exceptions.RequestException as e:
-                    print(f"Error downloading {image_url} for ID {bottle_id}: {e}")
-                    download_errors += 1
-                except Exception as e:
-                    print(f"Error saving file {image_filename} for ID {bottle_id}: {e}")
-                    download_errors += 1
-            else:
-                # print(f"Skipped (already exists): {image_filename}") # Verbose output
-                image_paths[bottle_id] = image_path # Store path even if exists
+    downloader = ImageDownloader()
+    image_paths, stats = downloader.download_all(jobs)
 
-        except Exception as e:
-            print(f"Error processing row for ID {bottle_id} (URL: {image_url}): {e}")
-            download_errors += 1
-
-    print(f"\nImage download complete.")
-    print(f"  Successfully downloaded: {download_count} new images.")
+    print("\nImage download complete.")
+    print(f"  Successfully downloaded: {stats['downloaded']} new or changed images.")
+    print(f"  Unchanged on server (304): {stats['not_modified']}; reused without a request: {stats['cached']}.")
     print(f"  Found existing/downloaded: {len(image_paths)} images.")
-    print(f"  Errors encountered: {download_errors}.")
+    print(f"  Errors encountered: {stats['error'] + invalid_urls}.")
     return image_paths
 
 
-def extract_features(image_paths_dict):
-    """Extracts ORB features from images and saves them."""
-    print(f"\n--- Starting Feature Extraction (using {config.N_FEATURES_ORB} features) ---")
-
-    orb = cv2.ORB_create(nfeatures=config.N_FEATURES_ORB)
-    reference_features = []
+# Feature detector for each extraction worker process (created on first use)
+_worker_detector = None
+
+def _init_extraction_worker():
+    """Keeps OpenCV single-threaded inside pool workers so processes don't oversubscribe cores."""
+    cv2.setNumThreads(1)
+
+def _detect_features(image_path):
+    """
+    Worker task: loads one image and runs the shared feature pipeline on it.
+    Returns (descriptors, keypoints) where keypoints holds the x/y coordinates
+    of each descriptor, or (None, None).
+    """
+    global _worker_detector
+    if _worker_detector is None:
+        _worker_detector = feature_pipeline.create_detector()
+    img = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
+    if img is None:
+        return None, None
+    keypoints, descriptors = feature_pipeline.extract(img, _worker_detector)
+    return descriptors, keypoints
+
+def feature_cache_key(image_path):
+    """
+    Identifies the features an image will produce: a hash of the image bytes plus
+    the feature pipeline parameters. Unchanged images with unchanged parameters
+    reuse their entry.
+    """
+    with open(image_path, 'rb') as f:
+        content_hash = hashlib.sha256(f.read()).hexdigest()
+    params_hash = hashlib.sha256(json.dumps(feature_pipeline.pipeline_params(), sort_keys=True).encode('utf-8')).hexdigest()
+    return f"{content_hash}:{params_hash[:16]}"
+
+def load_existing_features():
+    """
+    Returns {(bottle_id, cache_key): (descriptors, keypoints)} from the unpruned
+    feature stores on disk: the copy kept when descriptors are pruned and the
+    current store, unless it is pruned. Entries are keyed by image content and ORB
+    parameters, so either store's are valid.
+    """
+    existing = {}
+    for path in (config.RAW_FEATURES_FILE, config.FEATURES_FILE):
+        if not os.path.exists(path):
+            continue
+        try:
+            store = open_feature_store(path)
+        except Exception as e:
+            print(f"Warning: Existing feature store '{path}' unreadable ({e}). Its features will be re-extracted.")
+            continue
+        if store.pruning is not None:
+            continue  # Pruning depends on the whole catalogue, so pruned features can't stand in for extracted ones
+        for idx, key in enumerate(store.keys):
+            if key is not None:
+                ref = store[idx]
+                # Copy out of the map before it is replaced
+                existing[(store.ids[idx], key)] = (np.array(ref['descriptors']), np.array(ref['keypoints']))
+    return existing
+
+def load_pruned_store():
+    """The current feature store if its descriptors were pruned (see descriptor_pruning.py), else None."""
+    if not os.path.exists(config.FEATURES_FILE):
+        return None
+    try:
+        store = open_feature_store()
+    except Exception as e:
+        print(f"Warning: Existing feature store unreadable ({e}). Pruning every bottle.")
+        return None
+    return store if store.pruning is not None else None
+
+def extract_features(image_paths_dict, bottle_names, full_rebuild=False, details=None, shard_count=0):
+    """
+    Extracts ORB features from images and saves them.
+
+    Only images that are new or whose content (or the ORB parameters) changed
+    since the last run are processed, across a pool of worker processes; all
+    other entries are carried over from the existing feature store.
+
+    Args:
+        image_paths_dict (dict): {bottle_id: image_path}
+        bottle_names (dict): {bottle_id: name}
+        full_rebuild (bool): Ignore the existing store: re-extract and re-prune everything.
+        details (dict): {bottle_id: details dict}, embedded in the store so it is a
+            complete catalogue snapshot (see details_store.py).
+        shard_count (int): Also split the store into this many shards (see write_shards).
+    """
+    print(f"\n--- Starting Feature Extraction (using {config.N_FEATURES_ORB} features, "
+          f"max image size {config.MAX_IMAGE_SIZE}) ---")
+
+    details = details or {}
+    existing = {} if full_rebuild else load_existing_features()
+    features_by_id = {}  # bottle_id -> (descriptors, keypoints)
+    cache_keys = {}
+    pending = {}
     extraction_errors = 0
-    processed_count = 0
-    total_images = len(image_paths_dict)
 
     for bottle_id, image_path in image_paths_dict.items():
         try:
-            # Load image in grayscale
-            img = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
-
-            if img is None:
-                print(f"Warning: Could not load image {image_path} for ID {bottle_id}. Skipping.")
-                extraction_errors += 1
-                continue
-
-            # Detect keypoints and compute descriptors
-            keypoints, descriptors = orb.detectAndCompute(img, None)
-
-            if descriptors is None or len(descriptors) == 0:
-                print(f"Warning: No descriptors found for image {image_path} (ID: {bottle_id}). Skipping.")
-                extraction_errors += 1
-                continue
-
-            # Fetch the name from the original dataframe (needs df passed or accessed)
-            # Assuming df_bottles is accessible in this scope or passed as argument
-            bottle_name = df_bottles.loc[df_bottles[config.COL_ID] == bottle_id, config.COL_NAME].iloc[0]
-
-            reference_features.append({
-                'id': bottle_id,
-                'name': bottle_name,
-                'descriptors': descriptors
-            })
-            processed_count += 1
-
-            # Progress indicator
-            if processed_count % 50 == 0 or processed_count == total_images:
-               print(f"  Processed {processed_count}/{total_images} images...")
-
-
-        except Exception as e:
-            print(f"Error processing image {image_path} for ID {bottle_id}: {e}")
+            key = feature_cache_key(image_path)
+        except OSError as e:
+            print(f"Warning: Could not read image {image_path} for ID {bottle_id}: {e}. Skipping.")
             extraction_errors += 1
-
-    print(f"\nFeature extraction complete.")
-    print(f"  Successfully processed: {processed_count} images.")
+            continue
+        cache_keys[bottle_id] = key
+        cached = existing.get((normalize_id(bottle_id), key))
+        if cached is not None:
+            features_by_id[bottle_id] = cached
+        else:
+            pending[bottle_id] = image_path
+
+    reused_count = len(features_by_id)
+    print(f"  Reusing features for {reused_count} unchanged images; extracting {len(pending)}.")
+
+    if pending:
+        with ProcessPoolExecutor(max_workers=config.NUM_WORKERS, initializer=_init_extraction_worker) as pool:
+            futures = {pool.submit(_detect_features, path): bottle_id for bottle_id, path in pending.items()}
+            for done_count, future in enumerate(as_completed(futures), start=1):
+                bottle_id = futures[future]
+                try:
+                    descriptors, keypoints = future.result()
+                    if descriptors is None or len(descriptors) == 0:
+                        print(f"Warning: No descriptors found for image {pending[bottle_id]} (ID: {bottle_id}). Skipping.")
+                        extraction_errors += 1
+                    else:
+                        features_by_id[bottle_id] = (descriptors, keypoints)
+                except Exception as e:
+                    print(f"Error processing image {pending[bottle_id]} for ID {bottle_id}: {e}")
+                    extraction_errors += 1
+
+                # Progress indicator
+                if done_count % 50 == 0 or done_count == len(pending):
+                    print(f"  Processed {done_count}/{len(pending)} images...")
+
+    # Keep the catalogue order of image_paths_dict so store indexes are stable between runs
+    reference_features = [
+        {
+            'id': bottle_id,
+            'name': bottle_names.get(bottle_id),
+            'descriptors': features_by_id[bottle_id][0],
+            'keypoints': features_by_id[bottle_id][1],
+            'key': cache_keys[bottle_id],
+            'details': record_body(details[bottle_id]) if bottle_id in details else None,
+        }
+        for bottle_id in image_paths_dict if bottle_id in features_by_id
+    ]
+
+    print("\nFeature extraction complete.")
+    print(f"  Successfully processed: {len(reference_features) - reused_count} images (+{reused_count} unchanged).")
     print(f"  Errors/Skipped: {extraction_errors}.")
 
     # --- Save the features ---
     if reference_features:
         try:
-            with open(config.FEATURES_FILE, 'wb') as f:
-                pickle.dump(reference_features, f)
-            print(f"Reference features saved to '{config.FEATURES_FILE}'")
+            pruning = None
+            if config.PRUNE_DESCRIPTORS:
+                write_feature_store(config.RAW_FEATURES_FILE, reference_features)
+                print(f"\n--- Pruning reference descriptors (at most {config.PRUNE_MAX_DESCRIPTORS} per bottle) ---")
+                # Unchanged bottles keep the previous store's selection; --full prunes them all again
+                previous = None if full_rebuild else load_pruned_store()
+                reference_features, stats = descriptor_pruning.prune_references(reference_features, previous=previous)
+                descriptor_pruning.print_stats(stats)
+                pruning = dict(descriptor_pruning.pruning_params(), **stats)
+            # Staged under another name until its index and vocabulary are written, so that
+            # a catalogue watcher never sees the new store without them
+            staged_path = staged_store_path(config.FEATURES_FILE)
+            build_id = write_feature_store(staged_path, reference_features, pruning=pruning)
         except Exception as e:
             print(f"Error saving features to {config.FEATURES_FILE}: {e}")
+            return
+        store = open_feature_store(staged_path)
+        build_descriptor_index(store)
+        build_vocabulary(store, retrain=full_rebuild)
+        os.replace(staged_path, config.FEATURES_FILE)
+        print(f"\nReference features saved to '{config.FEATURES_FILE}' (build {build_id})")
+        write_shards(store, shard_count)
     else:
         print("Warning: No features were extracted. Feature file not saved.")
 
+
+def staged_store_path(path):
+    """Where a new store is written before it replaces path (its index and vocabulary are built in between)."""
+    return f"{path}.new"
+
+def build_descriptor_index(store, path=None):
+    """
+    Builds the ANN index selected by config.ANN_INDEX_TYPE over the feature store's
+    descriptors, saved with the store's build ID (see ann_index.load_index).
+    """
+    if config.ANN_INDEX_TYPE == ann_index.BruteForceIndex.kind:
+        print("ANN_INDEX_TYPE is 'brute'; no descriptor index to build.")
+        return
+
+    print(f"\n--- Building '{config.ANN_INDEX_TYPE}' descriptor index ---")
+    try:
+        descriptors = store.descriptors
+        start = time.time()
+        index = ann_index.build_index(descriptors)
+        path = path or config.ANN_INDEX_FILE
+        index.save(path, store.build_id)
+        print(f"Indexed {len(descriptors)} descriptors in {time.time() - start:.1f}s, saved to '{path}'")
+    except Exception as e:
+        print(f"Error building descriptor index: {e}")
+
+def build_vocabulary(store, retrain=False):
+    """
+    Builds the per-bottle signatures used by the 'shortlist' engine. The visual
+    words of an existing vocabulary are reused unless retrain is set, so adding
+    bottles only recomputes signatures.
+    """
+    try:
+        start = time.time()
+        words = None
+        if not retrain and os.path.exists(config.VOCABULARY_FILE):
+            previous = VisualVocabulary.load(config.VOCABULARY_FILE)
+            if len(previous.words) == config.VOCABULARY_SIZE:
+                words = previous.words
+
+        if words is None:
+            print(f"\n--- Training visual vocabulary ({config.VOCABULARY_SIZE} words) ---")
+            vocabulary = VisualVocabulary.train(store)
+        else:
+            print("\n--- Updating bottle signatures with the existing visual vocabulary ---")
+            vocabulary = VisualVocabulary.from_words(words, store)
+        vocabulary.save(config.VOCABULARY_FILE)
+        print(f"Vocabulary ready in {time.time() - start:.1f}s, saved to '{config.VOCABULARY_FILE}'")
+    except Exception as e:
+        print(f"Error training visual vocabulary: {e}")
+
+def write_shards(store, count):
+    """
+    Splits the feature store into count shard stores (see sharding.py) for
+    shard_server.py to serve, each with its own descriptor index and bottle
+    signatures over the full catalogue's visual words. Shard files left over
+    from an earlier run with more shards are removed.
+    """
+    count = min(count, len(store))
+    for path in (config.FEATURES_FILE, config.ANN_INDEX_FILE, config.VOCABULARY_FILE):
+        for index, stale_path in sharding.shard_files(path).items():
+            if index >= count:
+                os.remove(stale_path)
+                if os.path.exists(ann_index.meta_path(stale_path)):
+                    os.remove(ann_index.meta_path(stale_path))
+                print(f"Removed stale shard file '{stale_path}'")
+    if count <= 0:
+        return
+
+    print(f"\n--- Splitting the catalogue into {count} shards ---")
+    try:
+        words = VisualVocabulary.load(config.VOCABULARY_FILE).words if os.path.exists(config.VOCABULARY_FILE) else None
+        for index, members in enumerate(sharding.partition(len(store), count)):
+            references = [dict(store[idx], key=store.keys[idx], details=store.details_body(idx)) for idx in members]
+            path = sharding.shard_path(config.FEATURES_FILE, index)
+            staged_path = staged_store_path(path)  # Replaces path last, as in extract_features
+            build_id = write_feature_store(staged_path, references, store.pipeline, pruning=store.pruning,
+                                           shard={'index': index, 'count': count, 'catalogue_build_id': store.build_id})
+            shard_store = open_feature_store(staged_path)
+            if config.ANN_INDEX_TYPE != ann_index.BruteForceIndex.kind:
+                build_descriptor_index(shard_store, sharding.shard_path(config.ANN_INDEX_FILE, index))
+            if words is not None:
+                VisualVocabulary.from_words(words, shard_store).save(sharding.shard_path(config.VOCABULARY_FILE, index))
+            os.replace(staged_path, path)
+            print(f"  Shard {index}: {len(shard_store)} bottles, {len(shard_store.descriptors)} descriptors "
+                  f"saved to '{path}' (build {build_id})")
+    except Exception as e:
+        print(f"Error writing catalogue shards: {e}")
+
 # --- Main Execution Logic ---
 if __name__ == "__main__":
     print("Starting Data Preparation...")
@@ -169,8 +344,16 @@ if __name__ == "__main__":
         print(f"Error reading Excel file: {e}")
         sys.exit(1)
 
+    # Bottle details served with each match, pre-serialized so the app never reads the Excel file
+    bottle_details = None
+    try:
+        bottle_details = details_from_dataframe(df)
+        count = write_details_file(details=bottle_details)
+        print(f"Saved details for {count} bottles to '{config.DETAILS_FILE}'")
+    except Exception as e:
+        print(f"Error saving bottle details to {config.DETAILS_FILE}: {e}")
+
     # 2. Download Images
-    # Make df_bottles global or pass it around if needed in extract_features without redefining it
     image_paths_map = download_images(df_bottles)
 
     # Filter dataframe to only include bottles whose images were successfully found/downloaded
@@ -180,8 +363,15 @@ if __name__ == "__main__":
 
 
     # 3. Extract Features
+    # --full re-extracts every image instead of reusing unchanged entries from the existing store;
+    # --shards N also splits it into N shards for shard_server.py (default SHARD_COUNT)
     if not df_bottles.empty:
-        extract_features(image_paths_map)
+        bottle_names = dict(zip(df_bottles[config.COL_ID], df_bottles[config.COL_NAME]))
+        shard_count = config.SHARD_COUNT
+        if '--shards' in sys.argv:
+            shard_count = int(sys.argv[sys.argv.index('--shards') + 1])
+        extract_features(image_paths_map, bottle_names, full_rebuild='--full' in sys.argv, details=bottle_details,
+                         shard_count=shard_count)
     else:
         print("No images were successfully downloaded or found. Skipping feature extraction.")
 
@@ -0,0 +1,262 @@
+# src/descriptor_pruning.py
+
+import os
+import sys
+import time
+import numpy as np
+import cv2
+
+# Import configuration variables
+try:
+    import config
+except ModuleNotFoundError:
+    print("Error: config.py not found. Make sure it's in the 'src' directory.")
+    sys.exit(1)
+
+import ann_index
+from feature_store import normalize_id
+
+# Offline pruning of reference descriptors, run by data_preparation.py before the feature
+# store is written. ORB keeps up to N_FEATURES_ORB descriptors per bottle, and many of them
+# only add cost: near-copies of each other along the same edge or letter, and generic
+# patterns (bottle outlines, background, common label type) whose nearest neighbours
+# belong to many other bottles, so they fail the ratio test or vote for the wrong one.
+# Pruning drops both kinds and keeps at most PRUNE_MAX_DESCRIPTORS per bottle, those
+# shared with the fewest other bottles first and, among equals, the strongest keypoints.
+# References with the very same image (the same photo under several IDs) don't count as
+# sharing with each other, and no bottle is left with fewer than PRUNE_MIN_DESCRIPTORS.
+#
+# Sharing depends on the whole catalogue, so a full pass searches the neighbours of every
+# descriptor (about 10 minutes for 500 bottles on one core). Incremental runs of
+# data_preparation.py only prune new and changed bottles; the others keep the selection
+# of the previous store, without counting what they share with the new bottles until the
+# next full pass (data_preparation.py --full, or this script).
+#
+#   python src/descriptor_pruning.py                 prune the current catalogue in place
+#   python src/descriptor_pruning.py --output x.store  write the pruned store elsewhere, e.g. to compare:
+#   python src/benchmark.py --set FEATURES_FILE=x.store
+
+def duplicate_mask(descriptors, max_distance=None):
+    """
+    Near-duplicates within one bottle's descriptors, which come strongest keypoint
+    first: a descriptor is a duplicate if it lies within max_distance bits of an
+    earlier one that was kept.
+
+    Returns:
+        np.ndarray: True for each descriptor to drop.
+    """
+    max_distance = config.PRUNE_DUPLICATE_DISTANCE if max_distance is None else max_distance
+    duplicates = np.zeros(len(descriptors), dtype=bool)
+    if len(descriptors) < 2 or max_distance <= 0:
+        return duplicates
+    descriptors = np.ascontiguousarray(descriptors)
+    matcher = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=False)
+    # radiusMatch keeps distances strictly below the radius; Hamming distances are whole bits
+    for matches in matcher.radiusMatch(descriptors, descriptors, max_distance + 0.5):
+        if not matches or duplicates[matches[0].queryIdx]:
+            continue
+        for m in matches:
+            if m.trainIdx > m.queryIdx:
+                duplicates[m.trainIdx] = True
+    return duplicates
+
+def image_groups(references):
+    """
+    Group number of each reference: references whose feature cache keys share the
+    image content hash (see data_preparation.feature_cache_key) get the same one.
+    """
+    groups = {}
+    numbers = []
+    for idx, ref in enumerate(references):
+        key = ref.get('key')
+        content = key.split(':', 1)[0] if key else idx
+        numbers.append(groups.setdefault(content, len(groups)))
+    return np.array(numbers, dtype=np.int64)
+
+def shared_bottle_counts(queries, query_owners, descriptors, owner_ids, chunk_size=20000):
+    """
+    For every query descriptor, the number of other bottles among its PRUNE_NEIGHBOURS
+    nearest neighbours in the catalogue within PRUNE_SHARED_DISTANCE bits.
+
+    Exact search is quadratic in the catalogue size, and substring indexes ('mih') miss
+    most neighbours that far apart, so the search uses FLANN LSH probing neighbouring
+    buckets (PRUNE_LSH_*): it finds nearly all bottles sharing a descriptor at a fraction
+    of the exact cost.
+
+    Args:
+        queries (np.ndarray): (n, 32) descriptors to count for.
+        query_owners (np.ndarray): Owner of each query descriptor.
+        descriptors (np.ndarray): (m, 32) descriptors of the whole catalogue, queries included.
+        owner_ids (np.ndarray): Owner of each catalogue descriptor (its reference's image group).
+
+    Returns:
+        np.ndarray: Other-bottle count per query descriptor.
+    """
+    descriptors = np.ascontiguousarray(descriptors, dtype=np.uint8)
+    index = ann_index.FlannLshIndex(descriptors, cv2.flann_Index(descriptors, dict(
+        algorithm=ann_index.FLANN_INDEX_LSH,
+        table_number=config.PRUNE_LSH_TABLES,
+        key_size=config.PRUNE_LSH_KEY_SIZE,
+        multi_probe_level=config.PRUNE_LSH_PROBE_LEVEL
+    )))
+    k = config.PRUNE_NEIGHBOURS + 1  # The descriptor itself is its own nearest neighbour
+    counts = np.zeros(len(queries), dtype=np.int64)
+    start = time.time()
+    for first in range(0, len(queries), chunk_size):
+        rows, distances = index.knn(np.ascontiguousarray(queries[first:first + chunk_size]), k)
+        owners = np.where(rows >= 0, owner_ids[np.maximum(rows, 0)], -1)
+        own = query_owners[first:first + chunk_size, None]
+        shared = (rows >= 0) & (owners != own) & (distances <= config.PRUNE_SHARED_DISTANCE)
+        # Distinct other bottles per row: sort the owners, count where the value changes
+        owners = np.sort(np.where(shared, owners, -1), axis=1)
+        counts[first:first + chunk_size] = (owners[:, 0] >= 0) + ((owners[:, 1:] != owners[:, :-1]) & (owners[:, 1:] >= 0)).sum(axis=1)
+        done = min(first + chunk_size, len(queries))
+        print(f"  Neighbours searched for {done}/{len(queries)} descriptors ({time.time() - start:.0f}s)")
+    return counts
+
+def reusable_selections(previous, params):
+    """
+    Descriptors an earlier run kept per bottle, if previous was pruned with params.
+
+    Returns:
+        dict: {(bottle ID, cache key): (descriptors, keypoints)}, empty if previous is
+              None, unpruned or pruned with other settings.
+    """
+    if previous is None or previous.pruning is None:
+        return {}
+    changed = [name for name, value in params.items() if previous.pruning.get(name) != value]
+    if changed:
+        print(f"  Pruning settings changed ({', '.join(changed)}); pruning every bottle again.")
+        return {}
+    selections = {}
+    for idx, key in enumerate(previous.keys):
+        if key is not None:
+            ref = previous[idx]
+            # Copy out of the map before it is replaced
+            selections[(previous.ids[idx], key)] = (np.array(ref['descriptors']), np.array(ref['keypoints']))
+    return selections
+
+def prune_references(references, max_descriptors=None, previous=None):
+    """
+    Prunes every reference's descriptors (see the module comment).
+
+    Args:
+        references (list): Dicts with 'descriptors' and 'keypoints' (one row per
+            descriptor, strongest keypoint first) as written to the feature store;
+            other keys are passed through.
+        max_descriptors (int): Per-bottle budget; defaults to PRUNE_MAX_DESCRIPTORS.
+        previous (FeatureStore): Store pruned by an earlier run. References with the same
+            ID and cache key keep the descriptors it kept for them, if it was pruned
+            with the same settings, so only new and changed bottles are pruned.
+
+    Returns:
+        tuple: (pruned references, stats dict: descriptor counts of the bottles pruned
+                now and removed by each step, and the bottles and descriptors reused)
+    """
+    max_descriptors = max_descriptors or config.PRUNE_MAX_DESCRIPTORS
+    stats = {'bottles': 0, 'before': 0, 'duplicates': 0, 'shared': 0, 'over_budget': 0, 'after': 0,
+             'reused': 0, 'reused_descriptors': 0}
+    reusable = reusable_selections(previous, pruning_params(max_descriptors))
+    pruned = [None] * len(references)
+    todo = []
+    for idx, ref in enumerate(references):
+        selection = reusable.get((normalize_id(ref['id']), ref.get('key'))) if ref.get('key') else None
+        if selection is None:
+            todo.append(idx)
+            continue
+        pruned[idx] = dict(ref, descriptors=selection[0], keypoints=selection[1])
+        stats['reused'] += 1
+        stats['reused_descriptors'] += len(selection[0])
+    if not todo:
+        return pruned, stats
+
+    # 1. Near-duplicates within each bottle
+    kept = []
+    for idx in todo:
+        descriptors = np.asarray(references[idx]['descriptors'])
+        keep = np.flatnonzero(~duplicate_mask(descriptors))
+        stats['bottles'] += 1
+        stats['before'] += len(descriptors)
+        stats['duplicates'] += len(descriptors) - len(keep)
+        kept.append(keep)
+
+    # 2. How many other bottles each remaining descriptor is shared with, in the whole catalogue
+    groups = image_groups(references)
+    catalogue = np.vstack([np.asarray(ref['descriptors']) for ref in references])
+    owner_ids = np.repeat(groups, [len(ref['descriptors']) for ref in references])
+    queries = np.vstack([np.asarray(references[idx]['descriptors'])[keep] for idx, keep in zip(todo, kept)])
+    query_owners = np.repeat(groups[todo], [len(keep) for keep in kept])
+    shared = shared_bottle_counts(queries, query_owners, catalogue, owner_ids)
+    offsets = np.concatenate([[0], np.cumsum([len(keep) for keep in kept])])
+
+    # 3. Drop widely shared descriptors, then keep the budget, least shared and strongest first
+    for position, (idx, keep) in enumerate(zip(todo, kept)):
+        ref = references[idx]
+        counts = shared[offsets[position]:offsets[position + 1]]
+        order = np.argsort(counts, kind='stable')
+        distinctive = int((counts < config.PRUNE_MAX_SHARED_BOTTLES).sum())
+        # Widely shared descriptors still make up a bottle's minimum if it has few others
+        n_kept = min(max(distinctive, config.PRUNE_MIN_DESCRIPTORS), len(order), max_descriptors)
+        stats['shared'] += max(len(order) - max(distinctive, n_kept), 0)
+        stats['over_budget'] += max(distinctive - n_kept, 0)
+        order = order[:n_kept]
+        rows = keep[np.sort(order)]  # Back in strongest-first order, for early termination
+        stats['after'] += len(rows)
+        pruned[idx] = dict(ref, descriptors=np.asarray(ref['descriptors'])[rows],
+                           keypoints=np.asarray(ref['keypoints'])[rows])
+    return pruned, stats
+
+def pruning_params(max_descriptors=None):
+    """Settings a pruned store was built with, recorded in its header."""
+    return {
+        'max_descriptors': max_descriptors or config.PRUNE_MAX_DESCRIPTORS,
+        'min_descriptors': config.PRUNE_MIN_DESCRIPTORS,
+        'duplicate_distance': config.PRUNE_DUPLICATE_DISTANCE,
+        'shared_distance': config.PRUNE_SHARED_DISTANCE,
+        'max_shared_bottles': config.PRUNE_MAX_SHARED_BOTTLES,
+        'neighbours': config.PRUNE_NEIGHBOURS,
+        'lsh': [config.PRUNE_LSH_TABLES, config.PRUNE_LSH_KEY_SIZE, config.PRUNE_LSH_PROBE_LEVEL],
+    }
+
+def print_stats(stats):
+    if stats['bottles']:
+        before = max(stats['before'], 1)
+        print(f"  Pruned {stats['bottles']} bottle(s) from {stats['before']} descriptors to {stats['after']} "
+              f"({stats['after'] / before:.0%}): {stats['duplicates']} near-duplicates, {stats['shared']} shared with "
+              f"{config.PRUNE_MAX_SHARED_BOTTLES}+ other bottles, {stats['over_budget']} over the per-bottle budget.")
+    if stats['reused']:
+        print(f"  Kept the earlier selection of {stats['reused']} unchanged bottle(s) "
+              f"({stats['reused_descriptors']} descriptors).")
+
+# --- Prune an existing catalogue: python src/descriptor_pruning.py [--output path] ---
+if __name__ == "__main__":
+    import argparse
+    from feature_store import open_feature_store, write_feature_store
+
+    parser = argparse.ArgumentParser(description="Prune the reference descriptors of the current feature store.")
+    parser.add_argument('--output', help="Write the pruned store here instead of replacing FEATURES_FILE")
+    args = parser.parse_args()
+
+    # Always start from unpruned features: data_preparation.py keeps them in RAW_FEATURES_FILE
+    source = config.RAW_FEATURES_FILE if os.path.exists(config.RAW_FEATURES_FILE) else config.FEATURES_FILE
+    store = open_feature_store(source)
+    if store.pruning is not None:
+        print(f"Error: '{source}' is already pruned and no unpruned features were found. Re-run data_preparation.py.")
+        sys.exit(1)
+    print(f"Pruning {len(store.descriptors)} descriptors of {len(store)} bottles from '{source}'...")
+    start = time.time()
+    references = [dict(store[idx], key=store.keys[idx], details=store.details_body(idx)) for idx in range(len(store))]
+    pruned, stats = prune_references(references)
+    print_stats(stats)
+
+    output = args.output or config.FEATURES_FILE
+    if output == config.FEATURES_FILE and source == config.FEATURES_FILE:
+        # Keep the unpruned features for future runs and incremental rebuilds
+        write_feature_store(config.RAW_FEATURES_FILE, references, store.pipeline)
+    build_id = write_feature_store(output, pruned, store.pipeline, pruning=dict(pruning_params(), **stats))
+    print(f"Pruned store written to '{output}' (build {build_id}) in {time.time() - start:.0f}s.")
+    if output == config.FEATURES_FILE:
+        import data_preparation
+        pruned_store = open_feature_store()
+        data_preparation.build_descriptor_index(pruned_store)
+        data_preparation.build_vocabulary(pruned_store)
@@ -0,0 +1,174 @@
+# src/details_store.py
+
+import os
+import sys
+import json
+import math
+import hashlib
+import threading
+
+# Import configuration variables
+try:
+    import config
+except ModuleNotFoundError:
+    print("Error: config.py not found. Make sure it's in the 'src' directory.")
+    sys.exit(1)
+
+from feature_store import normalize_id
+
+# Bottle details as served by /identify, prepared once from the Excel dataset by
+# data_preparation.py: embedded in the feature store (the catalogue snapshot) and also saved
+# as JSON for stores without them. Every bottle's record is held as serialized JSON bytes,
+# so answering a match is a dict lookup and a byte concatenation, and the web workers never
+# load pandas or parse the spreadsheet.
+FORMAT_VERSION = 1
+
+def _json_value(value):
+    """Converts a spreadsheet cell (NumPy scalar, NaN, ...) to a JSON-serialisable value."""
+    value = normalize_id(value)
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    if value is not None and not isinstance(value, (str, int, float, bool)):
+        return str(value)
+    return value
+
+def _source_stamp(path):
+    """Identifies a version of the Excel file, so stale details files can be detected."""
+    with open(path, 'rb') as f:
+        # By content rather than mtime, which a fresh checkout or deploy resets
+        return {'blake2b': hashlib.blake2b(f.read(), digest_size=16).hexdigest()}
+
+def record_body(record):
+    """Serializes a details dict as a JSON object body: UTF-8 bytes without the braces."""
+    return json.dumps(record, ensure_ascii=False, separators=(',', ':'), sort_keys=True)[1:-1].encode('utf-8')
+
+def read_excel_details(excel_path=None):
+    """Reads bottle details from the Excel dataset (see details_from_dataframe)."""
+    import pandas as pd  # Only needed when (re)building from the spreadsheet
+
+    return details_from_dataframe(pd.read_excel(excel_path or config.EXCEL_FILE_PATH))
+
+def details_from_dataframe(df):
+    """
+    Converts the dataset's rows to JSON-ready details.
+
+    Returns:
+        dict: {bottle ID: {column: value}} without the ID and image URL columns;
+              the first row wins for duplicate IDs.
+    """
+    if config.COL_ID not in df.columns:
+        raise ValueError(f"ID column '{config.COL_ID}' not found in Excel file.")
+    df = df.loc[~df[config.COL_ID].duplicated(keep='first') & df[config.COL_ID].notna()]
+    columns = [col for col in df.columns if col not in (config.COL_ID, config.COL_IMAGE_URL)]
+    return {
+        normalize_id(bottle_id): {col: _json_value(value) for col, value in zip(columns, row)}
+        for bottle_id, row in zip(df[config.COL_ID], df[columns].itertuples(index=False, name=None))
+    }
+
+def write_details_file(path=None, excel_path=None, details=None):
+    """
+    Converts the Excel dataset into the details file, written to a temporary
+    name and atomically renamed into place.
+
+    Args:
+        details (dict): Details already read from excel_path (see details_from_dataframe);
+            read from the file if not given.
+
+    Returns:
+        int: Number of bottles written.
+    """
+    path = path or config.DETAILS_FILE
+    excel_path = excel_path or config.EXCEL_FILE_PATH
+    if details is None:
+        details = read_excel_details(excel_path)
+    document = {
+        'format_version': FORMAT_VERSION,
+        'source': _source_stamp(excel_path),
+        'ids': list(details),
+        'details': [details[bottle_id] for bottle_id in details],
+    }
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(document, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+    return len(details)
+
+class DetailsStore:
+    """
+    Bottle details keyed by ID, each kept as the serialized JSON object without
+    its braces (see record_body), ready to be spliced into a response.
+    """
+
+    def __init__(self, bodies, source=None):
+        self._bodies = bodies  # str(bottle ID) -> JSON body bytes
+        self.source = source
+        self._lock = threading.Lock()
+        self.counters = {'found': 0, 'missing': 0}
+
+    @classmethod
+    def load(cls, path=None):
+        """Reads the JSON details file written by write_details_file."""
+        with open(path or config.DETAILS_FILE, 'r', encoding='utf-8') as f:
+            document = json.load(f)
+        if document.get('format_version') != FORMAT_VERSION:
+            raise ValueError(f"Details file has format version {document.get('format_version')}, expected {FORMAT_VERSION}")
+        bodies = {str(bottle_id): record_body(record) for bottle_id, record in zip(document['ids'], document['details'])}
+        return cls(bodies, document.get('source'))
+
+    @classmethod
+    def from_feature_store(cls, store):
+        """Takes the details embedded in a feature store (catalogue snapshot), or returns None."""
+        if not store.has_details:
+            return None
+        return cls({str(bottle_id): store.details_body(idx) for idx, bottle_id in enumerate(store.ids)},
+                   {'feature_store': store.build_id})
+
+    def __len__(self):
+        return len(self._bodies)
+
+    def _lookup(self, bottle_id):
+        body = self._bodies.get(str(bottle_id))
+        with self._lock:
+            self.counters['found' if body is not None else 'missing'] += 1
+        return body
+
+    def get(self, bottle_id):
+        """Returns a new details dict for a bottle, or None."""
+        body = self._lookup(bottle_id)
+        return json.loads(b'{' + body + b'}') if body is not None else None
+
+    def json_bytes(self, bottle_id, extra=None):
+        """
+        Returns the bottle's details as a JSON object (bytes), with the fields of
+        `extra` appended, or None for an unknown bottle.
+        """
+        body = self._lookup(bottle_id)
+        if body is None:
+            return None
+        if extra:
+            extra_body = json.dumps(extra, separators=(',', ':'))[1:-1].encode('utf-8')
+            body = body + b',' + extra_body if body else extra_body
+        return b'{' + body + b'}'
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+        stats['bottles'] = len(self)
+        return stats
+
+def open_details_store(path=None, excel_path=None):
+    """
+    Opens the details file, first (re)building it from the Excel dataset when
+    it is missing or was built from a different version of the spreadsheet.
+    Without the spreadsheet an existing details file is used as is.
+    """
+    path = path or config.DETAILS_FILE
+    excel_path = excel_path or config.EXCEL_FILE_PATH
+    store = DetailsStore.load(path) if os.path.exists(path) else None
+    if os.path.exists(excel_path) and (store is None or store.source != _source_stamp(excel_path)):
+        print(f"Building bottle details file '{path}' from '{excel_path}'...")
+        write_details_file(path, excel_path)
+        store = DetailsStore.load(path)
+    if store is None:
+        raise FileNotFoundError(f"Neither the details file '{path}' nor the Excel file '{excel_path}' exists.")
+    return store
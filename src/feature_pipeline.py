@@ -0,0 +1,133 @@
+# src/feature_pipeline.py
+
+import sys
+import time
+import threading
+import numpy as np
+import cv2
+
+# Import configuration variables
+try:
+    import config
+except ModuleNotFoundError:
+    print("Error: config.py not found. Make sure it's in the 'src' directory.")
+    sys.exit(1)
+
+# The one feature-extraction pipeline used for both reference images (data_preparation.py)
+# and queries (identification.py). Its parameters are stamped into the feature store, and
+# identification refuses a store built with a different pipeline, so resolution or ORB
+# settings can't drift between indexing and querying without a rebuild.
+PIPELINE_VERSION = 2  # Bump whenever preprocess() or extract() change behaviour (2: longest-side resize)
+QUERY_TUNABLE_PARAMS = ('n_features',)  # May differ between the store and queries
+# Stamped on features converted from the legacy pickle (see feature_store.py), which were
+# extracted with default ORB settings and no resize or CLAHE: matches no current pipeline
+LEGACY_PIPELINE = {'version': 0}
+
+def pipeline_params(n_features=None):
+    """
+    Every setting that affects the descriptors an image produces.
+
+    Args:
+        n_features (int): ORB feature budget; defaults to N_FEATURES_ORB (the indexing budget).
+    """
+    return {
+        'version': PIPELINE_VERSION,
+        'max_image_size': config.MAX_IMAGE_SIZE,
+        'clahe_clip_limit': config.CLAHE_CLIP_LIMIT,
+        'clahe_tile_grid': config.CLAHE_TILE_GRID,
+        'n_features': n_features or config.N_FEATURES_ORB,
+        'scale_factor': config.SCALE_FACTOR,
+        'n_levels': config.N_LEVELS,
+        'edge_threshold': config.EDGE_THRESHOLD,
+        'first_level': config.FIRST_LEVEL,
+        'wta_k': config.WTA_K,
+        'patch_size': config.PATCH_SIZE,
+        'fast_threshold': config.FAST_THRESHOLD,
+    }
+
+def param_mismatches(stored_params, current_params=None):
+    """
+    Compares the pipeline a feature store was built with against the current one.
+
+    Returns:
+        list: (name, stored value, current value) for every differing parameter,
+              ignoring QUERY_TUNABLE_PARAMS. Empty if the two are compatible.
+    """
+    current_params = current_params or pipeline_params()
+    stored_params = stored_params or {}
+    return [
+        (name, stored_params.get(name), value)
+        for name, value in current_params.items()
+        if name not in QUERY_TUNABLE_PARAMS and stored_params.get(name) != value
+    ]
+
+def create_detector(n_features=None):
+    """Creates the ORB detector described by pipeline_params()."""
+    return cv2.ORB_create(
+        nfeatures=n_features or config.N_FEATURES_ORB,
+        scaleFactor=config.SCALE_FACTOR,
+        nlevels=config.N_LEVELS,
+        edgeThreshold=config.EDGE_THRESHOLD,
+        firstLevel=config.FIRST_LEVEL,
+        WTA_K=config.WTA_K,
+        patchSize=config.PATCH_SIZE,
+        fastThreshold=config.FAST_THRESHOLD
+    )
+
+# cv2.CLAHE objects keep internal buffers, so each thread gets its own, created once
+_thread_local = threading.local()
+
+def _clahe():
+    settings = (config.CLAHE_CLIP_LIMIT, config.CLAHE_TILE_GRID)
+    if getattr(_thread_local, 'clahe_settings', None) != settings:
+        _thread_local.clahe = cv2.createCLAHE(clipLimit=settings[0], tileGridSize=(settings[1], settings[1]))
+        _thread_local.clahe_settings = settings
+    return _thread_local.clahe
+
+def resize_to_limit(image, max_size=None):
+    """Scales an image down (never up) so its longest side is at most max_size (default MAX_IMAGE_SIZE)."""
+    max_size = max_size or config.MAX_IMAGE_SIZE
+    height, width = image.shape[:2]
+    if max(height, width) <= max_size:
+        return image
+    scale = max_size / max(height, width)
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+def preprocess(image, max_size=None):
+    """
+    Preprocess a grayscale image for better feature detection.
+    """
+    # Bound the longest side, so tall bottle photos are limited too
+    image = resize_to_limit(image, max_size)
+
+    # Apply CLAHE for better contrast
+    return _clahe().apply(image)
+
+def extract(image, detector, timings=None, max_size=None):
+    """
+    Runs the full pipeline on a decoded image (grayscale or BGR).
+
+    Args:
+        timings (dict): If given, receives 'preprocess' and 'detect' durations in ms.
+        max_size (int): Longest side to resize to, instead of MAX_IMAGE_SIZE (e.g. for
+            shelf photos, where every bottle covers only part of the image).
+
+    Returns:
+        tuple: (keypoint x/y coordinates (n, 2) float32, descriptors (n, 32) uint8),
+               strongest keypoint response first, or (None, None) if nothing was found.
+    """
+    start = time.perf_counter()
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    image = preprocess(image, max_size)
+    preprocessed = time.perf_counter()
+    keypoints, descriptors = detector.detectAndCompute(image, None)
+    if timings is not None:
+        timings['preprocess'] = round(1000 * (preprocessed - start), 2)
+        timings['detect'] = round(1000 * (time.perf_counter() - preprocessed), 2)
+    if descriptors is None:
+        return None, None
+    order = np.argsort([-kp.response for kp in keypoints], kind='stable')
+    points = np.array([kp.pt for kp in keypoints], dtype=np.float32).reshape(-1, 2)
+    return points[order], descriptors[order]
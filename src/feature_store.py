@@ -0,0 +1,223 @@
+# src/feature_store.py
+
+import os
+import sys
+import json
+import uuid
+import time
+import numpy as np
+
+# Import configuration variables
+try:
+    import config
+except ModuleNotFoundError:
+    print("Error: config.py not found. Make sure it's in the 'src' directory.")
+    sys.exit(1)
+
+from feature_pipeline import pipeline_params
+
+# --- On-disk layout ---
+# [0:8]    MAGIC
+# [8:12]   uint32 little-endian length of the JSON header
+# [12:...] JSON header: format version, build ID, feature pipeline parameters, bottle IDs/names and
+#          the byte offset, dtype and shape of every array section (plus, for a shard of a split
+#          catalogue, which one it is, and for pruned descriptors, how they were pruned)
+# Sections: descriptors (n, 32) uint8, keypoints (n, 2) float32 x/y image coordinates of
+#           each descriptor (NaN when unknown), offsets (bottles + 1) and owner_ids (n)
+#           Optional: details (UTF-8 JSON bodies of every bottle's details, concatenated) and
+#           details_offsets (bottles + 1), making the file a complete catalogue snapshot
+# Each array section starts on a SECTION_ALIGNMENT boundary and is opened with np.memmap,
+# so all gunicorn workers share the same page-cache pages instead of private copies.
+MAGIC = b'WGFSTORE'
+FORMAT_VERSION = 2  # 2: keypoint coordinates stored for geometric verification
+SECTION_ALIGNMENT = 64
+
+def normalize_id(bottle_id):
+    """Converts NumPy scalar IDs (as read by pandas) to plain JSON-serialisable Python values."""
+    return bottle_id.item() if hasattr(bottle_id, 'item') else bottle_id
+
+def _aligned(position):
+    return (position + SECTION_ALIGNMENT - 1) // SECTION_ALIGNMENT * SECTION_ALIGNMENT
+
+def write_feature_store(path, references, pipeline=None, shard=None, pruning=None):
+    """
+    Writes reference features to a versioned store file. The file is written
+    next to its destination and atomically renamed into place, so readers
+    never see a half-written store.
+
+    Args:
+        path (str): Destination file.
+        references (list): Dicts with 'id', 'name' and 'descriptors' (uint8 array), and
+            optionally 'keypoints' ((n, 2) x/y coordinates, one row per descriptor),
+            'key', the extraction cache key used for incremental rebuilds, and 'details',
+            the bottle's details as a serialized JSON body (see details_store.record_body).
+        pipeline (dict): Feature pipeline parameters; defaults to the current config
+            (see feature_pipeline.pipeline_params).
+        shard (dict): For one shard of a split catalogue, its 'index', 'count' and the
+            'catalogue_build_id' of the store it was split from (see sharding.py).
+        pruning (dict): For pruned descriptors, the settings and counts of the pruning
+            (see descriptor_pruning.py).
+
+    Returns:
+        str: The build ID of the written store.
+    """
+    references = [ref for ref in references if ref['descriptors'] is not None and len(ref['descriptors']) > 0]
+    counts = np.array([len(ref['descriptors']) for ref in references], dtype=np.int64)
+    descriptor_size = references[0]['descriptors'].shape[1] if references else 32
+
+    arrays = {
+        'offsets': np.concatenate([[0], np.cumsum(counts)]).astype(np.int64),
+        'owner_ids': np.repeat(np.arange(len(references), dtype=np.int32), counts),
+    }
+    if any(ref.get('details') is not None for ref in references):
+        bodies = [ref.get('details') or b'' for ref in references]
+        arrays['details'] = np.frombuffer(b''.join(bodies), dtype=np.uint8)
+        arrays['details_offsets'] = np.concatenate([[0], np.cumsum([len(body) for body in bodies])]).astype(np.int64)
+    sections = {}
+    header = {
+        'format_version': FORMAT_VERSION,
+        'build_id': uuid.uuid4().hex,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'pipeline': pipeline or pipeline_params(),
+        'ids': [normalize_id(ref['id']) for ref in references],
+        'names': [None if ref.get('name') is None else str(ref.get('name')) for ref in references],
+        'keys': [ref.get('key') for ref in references],
+        'shard': shard,
+        'pruning': pruning,
+        'sections': sections,
+    }
+
+    # Section offsets depend on the header length, which depends on the offsets; reserve
+    # room by laying sections out after a generously padded header.
+    layout = [
+        ('descriptors', np.dtype(np.uint8), (int(counts.sum()), descriptor_size)),
+        ('keypoints', np.dtype(np.float32), (int(counts.sum()), 2)),
+    ]
+    layout += [(name, array.dtype, array.shape) for name, array in arrays.items()]
+    header_bytes = b''
+    position = 0
+    for _ in range(3):
+        position = _aligned(len(MAGIC) + 4 + len(header_bytes) + SECTION_ALIGNMENT)
+        for name, dtype, shape in layout:
+            sections[name] = {'offset': position, 'dtype': dtype.str, 'shape': list(shape)}
+            position = _aligned(position + int(np.prod(shape)) * dtype.itemsize)
+        header_bytes = json.dumps(header).encode('utf-8')
+    if len(MAGIC) + 4 + len(header_bytes) > sections['descriptors']['offset']:
+        raise ValueError("Feature store header overflowed its reserved space")
+
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(len(header_bytes).to_bytes(4, 'little'))
+        f.write(header_bytes)
+        f.seek(sections['descriptors']['offset'])
+        for ref in references:
+            f.write(np.ascontiguousarray(ref['descriptors'], dtype=np.uint8).tobytes())
+        f.seek(sections['keypoints']['offset'])
+        for ref, count in zip(references, counts):
+            keypoints = ref.get('keypoints')
+            if keypoints is None or len(keypoints) != count:
+                keypoints = np.full((count, 2), np.nan)
+            f.write(np.ascontiguousarray(keypoints, dtype=np.float32).tobytes())
+        for name, array in arrays.items():
+            f.seek(sections[name]['offset'])
+            f.write(np.ascontiguousarray(array).tobytes())
+        f.truncate(position)
+    os.replace(tmp_path, path)
+    return header['build_id']
+
+class FeatureStore:
+    """
+    Read-only view of a feature store file. Array sections are memory-mapped,
+    so opening costs the same regardless of catalogue size.
+
+    Indexable like the legacy list of reference dicts: store[i] returns
+    {'id', 'name', 'descriptors', 'keypoints'} where the arrays are views into the map.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"'{path}' is not a feature store file")
+            header_length = int.from_bytes(f.read(4), 'little')
+            self.header = json.loads(f.read(header_length).decode('utf-8'))
+
+        if self.header.get('format_version') != FORMAT_VERSION:
+            raise ValueError(
+                f"Feature store '{path}' has format version {self.header.get('format_version')}, "
+                f"expected {FORMAT_VERSION}. Re-run data_preparation.py."
+            )
+
+        self.build_id = self.header['build_id']
+        self.pipeline = self.header.get('pipeline')  # None for stores written before the shared pipeline
+        self.ids = self.header['ids']
+        self.names = self.header['names']
+        self.keys = self.header.get('keys') or [None] * len(self.ids)
+        self.shard = self.header.get('shard')  # None unless this is one shard of a split catalogue
+        self.pruning = self.header.get('pruning')  # None unless descriptors were pruned
+        self.descriptors = self._map('descriptors')
+        self.keypoints = self._map('keypoints')
+        self.offsets = self._map('offsets')
+        self.owner_ids = self._map('owner_ids')
+        self.has_details = 'details' in self.header['sections']
+        if self.has_details:
+            self.details = self._map('details')
+            self.details_offsets = self._map('details_offsets')
+
+    def _map(self, name):
+        section = self.header['sections'][name]
+        shape = tuple(section['shape'])
+        if 0 in shape:
+            return np.zeros(shape, dtype=np.dtype(section['dtype']))
+        return np.memmap(self.path, dtype=np.dtype(section['dtype']), mode='r',
+                         offset=section['offset'], shape=shape)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def details_body(self, idx):
+        """The bottle's details as a serialized JSON body (bytes), or None if the store has none."""
+        if not self.has_details:
+            return None
+        return bytes(self.details[self.details_offsets[idx]:self.details_offsets[idx + 1]])
+
+    def __getitem__(self, idx):
+        return {
+            'id': self.ids[idx],
+            'name': self.names[idx],
+            'descriptors': self.descriptors[self.offsets[idx]:self.offsets[idx + 1]],
+            'keypoints': self.keypoints[self.offsets[idx]:self.offsets[idx + 1]],
+        }
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+def open_feature_store(path=None):
+    """Opens the feature store written by data_preparation.py."""
+    return FeatureStore(path or config.FEATURES_FILE)
+
+# --- Convert a legacy pickle: python src/feature_store.py <bottle_features.pkl> ---
+if __name__ == "__main__":
+    import pickle
+    import argparse
+    from feature_pipeline import LEGACY_PIPELINE
+
+    parser = argparse.ArgumentParser(description="Convert a legacy pickled feature file to a feature store.")
+    parser.add_argument('legacy_file', help="Pickled list of reference features (e.g. bottle_features.pkl)")
+    parser.add_argument('--assume-current-pipeline', action='store_true',
+                        help="The features were extracted with the current config's pipeline; stamp its "
+                             "parameters instead of marking them legacy")
+    args = parser.parse_args()
+
+    with open(args.legacy_file, 'rb') as f:
+        legacy_features = pickle.load(f)
+    # Legacy features came from default ORB settings without resize or CLAHE. Stamped as such,
+    # identification refuses the store until data_preparation.py rebuilds it.
+    pipeline = pipeline_params() if args.assume_current_pipeline else LEGACY_PIPELINE
+    build_id = write_feature_store(config.FEATURES_FILE, legacy_features, pipeline)
+    print(f"Converted {len(legacy_features)} references to '{config.FEATURES_FILE}' (build {build_id}).")
+    if not args.assume_current_pipeline:
+        print("Note: Marked as extracted by the legacy pipeline; queries are refused until "
+              "data_preparation.py rebuilds the store with the current settings.")
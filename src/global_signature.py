@@ -0,0 +1,193 @@
+# src/global_signature.py
+
+import os
+import sys
+import time
+import numpy as np
+import cv2
+
+# Import configuration variables
+try:
+    import config
+except ModuleNotFoundError:
+    print("Error: config.py not found. Make sure it's in the 'src' directory.")
+    sys.exit(1)
+
+class VisualVocabulary:
+    """
+    Bag-of-visual-words model over ORB descriptors. Each reference bottle is
+    summarised by one L2-normalised TF-IDF vector, so a query can be compared
+    with the whole catalogue in a single matrix product.
+    """
+
+    def __init__(self, words, idf, signatures, ids, build_id=None):
+        self.words = words            # (vocabulary_size, 32) uint8 binary cluster centres
+        self.idf = idf                # (vocabulary_size,) float32 inverse document frequency
+        self.signatures = signatures  # (n_references, vocabulary_size) float32, rows L2-normalised
+        self.ids = ids                # Bottle ID for each signature row
+        self.build_id = build_id      # Build ID of the feature store the signatures describe, if known
+        self.matcher = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=False)
+
+    @classmethod
+    def train(cls, features, vocabulary_size=None, sample_size=None, seed=0):
+        """
+        Clusters a sample of the reference descriptors with MiniBatchKMeans and
+        builds a signature for every reference bottle.
+        """
+        from sklearn.cluster import MiniBatchKMeans
+
+        vocabulary_size = vocabulary_size or config.VOCABULARY_SIZE
+        sample_size = sample_size or config.VOCABULARY_TRAINING_SAMPLE
+        all_descriptors = np.vstack([ref['descriptors'] for ref in features if ref['descriptors'] is not None])
+        rng = np.random.default_rng(seed)
+        sample = all_descriptors[rng.choice(len(all_descriptors), min(sample_size, len(all_descriptors)), replace=False)]
+
+        # Cluster in bit space, then binarise the centres so assignment is a Hamming search
+        kmeans = MiniBatchKMeans(n_clusters=vocabulary_size, random_state=seed, batch_size=4096, n_init=3)
+        kmeans.fit(np.unpackbits(sample, axis=1).astype(np.float32))
+        words = np.packbits(kmeans.cluster_centers_ > 0.5, axis=1)
+        return cls.from_words(words, features)
+
+    @classmethod
+    def from_words(cls, words, features):
+        """
+        Builds IDF weights and per-bottle signatures for an existing set of visual words.
+        """
+        vocabulary = cls(words, np.ones(len(words), dtype=np.float32), None, [ref['id'] for ref in features],
+                         getattr(features, 'build_id', None))
+        counts = np.vstack([vocabulary._word_counts(ref['descriptors']) for ref in features])
+        document_frequency = (counts > 0).sum(axis=0)
+        vocabulary.idf = np.log(len(features) / (1.0 + document_frequency)).clip(min=0).astype(np.float32)
+        vocabulary.signatures = vocabulary._normalise(counts * vocabulary.idf)
+        return vocabulary
+
+    def _word_counts(self, descriptors):
+        counts = np.zeros(len(self.words), dtype=np.float32)
+        if descriptors is None or len(descriptors) == 0:
+            return counts
+        assignments = [m.trainIdx for m in self.matcher.match(descriptors, self.words)]
+        return np.bincount(assignments, minlength=len(self.words)).astype(np.float32)
+
+    @staticmethod
+    def _normalise(vectors):
+        # Square-root (power) normalisation damps bursty words such as repeated label text
+        vectors = np.sqrt(vectors)
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        return (vectors / np.maximum(norms, 1e-12)).astype(np.float32)
+
+    def describe(self, descriptors):
+        """Returns the normalised signature vector for a query's descriptors."""
+        return self._normalise(self._word_counts(descriptors) * self.idf)
+
+    def shortlist(self, descriptors, k):
+        """
+        Returns the row indices of the k references most similar to the query
+        (by cosine similarity), best first, and their similarity scores.
+        """
+        scores = self.signatures @ self.describe(descriptors)
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return top, scores[top]
+
+    def matches_features(self, features):
+        """
+        True if this vocabulary's signatures were built from exactly these references:
+        the same feature store build, where the features come from a store.
+        """
+        build_id = getattr(features, 'build_id', None)
+        if build_id is not None and self.build_id != build_id:
+            return False
+        return list(self.ids) == list(getattr(features, 'ids', None) or [ref['id'] for ref in features])
+
+    def save(self, path):
+        tmp_path = f"{path}.tmp-{os.getpid()}"
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, words=self.words, idf=self.idf, signatures=self.signatures, ids=np.asarray(self.ids),
+                     build_id=str(self.build_id or ''))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            build_id = str(data['build_id']) if 'build_id' in data.files else ''
+            return cls(data['words'], data['idf'], data['signatures'], data['ids'].tolist(), build_id or None)
+
+def load_vocabulary(features, path=None):
+    """
+    Loads the vocabulary written by data_preparation.py. Returns None (full
+    scan) if it is missing or was built from a different reference set.
+    """
+    path = path or config.VOCABULARY_FILE
+    if not os.path.exists(path):
+        print(f"Warning: Vocabulary file '{path}' not found. Shortlisting disabled.")
+        return None
+    try:
+        vocabulary = VisualVocabulary.load(path)
+    except Exception as e:
+        print(f"Warning: Could not load vocabulary '{path}' ({e}). Shortlisting disabled.")
+        return None
+    if not vocabulary.matches_features(features):
+        print(f"Warning: Vocabulary '{path}' is out of date with the feature file. Shortlisting disabled.")
+        return None
+    print(f"Loaded visual vocabulary ({len(vocabulary.words)} words) from '{path}'.")
+    return vocabulary
+
+def measure_shortlist_recall(vocabulary, queries, ks):
+    """
+    Args:
+        queries (list): (true_bottle_id, query_descriptors) pairs.
+        ks (list): Shortlist sizes to evaluate.
+
+    Returns:
+        dict: Recall@k for each k, plus mean shortlisting latency in ms.
+    """
+    hits = {k: 0 for k in ks}
+    elapsed = 0.0
+    for true_id, descriptors in queries:
+        start = time.perf_counter()
+        top, _ = vocabulary.shortlist(descriptors, max(ks))
+        elapsed += time.perf_counter() - start
+        ranked_ids = [vocabulary.ids[i] for i in top]
+        for k in ks:
+            hits[k] += true_id in ranked_ids[:k]
+
+    n_queries = max(len(queries), 1)
+    result = {f"recall@{k}": hits[k] / n_queries for k in ks}
+    result['shortlist_ms'] = 1000 * elapsed / n_queries
+    return result
+
+# --- Shortlist recall benchmark: python src/global_signature.py [num_query_images] ---
+if __name__ == "__main__":
+    import random
+    import feature_pipeline
+    from feature_store import open_feature_store
+
+    num_queries = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    features = list(open_feature_store())
+    vocabulary = load_vocabulary(features)
+    if vocabulary is None:
+        sys.exit(1)
+
+    image_files = {os.path.splitext(name)[0]: name for name in os.listdir(config.IMAGE_DOWNLOAD_DIR)}
+    detector = feature_pipeline.create_detector(config.N_FEATURES_QUERY)
+    queries = []
+    for ref in random.Random(0).sample(features, min(num_queries, len(features))):
+        if str(ref['id']) not in image_files:
+            continue
+        img = cv2.imread(os.path.join(config.IMAGE_DOWNLOAD_DIR, image_files[str(ref['id'])]), cv2.IMREAD_GRAYSCALE)
+        if img is None:
+            continue
+        # Mild rotation and scale change so queries are not bit-identical to the references
+        h, w = img.shape
+        img = cv2.warpAffine(img, cv2.getRotationMatrix2D((w / 2, h / 2), 10, 0.8), (w, h))
+        _, des = feature_pipeline.extract(img, detector)
+        if des is not None:
+            queries.append((ref['id'], des))
+
+    ks = sorted({1, 5, 10, config.SHORTLIST_SIZE, 50})
+    result = measure_shortlist_recall(vocabulary, queries, ks)
+    print(f"Shortlist recall over {len(queries)} perturbed reference images:")
+    for k in ks:
+        print(f"  Recall@{k}: {result[f'recall@{k}']:.3f}")
+    print(f"  Mean shortlist time: {result['shortlist_ms']:.2f} ms")
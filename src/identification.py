@@ -2,13 +2,11 @@
 
 import cv2
 import numpy as np
-import pickle
 import os
 import sys
-import pandas as pd # Import pandas
-from concurrent.futures import ThreadPoolExecutor
-from functools import lru_cache
-import imutils
+import time
+import threading
+import multiprocessing
 
 # Import configuration variables
 try:
@@ -17,124 +15,456 @@ except ModuleNotFoundError:
     print("Error: config.py not found. Make sure it's in the 'src' directory.")
     sys.exit(1) # Exit if config is missing, as it's crucial
 
+import feature_pipeline
+from catalogue import load_catalogue, file_signature
+from matching_engine import (create_engine, register_store, count_good_matches, count_inliers, knn_sharded,
+                             StoreReplacedError)
+from result_cache import ResultCache, content_key, perceptual_signature
+from sharding import ShardClient, ShardUnavailableError
+
 # --- Global Variables ---
 orb = None
-bf = None
-reference_features = []
-bottle_details_df = pd.DataFrame() # Global DataFrame to hold all bottle details
-executor = ThreadPoolExecutor(max_workers=4)  # For parallel processing
+catalogue = None                 # Current Catalogue: feature store, index, vocabulary, details (see catalogue.py)
+engine = None                    # Runs matching tasks within the CPU budget (see matching_engine.py)
+result_cache = ResultCache()     # Results of recent uploads, keyed by content and perceptual hash
+shard_client = None              # Sends queries to the shard servers when SHARD_ADDRESSES is set (see sharding.py)
+
+# --- Catalogue reload (read-copy-update) ---
+# A request reads the `catalogue` global once and passes that object down, so it finishes
+# on the version it started with. A reload builds the new Catalogue completely on the side
+# and then replaces the global in one assignment; the old one is freed when the last
+# request using it returns.
+_reload_lock = threading.Lock()
+_watched_signature = None        # Files the current catalogue was loaded from (see _source_files_signature)
+_watcher = None
+
+def current_catalogue():
+    """The catalogue new requests should use (None before a successful initialization)."""
+    return catalogue
 
-def preprocess_image(image):
+SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+REDUCED_DECODE_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_GRAYSCALE_8),
+    (4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+    (2, cv2.IMREAD_REDUCED_GRAYSCALE_2),
+)
+
+def can_stop_early(votes, processed=0, remaining=0, unvisited=0):
     """
-    Preprocess image for better feature detection.
+    Early-termination test on partial good-match counts, by EARLY_TERMINATION mode.
+
+    'bound' stops only once no other reference can catch up, whatever the matching not
+    done yet finds: each query descriptor not matched yet passes the ratio test for at
+    most one reference, and a reference not matched yet gets at most one vote per query
+    descriptor and per descriptor of its own. The result is the same as matching
+    everything, but a query's votes seldom allow stopping before the end.
+
+    'projected' is a heuristic: the runner-up is projected to keep collecting votes over
+    the remaining query descriptors at its (smoothed) rate so far, and references not
+    matched yet are expected to score below those before them (shortlist order). It can
+    stop on a leader that the rest would have overturned.
+
+    Args:
+        votes (np.ndarray): Good-match count per reference so far.
+        processed (int): Query descriptors already matched (stepping over query descriptors).
+        remaining (int): Query descriptors not matched yet (stepping over query descriptors).
+        unvisited (int): Most votes any reference not matched yet can reach (stepping over references).
+
+    Returns:
+        bool: True if the leader has MIN_MATCH_COUNT matches and is at least
+              EARLY_TERMINATION_MARGIN ahead of the best score expected of any other reference.
     """
-    # Resize image to a reasonable size while maintaining aspect ratio
-    if max(image.shape) > 1024:
-        image = imutils.resize(image, width=1024)
-    
-    # Apply CLAHE for better contrast
-    clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
-    return clahe.apply(image)
+    if len(votes) == 0:
+        return False
+    top = np.sort(votes)[-2:]
+    lead = int(top[-1])
+    second = int(top[0]) if len(top) > 1 else 0
+    if config.EARLY_TERMINATION == 'bound':
+        best_other = max(second + remaining, unvisited)
+    else:
+        best_other = second + remaining * (second + 1) / max(processed, 1)
+    return lead >= config.MIN_MATCH_COUNT and lead - best_other >= config.EARLY_TERMINATION_MARGIN
 
-@lru_cache(maxsize=100)
-def get_bottle_details_cached(bottle_id):
+def match_stacked(catalogue, des_query):
     """
-    Cached version of get_bottle_details for faster repeated lookups.
+    Matches the query against all references with k-NN passes over
+    catalogue.index and counts ratio-test survivors per bottle.
+
+    With EARLY_TERMINATION the query descriptors are matched
+    EARLY_TERMINATION_CHUNK at a time (extract_query_features orders them
+    strongest keypoint first) until can_stop_early().
+
+    Returns:
+        tuple: (good-match count for each reference of the catalogue,
+                number of query descriptors actually matched)
     """
-    try:
-        details = bottle_details_df.loc[bottle_id]
-        if config.COL_IMAGE_URL in details.index:
-            details = details.drop(config.COL_IMAGE_URL)
-        return details
-    except (KeyError, Exception) as e:
-        print(f"Error retrieving details for bottle ID '{bottle_id}': {e}")
-        return None
+    if not config.EARLY_TERMINATION:
+        return match_stacked_batch(catalogue, [des_query])[0], len(des_query)
+
+    votes = np.zeros(len(catalogue), dtype=np.int64)
+    processed = 0
+    while processed < len(des_query):
+        chunk = des_query[processed:processed + config.EARLY_TERMINATION_CHUNK]
+        votes += match_stacked_batch(catalogue, [chunk])[0]
+        processed += len(chunk)
+        if can_stop_early(votes, processed, len(des_query) - processed):
+            break
+    return votes, processed
+
+def match_references_in_order(catalogue, des_query, order, early_exit=True):
+    """
+    Ratio-test matches the query against references one by one, in priority
+    order, one engine task per reference and engine.workers at a time. With
+    EARLY_TERMINATION (and early_exit), stops once can_stop_early() after a step.
+
+    Args:
+        des_query (np.ndarray): Query descriptors.
+        order (sequence): Indexes into the catalogue's references, most promising first.
+        early_exit (bool): False when the order carries no ranking information.
 
-def process_reference_match(args):
+    Returns:
+        np.ndarray: Good-match count for each reference (0 if not visited).
     """
-    Process a single reference match (for parallel processing).
+    store = catalogue.features
+    votes = np.zeros(len(catalogue), dtype=np.int64)
+    early_exit = early_exit and config.EARLY_TERMINATION
+    step = engine.workers if early_exit else max(len(order), 1)
+    order = np.asarray(order, dtype=np.int64)
+    # Most votes each reference can get: one per query descriptor and per reference descriptor
+    reachable = np.minimum(np.diff(store.offsets)[order], len(des_query))
+    for start in range(0, len(order), step):
+        wave = [int(idx) for idx in order[start:start + step]]
+        tasks = [(store.path, store.build_id, idx, [des_query]) for idx in wave]
+        for idx, counts in zip(wave, engine.map(count_good_matches, tasks)):
+            votes[idx] = counts[0]
+        unvisited = int(reachable[start + step:].max()) if start + step < len(order) else 0
+        if early_exit and can_stop_early(votes, unvisited=unvisited):
+            break
+    return votes
+
+def descriptor_owners(catalogue, des_query):
     """
-    des_query, ref = args
-    ref_id = ref['id']
-    des_ref = ref['descriptors']
+    Finds the reference each query descriptor votes for: the owner of its nearest
+    neighbour in catalogue.index, if it passes the ratio test.
 
-    if des_ref is None or len(des_ref) < 2:
-        return None
+    Returns:
+        np.ndarray: Reference index for each descriptor, -1 where the ratio test fails.
+    """
+    owners = np.full(len(des_query), -1, dtype=np.int64)
+    if len(catalogue.descriptors) < 2 or not len(des_query):
+        return owners
+    if catalogue.index.kind == 'brute':
+        # Exact search splits into row blocks, which the engine runs in parallel
+        rows, distances = knn_sharded(engine, catalogue.features, des_query)
+    else:
+        rows, distances = catalogue.index.knn(des_query, 2)
+    good = (rows[:, 1] >= 0) & (distances[:, 0] < config.MATCHER_THRESHOLD * distances[:, 1])
+    owners[good] = catalogue.owner_ids[rows[good, 0]]
+    return owners
 
-    try:
-        matches = bf.knnMatch(des_query, des_ref, k=2)
-        good_matches = []
-        for match_pair in matches:
-            if len(match_pair) == 2:
-                m, n = match_pair
-                if m.distance < config.MATCHER_THRESHOLD * n.distance:
-                    good_matches.append(m)
-
-        if len(good_matches) >= config.MIN_MATCH_COUNT:
-            return {
-                'id': ref_id,
-                'match_count': len(good_matches)
-            }
-    except cv2.error:
-        pass
-    return None
+def match_stacked_batch(catalogue, des_queries):
+    """
+    Matches several queries in one k-NN pass: their descriptors are stacked so the
+    reference matrix is traversed once for the whole batch.
+
+    Returns:
+        np.ndarray: (n_queries, n_references) good-match counts.
+    """
+    n_refs = len(catalogue)
+    if not des_queries:
+        return np.zeros((0, n_refs), dtype=np.int64)
+    owners = descriptor_owners(catalogue, np.vstack(des_queries))
+    query_of_row = np.repeat(np.arange(len(des_queries)), [len(des) for des in des_queries])
+    good = owners >= 0
+    cells = query_of_row[good] * n_refs + owners[good]
+    return np.bincount(cells, minlength=len(des_queries) * n_refs).reshape(len(des_queries), n_refs)
+
+def match_shortlist_batch(catalogue, des_queries):
+    """
+    Shortlists candidates for every query, then matches each shortlisted
+    reference once against the stacked descriptors of all queries that picked
+    it, applying the ratio test per query.
+
+    Returns:
+        np.ndarray: (n_queries, n_references) good-match counts.
+    """
+    store = catalogue.features
+    votes = np.zeros((len(des_queries), len(catalogue)), dtype=np.int64)
+    queries_by_reference = {}
+    for query_idx, des_query in enumerate(des_queries):
+        candidates, _ = catalogue.vocabulary.shortlist(des_query, config.SHORTLIST_SIZE)
+        for ref_idx in candidates:
+            queries_by_reference.setdefault(int(ref_idx), []).append(query_idx)
+
+    items = list(queries_by_reference.items())
+    tasks = [(store.path, store.build_id, ref_idx, [des_queries[q] for q in query_indexes])
+             for ref_idx, query_indexes in items]
+    for (ref_idx, query_indexes), counts in zip(items, engine.map(count_good_matches, tasks)):
+        votes[query_indexes, ref_idx] = counts
+    return votes
+
+def match_batch(catalogue, des_queries):
+    """
+    Matches several queries together, with the batch form of the configured
+    engine: shortlisted references matched once for all queries that picked
+    them, or a single k-NN pass over the stacked reference matrix.
+
+    Returns:
+        np.ndarray: (n_queries, n_references) good-match counts.
+    """
+    if config.MATCHER_ENGINE == 'shortlist' and catalogue.vocabulary is not None:
+        return match_shortlist_batch(catalogue, des_queries)
+    return match_stacked_batch(catalogue, des_queries)
+
+def verify_candidates(catalogue, votes, des_query, points_query):
+    """
+    Geometric verification: re-scores the GEOMETRIC_TOP_K references with the
+    most good matches by RANSAC homography inliers, one engine task each.
+
+    Returns:
+        np.ndarray: Inlier count for each reference (0 outside the top K).
+    """
+    store = catalogue.features
+    inliers = np.zeros(len(catalogue), dtype=np.int64)
+    candidates = [int(idx) for idx in np.argsort(-votes, kind='stable')[:config.GEOMETRIC_TOP_K] if votes[idx] > 0]
+    tasks = [(store.path, store.build_id, idx, des_query, points_query) for idx in candidates]
+    for idx, count in zip(candidates, engine.map(count_inliers, tasks)):
+        inliers[idx] = count
+    return inliers
+
+def best_from_votes(votes, n_query_descriptors, catalogue=None):
+    """
+    Picks the winning bottle from per-reference good-match counts.
+
+    The confidence score comes from the ratio of the runner-up's votes to the
+    winner's: (1 - second_best / best) scales it to 0 for a tie and 1 when no
+    other bottle got a vote, and it is weighted by best / n_query_descriptors,
+    the share of the query that voted for the winner. The score lies in 0-1;
+    the unbounded best / second_best ratio itself is not reported.
+
+    Args:
+        votes (np.ndarray): Good-match count for each reference of the catalogue.
+        n_query_descriptors (int): Query descriptors the votes were counted over.
+        catalogue (Catalogue): The catalogue the votes were counted against (or merged shard
+            candidates, see sharding.ShardScores); the current one if None.
+
+    Returns:
+        tuple: (best_match_id, confidence_score, good_matches_count)
+    """
+    if not len(votes):
+        return None, 0.0, 0
+    best = int(np.argmax(votes))
+    if votes[best] < config.MIN_MATCH_COUNT:
+        return None, 0.0, 0
+    second = int(np.partition(votes, -2)[-2]) if len(votes) > 1 else 0
+    runner_up_ratio = max(second, 0) / max(int(votes[best]), 1)  # 0 when no other bottle got a vote
+    coverage = min(int(votes[best]) / max(n_query_descriptors, 1), 1.0)
+    confidence = (1.0 - runner_up_ratio) * coverage
+    return (catalogue or current_catalogue()).ids[best], round(float(confidence), 4), int(votes[best])
+
+def _source_files_signature():
+    """
+    Change detector over the files a catalogue is loaded from. The index and vocabulary
+    are left out: data_preparation.py writes them before the store they belong to, and
+    they are only used with the store build they were made for (see load_catalogue).
+    """
+    return tuple(file_signature(path) for path in (config.FEATURES_FILE, config.DETAILS_FILE))
+
+def _install_catalogue(new_catalogue, signature):
+    """Makes new_catalogue the one new requests use (the 'update' of read-copy-update)."""
+    global catalogue, _watched_signature
+    register_store(new_catalogue.features)
+    result_cache.set_version(new_catalogue.build_id)
+    catalogue = new_catalogue
+    _watched_signature = signature
 
 def initialize_matcher_and_data():
     """
-    Loads features, initializes ORB/Matcher, and loads the full bottle details DataFrame.
+    Loads the catalogue (features, index, vocabulary and bottle details),
+    initializes the query-side ORB detector and the matching engine.
+    With SHARD_ADDRESSES set, only IDs and details are loaded and queries
+    are matched by the shard servers.
     """
-    global orb, bf, reference_features, bottle_details_df
+    global orb, engine, shard_client
     print("Initializing matcher, loading reference features, and bottle details...")
 
     try:
-        # 1. Load Reference Features
+        # 1. Load the catalogue: reference features and everything derived from them
         if not os.path.exists(config.FEATURES_FILE):
             print(f"Error: Feature file '{config.FEATURES_FILE}' not found.")
             return False
 
-        with open(config.FEATURES_FILE, 'rb') as f:
-            reference_features = pickle.load(f)
-        if not reference_features:
-            print(f"Warning: Feature file '{config.FEATURES_FILE}' is empty or invalid.")
-            return False
-        print(f"Loaded {len(reference_features)} reference bottle features.")
+        signature = _source_files_signature()
+        loaded = load_catalogue(matching=not config.SHARD_ADDRESSES)
+        _install_catalogue(loaded, signature)
+        print(f"Mapped {len(loaded)} reference bottle features (build {loaded.build_id}).")
+        if config.SHARD_ADDRESSES:
+            shard_client = ShardClient()
+            print(f"Matching on {len(shard_client.addresses)} shard server(s): {', '.join(shard_client.addresses)}.")
+        else:
+            print(f"Indexed {len(loaded.descriptors)} reference descriptors with a '{loaded.index.kind}' index.")
+        print(f"Loaded details for {len(loaded.details)} bottles.")
 
-        # 2. Load Full Bottle Details from Excel
-        bottle_details_df = pd.read_excel(config.EXCEL_FILE_PATH)
-        if config.COL_ID not in bottle_details_df.columns:
-            print(f"Error: ID column '{config.COL_ID}' not found in Excel file.")
-            return False
-            
-        # Handle potential duplicate IDs
-        bottle_details_df = bottle_details_df.loc[~bottle_details_df[config.COL_ID].duplicated(keep='first')]
-        bottle_details_df.set_index(config.COL_ID, inplace=True)
-        print(f"Loaded details for {len(bottle_details_df)} bottles.")
-
-        # 3. Initialize ORB and Matcher with optimized settings
-        orb = cv2.ORB_create(
-            nfeatures=config.N_FEATURES_ORB,
-            scaleFactor=1.2,
-            nlevels=8,
-            edgeThreshold=31,
-            firstLevel=0,
-            WTA_K=2,
-            patchSize=31,
-            fastThreshold=20
-        )
-        bf = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=False)
-        print("ORB detector and BFMatcher initialized with optimized settings.")
+        # 2. Initialize the query-side ORB detector (same settings as indexing, own feature budget)
+        orb = feature_pipeline.create_detector(config.N_FEATURES_QUERY)
+        print(f"ORB detector initialized ({config.N_FEATURES_QUERY} features per query).")
+
+        # 3. Matching engine, sized to this process's share of the CPU budget
+        engine = create_engine()
+        print(f"Matching engine '{engine.kind}': {engine.workers} worker(s) x {engine.cv2_threads} OpenCV thread(s).")
         return True
 
     except Exception as e:
         print(f"Error during initialization: {e}")
         return False
 
+def reload_catalogue(force=False):
+    """
+    Loads the feature store (and the files derived from it) again and swaps
+    the result in, if any of them changed since the current catalogue was loaded.
+    Loading happens before the swap, so requests never wait for it; in-flight
+    requests finish on the catalogue they started with.
+
+    Args:
+        force (bool): Reload even if the files look unchanged.
+
+    Returns:
+        tuple: (reloaded, message)
+    """
+    global _watched_signature
+    with _reload_lock:
+        signature = _source_files_signature()
+        if not force and signature == _watched_signature:
+            return False, f"Catalogue unchanged (build {catalogue.build_id if catalogue else None})."
+        try:
+            start = time.perf_counter()
+            # Read in off the request path, so requests on the new catalogue don't fault its pages in
+            loaded = load_catalogue(matching=not config.SHARD_ADDRESSES, prefault=True)
+        except Exception as e:
+            # Keep serving the current catalogue; don't retry until the files change again
+            _watched_signature = signature
+            return False, f"Reload failed, keeping the current catalogue: {e}"
+        previous = catalogue.build_id if catalogue else None
+        _install_catalogue(loaded, signature)
+        message = (f"Catalogue reloaded in {time.perf_counter() - start:.2f}s: build {previous} -> {loaded.build_id}, "
+                   f"{len(loaded)} bottles.")
+        print(message)
+        return True, message
+
+def _watch_catalogue():
+    """
+    Watcher thread: reloads once the catalogue files have changed and then stayed
+    unchanged for a full interval. data_preparation.py replaces the feature store
+    only after writing its index and vocabulary, so those are ready by then.
+    """
+    pending = None
+    while True:
+        time.sleep(config.CATALOGUE_WATCH_INTERVAL)
+        signature = _source_files_signature()
+        if signature == _watched_signature or signature[0] is None:
+            pending = None
+        elif signature != pending:
+            pending = signature  # Changed; check it is stable next time round
+        else:
+            reload_catalogue()
+            pending = None
+
+def start_catalogue_watcher():
+    """Starts the watcher thread in this process, if CATALOGUE_WATCH_INTERVAL is set."""
+    global _watcher
+    if config.CATALOGUE_WATCH_INTERVAL <= 0 or (_watcher is not None and _watcher.is_alive()):
+        return
+    _watcher = threading.Thread(target=_watch_catalogue, name='catalogue-watcher', daemon=True)
+    _watcher.start()
+
 # --- Call initialization when the module is loaded ---
-INITIALIZATION_SUCCESSFUL = initialize_matcher_and_data()
+# Not in the workers of the 'processes' matching engine: spawning re-imports the script the
+# service was started from (e.g. python app.py) there, and they only need the stores they map
+if multiprocessing.current_process().name == 'MainProcess':
+    INITIALIZATION_SUCCESSFUL = initialize_matcher_and_data()
+else:
+    INITIALIZATION_SUCCESSFUL = False
+if INITIALIZATION_SUCCESSFUL:
+    start_catalogue_watcher()
+
+def _restart_after_fork():
+    """
+    With gunicorn --preload the catalogue is loaded once in the master and workers
+    are forked from it, sharing its pages copy-on-write. Worker pools, OpenCV's
+    threads and the watcher thread don't survive a fork, so each worker starts its own.
+    """
+    global engine, shard_client, _watcher, _reload_lock
+    _reload_lock = threading.Lock()
+    if engine is not None:
+        engine = create_engine(engine.kind)
+    if shard_client is not None:
+        shard_client = ShardClient(shard_client.addresses, shard_client.timeout)
+    if _watcher is not None:
+        _watcher = None
+        start_catalogue_watcher()
+
+if hasattr(os, 'register_at_fork'):  # Not available on Windows
+    os.register_at_fork(after_in_child=_restart_after_fork)
+
+def jpeg_dimensions(image_bytes):
+    """
+    Reads (width, height) from a JPEG's frame header without decoding it.
+    Returns None for anything that is not a parseable JPEG.
+    """
+    data = memoryview(image_bytes)
+    if len(data) < 4 or data[0] != 0xFF or data[1] != 0xD8:
+        return None
+    pos = 2
+    while pos + 9 < len(data):
+        if data[pos] != 0xFF:
+            return None
+        marker = data[pos + 1]
+        if marker == 0xFF:  # Fill byte
+            pos += 1
+            continue
+        if marker in (0x01,) or 0xD0 <= marker <= 0xD9:  # Standalone markers carry no length
+            pos += 2
+            continue
+        if marker in SOF_MARKERS:
+            height = (data[pos + 5] << 8) | data[pos + 6]
+            width = (data[pos + 7] << 8) | data[pos + 8]
+            return width, height
+        pos += 2 + ((data[pos + 2] << 8) | data[pos + 3])
+    return None
+
+def decode_image(image_bytes, max_size=None):
+    """
+    Decodes an encoded image held in memory straight to grayscale.
+
+    Large JPEGs (e.g. 12MP phone photos) are decoded at 1/2, 1/4 or 1/8 scale
+    (IMREAD_REDUCED_GRAYSCALE_*), which does a fraction of the IDCT work, as long as
+    the longest side still reaches max_size (default MAX_IMAGE_SIZE), the feature
+    pipeline's resize target, so the features are unchanged.
+    """
+    max_size = max_size or config.MAX_IMAGE_SIZE
+    buffer = np.frombuffer(image_bytes, dtype=np.uint8)
+    flags = cv2.IMREAD_GRAYSCALE
+    size = jpeg_dimensions(image_bytes)
+    if size is not None:
+        # The longest side is the same whichever way EXIF orientation turns the image
+        longest_side = max(size)
+        for factor, reduced_flag in REDUCED_DECODE_FLAGS:
+            if longest_side // factor >= max_size:
+                flags = reduced_flag
+                break
+    return cv2.imdecode(buffer, flags)
+
+def extract_query_features(img_query, timings=None):
+    """
+    Runs a decoded query image (grayscale or BGR) through the shared feature
+    pipeline and returns (keypoint x/y coordinates, ORB descriptors),
+    strongest keypoint response first (for early termination), or (None, None).
+    """
+    return feature_pipeline.extract(img_query, orb, timings)
 
 def find_best_match(image_path):
     """
-    Identifies the best matching whisky bottle ID and confidence.
+    Identifies the best matching whisky bottle from an image file on disk.
 
     Args:
         image_path (str): Path to the input image file.
@@ -143,51 +473,316 @@ def find_best_match(image_path):
         tuple: (best_match_id, confidence_score, good_matches_count)
                Returns (None, 0.0, 0) if no match is found or an error occurs.
     """
-    if not INITIALIZATION_SUCCESSFUL or orb is None or bf is None or not reference_features:
-        print("Error: Matcher not initialized successfully. Cannot perform matching.")
-        return None, 0.0, 0
-
     if not os.path.exists(image_path):
         print(f"Error: Query image file not found at '{image_path}'")
         return None, 0.0, 0
 
+    with open(image_path, 'rb') as f:
+        return find_best_match_from_bytes(f.read())
+
+def _record_stage(timings, stage, start):
+    """Adds the ms elapsed since start to timings[stage], if timings are being collected."""
+    if timings is not None:
+        timings[stage] = round(timings.get(stage, 0.0) + 1000 * (time.perf_counter() - start), 2)
+
+def find_best_match_from_bytes(image_bytes, timings=None):
+    """
+    Identifies the best matching whisky bottle from an encoded image (e.g. the
+    raw bytes of an upload) without touching the filesystem.
+
+    Repeat submissions of the same or a near-identical image are answered from
+    result_cache when RESULT_CACHE_ENABLED is set.
+
+    Args:
+        image_bytes (bytes): Encoded image.
+        timings (dict): If given, receives the duration in ms of each stage that
+            ran: 'cache' (result cache lookups), 'decode', 'preprocess', 'detect' and 'match'.
+
+    Returns:
+        tuple: (best_match_id, confidence_score, good_matches_count)
+               Returns (None, 0.0, 0) if no match is found or an error occurs.
+    """
+    catalogue = current_catalogue()  # Used for the whole request, even if a reload swaps it meanwhile
+    key = content_key(image_bytes) if config.RESULT_CACHE_ENABLED else None
+    if key is not None:
+        start = time.perf_counter()
+        cached = result_cache.get_exact(key)
+        _record_stage(timings, 'cache', start)
+        if cached is not None:
+            return cached
+
+    start = time.perf_counter()
     try:
-        # Load and preprocess image
-        img_query = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
-        if img_query is None:
-            print(f"Error: Could not load query image '{image_path}'.")
-            return None, 0.0, 0
+        img_query = decode_image(image_bytes)
+    except cv2.error as e:
+        print(f"Error: Could not decode query image: {e}")
+        return None, 0.0, 0
+    if timings is not None:
+        timings['decode'] = round(1000 * (time.perf_counter() - start), 2)
+    if img_query is None:
+        print("Error: Could not decode query image.")
+        return None, 0.0, 0
 
-        # Preprocess image
-        img_query = preprocess_image(img_query)
-        
-        # Detect features
-        kp_query, des_query = orb.detectAndCompute(img_query, None)
+    if key is None or not _matcher_ready(catalogue):
+        return find_best_match_from_array(img_query, timings, catalogue)
 
-        if des_query is None or len(des_query) < config.MIN_MATCH_COUNT:
-            return None, 0.0, 0
+    start = time.perf_counter()
+    signature = perceptual_signature(img_query)
+    cached = result_cache.get_similar(signature)
+    _record_stage(timings, 'cache', start)
+    if cached is not None:
+        return cached
+    try:
+        result = _match_image(img_query, timings, catalogue)
+    except ShardUnavailableError:
+        raise
+    except Exception as e:
+        print(f"An unexpected error occurred during matching: {e}")
+        return None, 0.0, 0  # Not cached: a failure is no answer for this image
+    result_cache.put(key, signature, result, catalogue.build_id)
+    return result
 
-        # Process matches in parallel
-        match_args = [(des_query, ref) for ref in reference_features]
-        match_results = list(executor.map(process_reference_match, match_args))
-        
-        # Filter out None results and find best match
-        all_match_results = [result for result in match_results if result is not None]
+def _matcher_ready(catalogue):
+    return INITIALIZATION_SUCCESSFUL and orb is not None and engine is not None and catalogue is not None
 
-        if not all_match_results:
-            return None, 0.0, 0
+def _match_image(img_query, timings, catalogue):
+    """find_best_match_from_array for a ready matcher, letting any error propagate."""
+    # Extraction runs as engine work too, so its OpenCV threads count against the CPU budget
+    points_query, des_query = engine.map_local(lambda img: extract_query_features(img, timings), [img_query])[0]
+    start = time.perf_counter()
+    result = match_descriptors(des_query, points_query, catalogue)
+    if timings is not None:
+        timings['match'] = round(1000 * (time.perf_counter() - start), 2)
+    return result
 
-        best_match = max(all_match_results, key=lambda x: x['match_count'])
-        confidence_score = best_match['match_count']
+def find_best_match_from_array(img_query, timings=None, catalogue=None):
+    """
+    Identifies the best matching whisky bottle from an already decoded image.
 
-        return best_match['id'], confidence_score, best_match['match_count']
+    Args:
+        img_query (np.ndarray): Grayscale image, or a BGR image (e.g. a webcam frame).
+        timings (dict): If given, receives 'preprocess', 'detect' and 'match' durations in ms.
+        catalogue (Catalogue): Reference set to match against; the current one if None.
 
+    Returns:
+        tuple: (best_match_id, confidence_score, good_matches_count)
+               Returns (None, 0.0, 0) if no match is found or an error occurs.
+    """
+    catalogue = catalogue or current_catalogue()
+    if not _matcher_ready(catalogue):
+        print("Error: Matcher not initialized successfully. Cannot perform matching.")
+        return None, 0.0, 0
+
+    try:
+        return _match_image(img_query, timings, catalogue)
+    except ShardUnavailableError:
+        raise  # Not a 'no match': the request fails rather than caching a wrong answer
     except Exception as e:
-        print(f"An unexpected error occurred during matching for image '{image_path}': {e}")
+        print(f"An unexpected error occurred during matching: {e}")
         return None, 0.0, 0
 
+def match_descriptors(des_query, points_query=None, catalogue=None):
+    """
+    Identifies the best matching whisky bottle from query ORB descriptors,
+    using the configured MATCHER_ENGINE. With GEOMETRIC_VERIFICATION and
+    query keypoint coordinates, the leading candidates are re-ranked by
+    RANSAC inliers, which are then reported as the good matches.
+
+    With SHARD_ADDRESSES set, every shard server scores the query against its
+    part of the catalogue and the winner is picked from their merged candidates.
+
+    Returns:
+        tuple: (best_match_id, confidence_score, good_matches_count)
+               Returns (None, 0.0, 0) if no match is found.
+
+    Raises:
+        ShardUnavailableError: If no shard server answered.
+    """
+    if des_query is None or len(des_query) < config.MIN_MATCH_COUNT:
+        return None, 0.0, 0
+    if shard_client is not None:
+        merged = shard_client.score_batch([des_query], [points_query])[0]
+        return best_from_votes(merged.scores, merged.n_matched, merged)
+    catalogue, scores, n_matched = score_query(des_query, points_query, catalogue)
+    return best_from_votes(scores, n_matched, catalogue)
+
+def score_query(des_query, points_query=None, catalogue=None):
+    """
+    Scores every reference of a catalogue for one query (see score_references),
+    moving on to the current catalogue if a reload replaced the store meanwhile.
+
+    Returns:
+        tuple: (catalogue the scores refer to, scores, number of query descriptors matched)
+    """
+    catalogue = catalogue or current_catalogue()
+    try:
+        scores, n_matched = score_references(des_query, points_query, catalogue)
+    except StoreReplacedError:
+        # A process worker opened the store file after a reload had replaced it; the
+        # request's catalogue can't be served there any more, so finish on the new one
+        if catalogue is current_catalogue():
+            raise
+        catalogue = current_catalogue()
+        scores, n_matched = score_references(des_query, points_query, catalogue)
+    return catalogue, scores, n_matched
+
+def score_references(des_query, points_query=None, catalogue=None):
+    """
+    Scores every reference for a query (see match_descriptors).
+
+    Returns:
+        tuple: (score for each reference of the catalogue: good matches, or inliers
+                when geometrically verified; number of query descriptors matched)
+    """
+    catalogue = catalogue or current_catalogue()
+    vocabulary = catalogue.vocabulary
+    n_matched = len(des_query)
+    if config.MATCHER_ENGINE == 'shortlist' and vocabulary is not None:
+        # Coarse global-signature ranking, then ratio-test matching on the top candidates only
+        candidates, _ = vocabulary.shortlist(des_query, config.SHORTLIST_SIZE)
+        votes = match_references_in_order(catalogue, des_query, candidates)
+    elif config.MATCHER_ENGINE in ('stacked', 'shortlist'):
+        # k-NN passes over the stacked matrix, votes counted per bottle
+        votes, n_matched = match_stacked(catalogue, des_query)
+    elif vocabulary is not None:
+        # Every reference, most similar global signature first
+        order, _ = vocabulary.shortlist(des_query, len(catalogue))
+        votes = match_references_in_order(catalogue, des_query, order)
+    else:
+        # Catalogue order carries no ranking, so every reference is matched
+        votes = match_references_in_order(catalogue, des_query, range(len(catalogue)), early_exit=False)
+
+    if config.GEOMETRIC_VERIFICATION and points_query is not None:
+        return verify_candidates(catalogue, votes, des_query, points_query), len(des_query)
+    return votes, n_matched
+
+def _decode_and_extract(image_bytes):
+    """
+    Batch worker: decodes one encoded image and extracts its features.
+    Returns ((points, descriptors), error, stage timings in ms).
+    """
+    timings = {'decode': 0.0, 'preprocess': 0.0, 'detect': 0.0}
+    points_query, des_query = None, None
+    start = time.perf_counter()
+    try:
+        img_query = decode_image(image_bytes)
+        timings['decode'] = round(1000 * (time.perf_counter() - start), 2)
+        if img_query is not None:
+            points_query, des_query = extract_query_features(img_query, timings)
+        error = None if img_query is not None else 'Could not decode image.'
+    except cv2.error as e:
+        error = f'Could not decode image: {e}'
+    return (points_query, des_query), error, timings
+
+def identify_batch(images, timings=None):
+    """
+    Identifies several encoded images at once. Features are extracted for all
+    images concurrently, then all queries are matched together: with the
+    'shortlist' engine each shortlisted reference is matched once against
+    every query that picked it; otherwise all queries share a single k-NN
+    pass over the stacked reference matrix. Geometric verification, if
+    enabled, then runs per image. With SHARD_ADDRESSES set, the whole batch
+    goes to every shard server at once and they verify their own candidates.
+
+    Args:
+        images (list): Encoded image bytes.
+        timings (dict): If given, receives the wall time in ms of the whole batch's
+            'extract' and 'match' stages.
+
+    Returns:
+        list: One dict per image, in input order, with 'id', 'score',
+              'matches_count', 'error' (None on success or no match) and
+              'timing_ms' ('decode', 'preprocess', 'detect', their sum as
+              'extract', 'match' as this image's share of the batch match
+              plus its own verification, and 'total').
+    """
+    catalogue = current_catalogue()
+    if not INITIALIZATION_SUCCESSFUL or orb is None or engine is None or catalogue is None:
+        print("Error: Matcher not initialized successfully. Cannot perform matching.")
+        empty_timings = {'decode': 0.0, 'preprocess': 0.0, 'detect': 0.0, 'extract': 0.0, 'match': 0.0, 'total': 0.0}
+        return [{'id': None, 'score': 0.0, 'matches_count': 0, 'error': 'Matcher not initialized.',
+                 'timing_ms': dict(empty_timings)} for _ in images]
+
+    start = time.perf_counter()
+    extracted = engine.map_local(_decode_and_extract, images)
+    _record_stage(timings, 'extract', start)
+    matchable = [idx for idx, ((_, des), _, _) in enumerate(extracted)
+                 if des is not None and len(des) >= config.MIN_MATCH_COUNT]
+
+    batch_start = start = time.perf_counter()
+    des_queries = [extracted[idx][0][1] for idx in matchable]
+    if shard_client is not None and matchable:
+        merged = shard_client.score_batch(des_queries, [extracted[idx][0][0] for idx in matchable])
+        scored = {idx: (shard_scores.scores, shard_scores.n_matched, shard_scores)
+                  for idx, shard_scores in zip(matchable, merged)}
+    else:
+        votes = match_batch(catalogue, des_queries)
+        scored = {idx: (image_votes, len(des_query), catalogue)
+                  for idx, des_query, image_votes in zip(matchable, des_queries, votes)}
+    match_share = (time.perf_counter() - start) / max(len(matchable), 1)
+
+    results = []
+    for idx, ((points_query, des_query), error, image_timings) in enumerate(extracted):
+        if idx in scored:
+            start = time.perf_counter()
+            votes, n_matched, candidates = scored[idx]
+            if config.GEOMETRIC_VERIFICATION and shard_client is None:
+                votes = verify_candidates(catalogue, votes, des_query, points_query)
+            bottle_id, score, matches_count = best_from_votes(votes, n_matched, candidates)
+            match_time = match_share + time.perf_counter() - start
+        else:
+            bottle_id, score, matches_count, match_time = None, 0.0, 0, 0.0
+        extract_ms = round(image_timings['decode'] + image_timings['preprocess'] + image_timings['detect'], 2)
+        image_timings.update(
+            extract=extract_ms,
+            match=round(1000 * match_time, 2),
+            total=round(extract_ms + 1000 * match_time, 2),
+        )
+        results.append({
+            'id': bottle_id,
+            'score': score,
+            'matches_count': matches_count,
+            'error': error,
+            'timing_ms': image_timings,
+        })
+    _record_stage(timings, 'match', batch_start)
+    return results
+
+def get_cache_stats():
+    """Hit/miss counters of the upload result cache."""
+    return result_cache.stats()
+
+def get_shard_stats():
+    """Answered/failed/late request counters per shard server ({} when matching in-process)."""
+    return shard_client.stats() if shard_client is not None else {}
+
+def get_reference_stats():
+    """Size and build of the current reference set, for monitoring."""
+    if catalogue is None:
+        return {'bottles': 0, 'descriptors': 0, 'build_id': None, 'loaded_at': None}
+    return catalogue.stats()
+
+def get_details_stats():
+    """Found/missing lookup counters of the current bottle details store."""
+    if catalogue is None:
+        return {'found': 0, 'missing': 0, 'bottles': 0}
+    return catalogue.details.stats()
+
 def get_bottle_details(bottle_id):
     """
-    Retrieves all details for a given bottle ID using the cached function.
+    Retrieves all details for a given bottle ID as a dict, or None if the bottle is unknown.
+    """
+    details = catalogue.details.get(bottle_id) if catalogue is not None else None
+    if details is None:
+        print(f"Error retrieving details for bottle ID '{bottle_id}': not found")
+    return details
+
+def get_bottle_details_json(bottle_id, extra=None):
+    """
+    Returns a bottle's details serialized as a JSON object (bytes), with the
+    fields of extra appended, or None if the bottle is unknown.
     """
-    return get_bottle_details_cached(bottle_id)
+    details = catalogue.details.json_bytes(bottle_id, extra) if catalogue is not None else None
+    if details is None:
+        print(f"Error retrieving details for bottle ID '{bottle_id}': not found")
+    return details
@@ -0,0 +1,204 @@
+# src/image_downloader.py
+
+import os
+import sys
+import json
+import time
+import threading
+from pathlib import Path
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import requests
+from requests.adapters import HTTPAdapter
+
+# Import configuration variables
+try:
+    import config
+except ModuleNotFoundError:
+    print("Error: config.py not found. Make sure it's in the 'src' directory.")
+    sys.exit(1)
+
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+MANIFEST_SAVE_EVERY = 25  # Completed downloads between manifest checkpoints
+
+def image_filename_for(bottle_id, image_url):
+    """Builds the local filename for a bottle image from its ID and the URL's extension."""
+    file_extension = Path(urlsplit(image_url).path).suffix or '.jpg'
+    safe_id_str = str(bottle_id).replace('/', '_').replace('\\', '_').replace(':', '_')  # Sanitize common problematic chars
+    return f"{safe_id_str}{file_extension}"
+
+class ImageDownloader:
+    """
+    Downloads bottle images concurrently over one pooled HTTP session.
+
+    - At most per_host_limit requests run against any single host at a time.
+    - Failed requests (connection errors, 429 and 5xx) are retried with
+      exponential backoff, honouring Retry-After when the server sends it.
+    - ETag / Last-Modified values are kept in a JSON manifest and sent back as
+      conditional headers, so unchanged images cost a 304 and no body.
+    - Files are written to a temporary name and renamed when complete, and the
+      manifest is checkpointed as downloads finish, so an interrupted run
+      resumes where it stopped.
+    """
+
+    def __init__(self, download_dir=None, manifest_path=None, max_workers=None, per_host_limit=None,
+                 max_retries=None, backoff=None, timeout=None, revalidate=None, session=None):
+        self.download_dir = download_dir or config.IMAGE_DOWNLOAD_DIR
+        self.manifest_path = manifest_path or config.DOWNLOAD_MANIFEST_FILE
+        self.max_workers = max_workers or config.DOWNLOAD_WORKERS
+        self.per_host_limit = per_host_limit or config.DOWNLOAD_PER_HOST_LIMIT
+        self.max_retries = config.DOWNLOAD_MAX_RETRIES if max_retries is None else max_retries
+        self.backoff = config.DOWNLOAD_BACKOFF_SECONDS if backoff is None else backoff
+        self.timeout = timeout or config.DOWNLOAD_TIMEOUT
+        self.revalidate = config.DOWNLOAD_REVALIDATE if revalidate is None else revalidate
+        self.session = session or self._create_session()
+        self.manifest = self._load_manifest()
+        self._manifest_lock = threading.Lock()
+        self._host_limits = {}
+        self._host_limits_lock = threading.Lock()
+        self._completed_since_save = 0
+
+    def _create_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.max_workers, pool_maxsize=self.max_workers)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def _load_manifest(self):
+        if not os.path.exists(self.manifest_path):
+            return {}
+        try:
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Warning: Could not read download manifest '{self.manifest_path}' ({e}). Starting fresh.")
+            return {}
+
+    def save_manifest(self):
+        """Atomically writes the manifest so a crash never leaves it half-written."""
+        with self._manifest_lock:
+            snapshot = json.dumps(self.manifest, indent=1, sort_keys=True)
+        os.makedirs(os.path.dirname(self.manifest_path) or '.', exist_ok=True)
+        tmp_path = f"{self.manifest_path}.tmp-{os.getpid()}"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(snapshot)
+        os.replace(tmp_path, self.manifest_path)
+
+    def _host_limit(self, url):
+        host = urlsplit(url).netloc
+        with self._host_limits_lock:
+            if host not in self._host_limits:
+                self._host_limits[host] = threading.BoundedSemaphore(self.per_host_limit)
+            return self._host_limits[host]
+
+    def _request(self, url, headers):
+        """
+        GETs url with per-host limiting and retry/backoff. Raises on final failure.
+
+        Returns:
+            tuple: (response, body: the content for a 200, else b''). The response is
+                   closed, so its connection is back in the session's pool.
+        """
+        for attempt in range(self.max_retries + 1):
+            delay = self.backoff * (2 ** attempt)
+            try:
+                with self._host_limit(url):
+                    response = self.session.get(url, headers=headers, stream=True, timeout=self.timeout)
+                    with response:
+                        # Read in full (empty for a 304) so closing returns the connection to the pool
+                        # instead of dropping it
+                        body = response.content
+                        if response.status_code not in RETRYABLE_STATUS:
+                            response.raise_for_status()
+                            return response, body if response.status_code == 200 else b''
+                        retry_after = response.headers.get('Retry-After', '')
+                        if retry_after.isdigit():
+                            delay = max(delay, float(retry_after))
+                        error = requests.exceptions.HTTPError(f"HTTP {response.status_code}", response=response)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                error = e
+            if attempt < self.max_retries:
+                time.sleep(delay)
+        raise error
+
+    def download_one(self, bottle_id, image_url):
+        """
+        Ensures one image is present locally.
+
+        Returns:
+            tuple: (image_path, status) where status is 'downloaded', 'not_modified' or 'cached'.
+        """
+        image_path = os.path.join(self.download_dir, image_filename_for(bottle_id, image_url))
+        key = str(bottle_id)
+        with self._manifest_lock:
+            entry = dict(self.manifest.get(key) or {})
+        exists = os.path.exists(image_path)
+
+        headers = {}
+        if exists and entry.get('url') == image_url and entry.get('path') == os.path.basename(image_path):
+            if not self.revalidate:
+                return image_path, 'cached'
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+            if not headers:
+                return image_path, 'cached'  # Nothing to revalidate against
+        elif exists and not entry:
+            # Present from before the manifest existed; adopt it without refetching
+            self._record(key, image_url, image_path, None, None)
+            return image_path, 'cached'
+
+        response, body = self._request(image_url, headers)
+        if response.status_code == 304 and exists:
+            return image_path, 'not_modified'
+
+        tmp_path = f"{image_path}.part"
+        with open(tmp_path, 'wb') as f:
+            f.write(body)
+        os.replace(tmp_path, image_path)
+        self._record(key, image_url, image_path, response.headers.get('ETag'), response.headers.get('Last-Modified'))
+        return image_path, 'downloaded'
+
+    def _record(self, key, image_url, image_path, etag, last_modified):
+        with self._manifest_lock:
+            self.manifest[key] = {
+                'url': image_url,
+                'path': os.path.basename(image_path),
+                'etag': etag,
+                'last_modified': last_modified,
+            }
+            self._completed_since_save += 1
+            checkpoint = self._completed_since_save >= MANIFEST_SAVE_EVERY
+            if checkpoint:
+                self._completed_since_save = 0
+        if checkpoint:
+            self.save_manifest()
+
+    def download_all(self, jobs):
+        """
+        Downloads every (bottle_id, image_url) pair concurrently.
+
+        Returns:
+            tuple: ({bottle_id: image_path} for every image available locally,
+                    {status: count} including 'error').
+        """
+        os.makedirs(self.download_dir, exist_ok=True)
+        image_paths = {}
+        stats = {'downloaded': 0, 'not_modified': 0, 'cached': 0, 'error': 0}
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+                futures = {pool.submit(self.download_one, bottle_id, url): (bottle_id, url) for bottle_id, url in jobs}
+                for future in as_completed(futures):
+                    bottle_id, url = futures[future]
+                    try:
+                        image_path, status = future.result()
+                        image_paths[bottle_id] = image_path
+                        stats[status] += 1
+                    except Exception as e:
+                        print(f"Error downloading {url} for ID {bottle_id}: {e}")
+                        stats['error'] += 1
+        finally:
+            self.save_manifest()
+        return image_paths, stats
@@ -0,0 +1,296 @@
+# src/job_queue.py
+
+import os
+import re
+import sys
+import json
+import math
+import time
+import uuid
+import weakref
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Import configuration variables
+try:
+    import config
+except ModuleNotFoundError:
+    print("Error: config.py not found. Make sure it's in the 'src' directory.")
+    sys.exit(1)
+
+# Identification runs on a small pool of threads per web worker, behind a bounded queue.
+# When the queue is full, new work is turned away at once with a Retry-After estimate
+# instead of piling up unseen in gunicorn until workers time out. Identical images
+# submitted while one is queued or running share that job. Jobs that may be polled are
+# also written to JOB_DIR, so any worker can answer for a job another worker runs.
+
+JOB_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+SERVICE_TIME_SMOOTHING = 0.2  # Weight of the latest job in the moving average of run times
+
+class QueueFullError(Exception):
+    """Raised by JobQueue.submit when max_depth jobs are already queued or running."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Identification queue is full, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+class Job:
+    """One unit of queued work and, once finished, its result."""
+
+    def __init__(self, key=None):
+        self.id = uuid.uuid4().hex
+        self.key = key                # Coalescing key (e.g. content hash), or None
+        self.status = 'queued'        # 'queued', 'running', 'done' or 'failed'
+        self.result = None
+        self.error = None
+        self.timings = {}             # Stage durations in ms, filled in by the job function
+        self.submitted_at = time.time()
+        self.finished_at = None
+        self.persist = False          # Written to JOB_DIR, so it can be polled through any worker
+        self.kind = 'identify'        # What the job does, so a poller knows how to present the result
+        self.context = None           # JSON-ready request details needed to present it (see keep)
+        self._submitted = time.perf_counter()
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+
+    def wait(self, timeout=None):
+        """Blocks until the job has finished; returns False if timeout ran out first."""
+        return self._done.wait(timeout)
+
+    @property
+    def finished(self):
+        return self._done.is_set()
+
+    def record(self):
+        """JSON-ready state of the job, as written to JOB_DIR."""
+        return {
+            'id': self.id,
+            'status': self.status,
+            'result': self.result,
+            'error': self.error,
+            'timings': self.timings,
+            'kind': self.kind,
+            'context': self.context,
+            'submitted_at': self.submitted_at,
+            'finished_at': self.finished_at,
+            'pid': os.getpid(),   # Process running the job, so a sweep can tell an orphaned one
+        }
+
+class JobQueue:
+    """
+    Bounded queue of jobs run by a thread pool.
+
+    At most max_depth jobs are queued or running at a time; submit() raises
+    QueueFullError beyond that. Finished jobs stay available to get() for
+    ttl_seconds.
+    """
+
+    def __init__(self, workers=None, max_depth=None, ttl_seconds=None, job_dir=None):
+        self.workers = workers or config.IDENTIFY_WORKERS
+        self.max_depth = max_depth or config.IDENTIFY_QUEUE_DEPTH
+        self.ttl_seconds = config.JOB_RESULT_TTL if ttl_seconds is None else ttl_seconds
+        self.job_dir = job_dir or config.JOB_DIR
+        self._reset()
+        self.counters = {'submitted': 0, 'coalesced': 0, 'rejected': 0, 'completed': 0, 'failed': 0}
+        _queues.add(self)
+
+    def _reset(self):
+        """(Re)creates the per-process state; the executor is started on first use."""
+        self._lock = threading.Lock()
+        self._executor = None
+        self._jobs = {}             # job ID -> Job, until ttl_seconds after it finished
+        self._in_flight = {}        # coalescing key -> queued or running Job
+        self._depth = 0             # Jobs queued or running
+        self._service_seconds = 1.0  # Moving average of job run time, for Retry-After
+        self._last_sweep = time.monotonic()
+
+    # --- Submitting ---
+    def submit(self, fn, *args, key=None):
+        """
+        Queues fn(*args, timings=job.timings) to run on the pool.
+
+        Args:
+            key: If given and a job with the same key is queued or running,
+                that job is returned instead of queueing another.
+
+        Returns:
+            tuple: (job, coalesced)
+
+        Raises:
+            QueueFullError: If max_depth jobs are already queued or running.
+        """
+        with self._lock:
+            job = self._in_flight.get(key) if key is not None else None
+            if job is not None:
+                self.counters['coalesced'] += 1
+                return job, True
+            if self._depth >= self.max_depth:
+                self.counters['rejected'] += 1
+                raise QueueFullError(self._retry_after())
+            job = Job(key)
+            self._depth += 1
+            self._jobs[job.id] = job
+            if key is not None:
+                self._in_flight[key] = job
+            self.counters['submitted'] += 1
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='identify')
+            executor = self._executor
+        self._sweep()
+        executor.submit(self._run, job, fn, args)
+        return job, False
+
+    def _run(self, job, fn, args):
+        start = time.perf_counter()
+        job.timings['queue'] = round(1000 * (start - job._submitted), 2)
+        job.status = 'running'
+        try:
+            result, error, status = fn(*args, timings=job.timings), None, 'done'
+        except Exception as e:
+            print(f"Error: Identification job {job.id} failed: {e}")
+            result, error, status = None, str(e), 'failed'
+
+        with self._lock:
+            self._depth -= 1
+            if self._in_flight.get(job.key) is job:
+                del self._in_flight[job.key]
+            self.counters['completed' if status == 'done' else 'failed'] += 1
+            self._service_seconds += SERVICE_TIME_SMOOTHING * (time.perf_counter() - start - self._service_seconds)
+
+        with job._lock:
+            job.result, job.error, job.status = result, error, status
+            job.finished_at = time.time()
+            job._done.set()
+            if job.persist:
+                self._write(job)
+
+    def _retry_after(self):
+        """Seconds until the queue has likely drained enough to take a new job (lock held)."""
+        return max(1, math.ceil(self._depth * self._service_seconds / self.workers))
+
+    def retry_after(self):
+        with self._lock:
+            return self._retry_after()
+
+    # --- Polling ---
+    def keep(self, job, kind=None, context=None):
+        """
+        Makes a job pollable from every worker: its state is written to job_dir,
+        now and when it finishes.
+
+        Args:
+            kind (str): What the job does ('identify' unless given), recorded for the poller.
+            context (dict): JSON-ready details of the request the poller needs to
+                present the result, e.g. the file names of a batch.
+        """
+        with job._lock:
+            if kind is not None:
+                job.kind = kind
+            if context is not None:
+                job.context = context
+            if not job.persist:
+                job.persist = True
+            self._write(job)
+
+    def get(self, job_id):
+        """
+        Looks a job up by ID, in this process first, then in job_dir.
+
+        Returns:
+            dict: The job's record (see Job.record), or None if it is unknown or expired.
+        """
+        if not JOB_ID_PATTERN.match(job_id or ''):
+            return None
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is not None:
+            with job._lock:
+                return job.record()
+        try:
+            with open(self._path(job_id), 'r', encoding='utf-8') as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if record.get('finished_at') and time.time() - record['finished_at'] > self.ttl_seconds:
+            return None
+        return record
+
+    def _path(self, job_id):
+        return os.path.join(self.job_dir, f"{job_id}.json")
+
+    def _write(self, job):
+        """Writes the job's record to job_dir atomically (job lock held)."""
+        try:
+            os.makedirs(self.job_dir, exist_ok=True)
+            tmp_path = f"{self._path(job.id)}.tmp-{os.getpid()}"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(job.record(), f, default=str)
+            os.replace(tmp_path, self._path(job.id))
+        except OSError as e:
+            print(f"Warning: Could not save identification job {job.id}: {e}")
+
+    def _sweep(self):
+        """
+        Forgets jobs finished more than ttl_seconds ago, at most once per ttl_seconds.
+        Queued and running jobs stay pollable however long they take, unless the
+        process running them has gone (e.g. a restarted worker), as they will never finish.
+        """
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_sweep < self.ttl_seconds:
+                return
+            self._last_sweep = now
+            cutoff = time.time() - self.ttl_seconds
+            for job_id in [job_id for job_id, job in self._jobs.items() if job.finished and job.finished_at < cutoff]:
+                del self._jobs[job_id]
+        try:
+            names = os.listdir(self.job_dir)
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(self.job_dir, name)
+            try:
+                if not name.endswith('.json'):
+                    # Left by a write interrupted before its rename
+                    if os.path.getmtime(path) < cutoff:
+                        os.remove(path)
+                    continue
+                with open(path, 'r', encoding='utf-8') as f:
+                    record = json.load(f)
+                finished_at = record.get('finished_at')
+                if finished_at is not None and finished_at < cutoff:
+                    os.remove(path)
+                elif finished_at is None and record.get('pid') and not _process_alive(record['pid']):
+                    os.remove(path)
+            except (OSError, ValueError):
+                pass  # Removed or being replaced by another worker meanwhile
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats.update(depth=self._depth, max_depth=self.max_depth, workers=self.workers,
+                         service_seconds=round(self._service_seconds, 3))
+        return stats
+
+def _process_alive(pid):
+    """True if process pid still exists (always assumed on Windows, where os.kill would end it)."""
+    if os.name == 'nt':
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True  # Exists, but belongs to another user
+    return True
+
+# Queues created in this process, so their threads and locks can be reset after a fork
+_queues = weakref.WeakSet()
+
+def _reset_after_fork():
+    """Pool threads don't survive a fork (gunicorn --preload); each worker starts its own."""
+    for queue in list(_queues):
+        queue._reset()
+
+if hasattr(os, 'register_at_fork'):  # Not available on Windows
+    os.register_at_fork(after_in_child=_reset_after_fork)
@@ -5,7 +5,8 @@ import os
 
 # Try to import the matching function
 try:
-    from identification import find_best_match, INITIALIZATION_SUCCESSFUL
+    from identification import find_best_match_from_bytes, get_bottle_details, INITIALIZATION_SUCCESSFUL
+    import config
 except ModuleNotFoundError:
     print("Error: Could not import from 'identification.py'.")
     print("Ensure 'identification.py' and '__init__.py' exist in the 'src' directory,")
@@ -45,14 +46,17 @@ if __name__ == "__main__":
 
     # --- Perform Identification ---
     print(f"\nAttempting to identify: {os.path.basename(test_image_path)}")
-    bottle_id, bottle_name, score, matches_count = find_best_match(test_image_path)
+    with open(test_image_path, 'rb') as f:
+        bottle_id, score, matches_count = find_best_match_from_bytes(f.read())
 
     # --- Display Results ---
     if bottle_id is not None:
-        print(f"\n--- Best Match Found ---")
+        details = get_bottle_details(bottle_id)
+        bottle_name = details.get(config.COL_NAME, 'Unknown') if details is not None else 'Unknown'
+        print("\n--- Best Match Found ---")
         print(f"  ID: {bottle_id}")
         print(f"  Name: {bottle_name}")
         print(f"  Good Matches: {matches_count}")
-        print(f"  Confidence Score (raw count): {score}")
+        print(f"  Confidence Score: {score:.3f}")
     else:
         print("\n--- No matching bottle found meeting the criteria. ---")
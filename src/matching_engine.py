@@ -0,0 +1,339 @@
+# src/matching_engine.py
+
+import os
+import sys
+import weakref
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import numpy as np
+import cv2
+
+# Import configuration variables
+try:
+    import config
+except ModuleNotFoundError:
+    print("Error: config.py not found. Make sure it's in the 'src' directory.")
+    sys.exit(1)
+
+from ann_index import STACKED_BLOCK_ROWS, hamming_knn
+from feature_store import FeatureStore
+
+# --- CPU budget ---
+# Matching runs inside every gunicorn worker process, next to OpenCV's own thread pool.
+# Each engine sizes itself so that (parallel tasks x OpenCV threads per task) stays
+# within this process's share of config.CPU_BUDGET. Query feature extraction (decode,
+# CLAHE, ORB) is engine work as well (map_local), so it takes one of those task slots
+# rather than adding OpenCV threads on top; request and job-queue threads only wait.
+
+def process_budget():
+    """CPU threads this process may use for matching: its share of CPU_BUDGET."""
+    return max(1, config.CPU_BUDGET // max(config.WEB_WORKERS, 1))
+
+# --- Worker-side state ---
+# Tasks name the feature store by (path, build_id) instead of carrying descriptors, so
+# process workers memory-map the same file and share its page-cache pages.
+# Stores registered by this process stay available for as long as something (a catalogue
+# still used by in-flight requests) holds them, so several builds can be served during a
+# reload; process workers keep only the build they opened last.
+_registered_stores = weakref.WeakValueDictionary()
+_opened_stores = {}
+_stores_lock = threading.Lock()
+_matcher = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=False)
+
+class StoreReplacedError(ValueError):
+    """A task named a feature store build that is no longer the file on disk."""
+
+def register_store(store):
+    """Makes an already open store available to tasks run in this process."""
+    with _stores_lock:
+        _registered_stores[(store.path, store.build_id)] = store
+
+def _get_store(path, build_id):
+    with _stores_lock:
+        store = _registered_stores.get((path, build_id))
+        if store is None:
+            store = _opened_stores.get((path, build_id))
+        if store is None:
+            store = FeatureStore(path)
+            if store.build_id != build_id:
+                raise StoreReplacedError(f"Feature store '{path}' was replaced (build {store.build_id}, expected {build_id})")
+            _opened_stores.clear()
+            _opened_stores[(path, build_id)] = store
+        return store
+
+def _init_process_worker(cv2_threads):
+    cv2.setNumThreads(cv2_threads)
+
+def count_good_matches(task):
+    """
+    Ratio-test matches one reference against one or more queries.
+
+    Args:
+        task (tuple): (store_path, build_id, ref_idx, des_queries) where des_queries
+            is a list of descriptor arrays, matched against the reference in one call.
+
+    Returns:
+        np.ndarray: Good-match count for each query.
+    """
+    path, build_id, ref_idx, des_queries = task
+    des_ref = _get_store(path, build_id)[ref_idx]['descriptors']
+    counts = np.zeros(len(des_queries), dtype=np.int64)
+    if des_ref is None or len(des_ref) < 2:
+        return counts
+    try:
+        rows, distances = hamming_knn(np.vstack(des_queries), np.asarray(des_ref), 2)
+    except cv2.error:
+        return counts
+    good = (rows[:, 1] >= 0) & (distances[:, 0] < config.MATCHER_THRESHOLD * distances[:, 1])
+    query_of_row = np.repeat(np.arange(len(des_queries)), [len(des) for des in des_queries])
+    return np.bincount(query_of_row[good], minlength=len(des_queries))
+
+def _fit_homography(ref, des_query, points_query):
+    """
+    Ratio-test matches a query against one reference and fits a RANSAC
+    homography from reference to query keypoints.
+
+    Returns:
+        tuple: (homography or None, ratio-test matches, inlier mask or None)
+    """
+    des_ref, points_ref = ref['descriptors'], ref['keypoints']
+    if len(des_ref) < 2 or np.isnan(points_ref[0, 0]):
+        return None, [], None
+    try:
+        matches = _matcher.knnMatch(des_query, np.asarray(des_ref), k=2)
+    except cv2.error:
+        return None, [], None
+    good = [pair[0] for pair in matches
+            if len(pair) == 2 and pair[0].distance < config.MATCHER_THRESHOLD * pair[1].distance]
+    if len(good) < 4:  # A homography needs four correspondences
+        return None, good, None
+    src = np.asarray(points_ref)[[m.trainIdx for m in good]]
+    dst = points_query[[m.queryIdx for m in good]]
+    homography, mask = cv2.findHomography(src, dst, cv2.RANSAC, config.RANSAC_REPROJECTION_THRESHOLD)
+    return homography, good, mask
+
+def count_inliers(task):
+    """
+    Geometric verification of one reference: ratio-test matches that agree
+    with a RANSAC homography from reference to query keypoints.
+
+    Args:
+        task (tuple): (store_path, build_id, ref_idx, des_query, points_query) where
+            points_query holds the x/y coordinates of each query descriptor.
+
+    Returns:
+        int: Inlier count (0 if the reference has no stored keypoints or no homography is found).
+    """
+    path, build_id, ref_idx, des_query, points_query = task
+    _, _, mask = _fit_homography(_get_store(path, build_id)[ref_idx], des_query, points_query)
+    return int(mask.sum()) if mask is not None else 0
+
+def locate_reference(task):
+    """
+    Finds where one reference appears in a query (see count_inliers).
+
+    Returns:
+        tuple: (query indexes of the inliers, (4, 2) corners in query coordinates of the
+                box around the reference's keypoints mapped by the homography), or
+               (empty array, None) if no homography is found.
+    """
+    path, build_id, ref_idx, des_query, points_query = task
+    ref = _get_store(path, build_id)[ref_idx]
+    homography, good, mask = _fit_homography(ref, des_query, points_query)
+    if homography is None:
+        return np.zeros(0, dtype=np.int64), None
+    inliers = np.array([m.queryIdx for m, keep in zip(good, mask.ravel()) if keep], dtype=np.int64)
+    points_ref = np.asarray(ref['keypoints'])
+    (x0, y0), (x1, y1) = points_ref.min(axis=0), points_ref.max(axis=0)
+    corners = np.float32([[x0, y0], [x1, y0], [x1, y1], [x0, y1]]).reshape(-1, 1, 2)
+    return inliers, cv2.perspectiveTransform(corners, homography).reshape(4, 2)
+
+def knn_block(task):
+    """
+    Exact 2-NN search of the query descriptors within one row block of the
+    stacked reference matrix.
+
+    Args:
+        task (tuple): (store_path, build_id, des_query, start, stop)
+
+    Returns:
+        tuple: (rows, distances) of shape (n_query, 2); rows index the full matrix,
+               missing neighbours are marked with row -1.
+    """
+    path, build_id, des_query, start, stop = task
+    block = np.asarray(_get_store(path, build_id).descriptors[start:stop])
+    return hamming_knn(des_query, block, 2, offset=start)
+
+# --- Backends ---
+
+class InlineEngine:
+    """
+    Runs tasks one after another in the calling thread. OpenCV gets the whole
+    budget for its internal threads, so only one request matches at a time.
+    """
+    kind = 'inline'
+
+    def __init__(self, budget=None):
+        self.budget = budget or process_budget()
+        self.workers = 1
+        self.cv2_threads = self.budget
+        self._gate = threading.Lock()
+        cv2.setNumThreads(self.cv2_threads)
+
+    def map(self, fn, items):
+        with self._gate:
+            return [fn(item) for item in items]
+
+    def map_local(self, fn, items):
+        """Runs work that needs this process's state (e.g. the ORB detector)."""
+        return self.map(fn, items)
+
+    def shutdown(self):
+        pass
+
+class ThreadEngine:
+    """
+    Fans tasks out over one thread pool shared by all requests in the process.
+    OpenCV releases the GIL inside matching, so the threads run in parallel.
+    """
+    kind = 'threads'
+
+    def __init__(self, budget=None):
+        self.budget = budget or process_budget()
+        self.workers = max(1, min(config.NUM_WORKERS, self.budget))
+        self.cv2_threads = max(1, self.budget // self.workers)
+        cv2.setNumThreads(self.cv2_threads)
+        self.pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='matching')
+
+    def map(self, fn, items):
+        return list(self.pool.map(fn, items))
+
+    def map_local(self, fn, items):
+        return self.map(fn, items)
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False)
+
+class ProcessEngine:
+    """
+    Fans tasks out over a process pool whose workers memory-map the feature
+    store, so Python-level work in the tasks is not serialised by the GIL.
+    Workers are spawned rather than forked, as the parent is multi-threaded.
+    Tasks in the workers and local work in this process take slots from one
+    semaphore, so together they keep to the budget.
+    """
+    kind = 'processes'
+
+    def __init__(self, budget=None):
+        self.budget = budget or process_budget()
+        self.workers = max(1, min(config.NUM_WORKERS, self.budget))
+        self.cv2_threads = max(1, self.budget // self.workers)
+        cv2.setNumThreads(self.cv2_threads)
+        self.pool = ProcessPoolExecutor(max_workers=self.workers,
+                                        mp_context=multiprocessing.get_context('spawn'),
+                                        initializer=_init_process_worker,
+                                        initargs=(self.cv2_threads,))
+        self.local_pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='matching')
+        self._slots = threading.BoundedSemaphore(self.workers)
+
+    def _run(self, pool, fn, items):
+        futures = []
+        for item in items:
+            self._slots.acquire()
+            try:
+                future = pool.submit(fn, item)
+            except Exception:
+                self._slots.release()
+                raise
+            future.add_done_callback(lambda _: self._slots.release())
+            futures.append(future)
+        return [future.result() for future in futures]
+
+    def map(self, fn, items):
+        return self._run(self.pool, fn, items)
+
+    def map_local(self, fn, items):
+        return self._run(self.local_pool, fn, items)
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False)
+        self.local_pool.shutdown(wait=False)
+
+ENGINE_TYPES = {
+    InlineEngine.kind: InlineEngine,
+    ThreadEngine.kind: ThreadEngine,
+    ProcessEngine.kind: ProcessEngine,
+}
+
+def create_engine(backend=None, budget=None):
+    """
+    Creates the matching engine selected by config.MATCHING_BACKEND.
+    """
+    backend = backend or config.MATCHING_BACKEND
+    if backend not in ENGINE_TYPES:
+        raise ValueError(f"Unknown MATCHING_BACKEND '{backend}'. Choose from {sorted(ENGINE_TYPES)}.")
+    return ENGINE_TYPES[backend](budget)
+
+def knn_sharded(engine, store, des_query):
+    """
+    Exact 2-NN search of the whole stacked reference matrix, split into row
+    blocks run as engine tasks and merged.
+
+    Returns:
+        tuple: (rows, distances) of shape (n_query, 2), as from ann_index.
+    """
+    n_rows = len(store.descriptors)
+    n_blocks = max(engine.workers, -(-n_rows // STACKED_BLOCK_ROWS))
+    bounds = np.linspace(0, n_rows, n_blocks + 1).astype(np.int64)
+    tasks = [(store.path, store.build_id, des_query, int(start), int(stop))
+             for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+    results = engine.map(knn_block, tasks)
+    rows = np.hstack([block_rows for block_rows, _ in results])
+    distances = np.hstack([block_distances for _, block_distances in results])
+    nearest = np.argsort(distances, axis=1, kind='stable')[:, :2]
+    return np.take_along_axis(rows, nearest, axis=1), np.take_along_axis(distances, nearest, axis=1)
+
+# --- Throughput benchmark: python src/matching_engine.py [num_queries] [concurrency] ---
+if __name__ == "__main__":
+    import time
+    import random
+    import identification
+
+    num_queries = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    if not identification.INITIALIZATION_SUCCESSFUL:
+        sys.exit(1)
+
+    image_files = sorted(name for name in os.listdir(config.IMAGE_DOWNLOAD_DIR) if not name.startswith('.'))
+    queries = []
+    for name in random.Random(0).sample(image_files, min(num_queries, len(image_files))):
+        img = cv2.imread(os.path.join(config.IMAGE_DOWNLOAD_DIR, name), cv2.IMREAD_GRAYSCALE)
+        if img is None:
+            continue
+        # Mild rotation and scale change so queries are not bit-identical to the references
+        h, w = img.shape
+        img = cv2.warpAffine(img, cv2.getRotationMatrix2D((w / 2, h / 2), 10, 0.8), (w, h), borderValue=255)
+        queries.append((os.path.splitext(name)[0], identification.extract_query_features(img)))
+
+    def timed_match(query):
+        start = time.perf_counter()
+        points_query, des_query = query[1]
+        bottle_id, _, _ = identification.match_descriptors(des_query, points_query)
+        return str(bottle_id) == query[0], time.perf_counter() - start
+
+    print(f"{len(queries)} queries, {concurrency} concurrent clients, MATCHER_ENGINE='{config.MATCHER_ENGINE}', "
+          f"budget {process_budget()} CPU thread(s) per process")
+    for backend in ENGINE_TYPES:
+        identification.engine.shutdown()
+        identification.engine = create_engine(backend)
+        identification.match_descriptors(queries[0][1][1])  # Warm up (process pool start-up, page cache)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as clients:
+            results = list(clients.map(timed_match, queries))
+        elapsed = time.perf_counter() - start
+        latencies = np.array([latency for _, latency in results]) * 1000
+        print(f"  {backend:<10} {identification.engine.workers} x {identification.engine.cv2_threads} threads: "
+              f"{len(queries) / elapsed:6.2f} queries/s, latency p50 {np.percentile(latencies, 50):7.1f} ms, "
+              f"p95 {np.percentile(latencies, 95):7.1f} ms, correct {sum(ok for ok, _ in results)}/{len(results)}")
+    identification.engine.shutdown()
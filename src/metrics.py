@@ -0,0 +1,180 @@
+# src/metrics.py
+
+import sys
+import bisect
+import threading
+
+# Import configuration variables
+try:
+    import config
+except ModuleNotFoundError:
+    print("Error: config.py not found. Make sure it's in the 'src' directory.")
+    sys.exit(1)
+
+# Minimal in-process metrics rendered in the Prometheus text exposition format, so the
+# hot path costs a lock and a few additions rather than a client library. Every gunicorn
+# worker keeps its own values; scrape each worker, or sum them, for service totals.
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.label_names):
+            raise ValueError(f"Metric '{self.name}' takes labels {self.label_names}, got {sorted(labels)}")
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        lines += self._sample_lines()
+        return lines
+
+class Counter(_Metric):
+    """Monotonically increasing count, optionally per label combination."""
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _sample_lines(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}" for key, value in values]
+
+class Gauge(_Metric):
+    """
+    Value that goes up and down. With a callback, the value is read from it at
+    scrape time; the callback returns a number, or a {label values tuple: number} dict.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, label_names=(), callback=None):
+        super().__init__(name, help_text, label_names)
+        self.callback = callback
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def _sample_lines(self):
+        if self.callback is not None:
+            try:
+                values = self.callback()
+            except Exception as e:
+                print(f"Warning: Could not collect metric '{self.name}': {e}")
+                return []
+            if not isinstance(values, dict):
+                values = {(): values}
+        else:
+            with self._lock:
+                values = dict(self._values)
+        return [f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}"
+                for key, value in sorted(values.items()) if value is not None]
+
+class CallbackCounter(Gauge):
+    """Counter whose value is read at scrape time from counts kept elsewhere (e.g. a cache)."""
+    kind = 'counter'
+
+class Histogram(_Metric):
+    """Cumulative histogram of observed values (seconds, by convention)."""
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, label_names=(), buckets=None):
+        super().__init__(name, help_text, label_names)
+        self.buckets = tuple(sorted(buckets or config.METRICS_LATENCY_BUCKETS))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        slot = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(key, (None, 0.0))
+            if counts is None:
+                counts = [0] * (len(self.buckets) + 1)
+            counts[slot] += 1
+            self._values[key] = (counts, total + value)
+
+    def _sample_lines(self):
+        with self._lock:
+            values = sorted((key, (list(counts), total)) for key, (counts, total) in self._values.items())
+        lines = []
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                labels = _format_labels(self.label_names, key, [('le', _format_value(bound))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {total!r}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {cumulative}")
+        return lines
+
+class Registry:
+    """Holds metrics in registration order and renders them for /metrics."""
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if any(existing.name == metric.name for existing in self._metrics):
+                raise ValueError(f"Metric '{metric.name}' is already registered")
+            self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines += metric.render()
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+def counter(name, help_text, label_names=()):
+    return REGISTRY.register(Counter(name, help_text, label_names))
+
+def gauge(name, help_text, label_names=(), callback=None):
+    return REGISTRY.register(Gauge(name, help_text, label_names, callback))
+
+def callback_counter(name, help_text, callback, label_names=()):
+    return REGISTRY.register(CallbackCounter(name, help_text, label_names, callback))
+
+def histogram(name, help_text, label_names=(), buckets=None):
+    return REGISTRY.register(Histogram(name, help_text, label_names, buckets))
+
+def server_timing_header(timings):
+    """Formats stage durations in ms as a Server-Timing header value (e.g. 'decode;dur=3.1, match;dur=40')."""
+    return ', '.join(f"{stage};dur={duration_ms}" for stage, duration_ms in timings.items())
@@ -0,0 +1,129 @@
+# src/result_cache.py
+
+import sys
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+import cv2
+
+# Import configuration variables
+try:
+    import config
+except ModuleNotFoundError:
+    print("Error: config.py not found. Make sure it's in the 'src' directory.")
+    sys.exit(1)
+
+# Number of set bits for every possible byte value
+POPCOUNT_TABLE = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1).astype(np.uint16)
+DHASH_SIZE = 16  # 16x16 gradient bits = 256-bit hash; 8x8 collides too easily on plain product shots
+THUMBNAIL_SIZE = 32  # Side of the grayscale thumbnail used to confirm perceptual-hash hits
+
+def content_key(image_bytes):
+    """Exact key: hash of the encoded image bytes."""
+    return hashlib.blake2b(image_bytes, digest_size=16).hexdigest()
+
+def perceptual_signature(gray_image):
+    """
+    Returns (dhash, thumbnail) for a grayscale image.
+
+    The difference hash is the sign of horizontal gradients on a
+    DHASH_SIZE x DHASH_SIZE thumbnail, packed into bytes; re-encoded, resized
+    or recompressed copies land within a few bits. Bottle shots on plain
+    backgrounds share silhouettes, so a hash match is confirmed against a small
+    grayscale thumbnail before it counts.
+    """
+    gradients = cv2.resize(gray_image, (DHASH_SIZE + 1, DHASH_SIZE), interpolation=cv2.INTER_AREA)
+    dhash = np.packbits(gradients[:, 1:] > gradients[:, :-1])
+    thumbnail = cv2.resize(gray_image, (THUMBNAIL_SIZE, THUMBNAIL_SIZE), interpolation=cv2.INTER_AREA)
+    return dhash, thumbnail.astype(np.int16)
+
+class ResultCache:
+    """
+    Bounded LRU + TTL cache of identification results.
+
+    Entries are found by exact content key first, then by perceptual hash
+    within hamming_tolerance bits, confirmed by a mean thumbnail pixel
+    difference of at most max_pixel_diff. The cache is tied to a feature store
+    build: set_version() with a different build ID empties it.
+    """
+
+    def __init__(self, max_entries=None, ttl_seconds=None, hamming_tolerance=None, max_pixel_diff=None):
+        self.max_entries = config.RESULT_CACHE_SIZE if max_entries is None else max_entries
+        self.ttl_seconds = config.RESULT_CACHE_TTL if ttl_seconds is None else ttl_seconds
+        self.hamming_tolerance = config.RESULT_CACHE_HAMMING_TOLERANCE if hamming_tolerance is None else hamming_tolerance
+        self.max_pixel_diff = config.RESULT_CACHE_MAX_PIXEL_DIFF if max_pixel_diff is None else max_pixel_diff
+        self.version = None
+        self._entries = OrderedDict()  # content key -> (perceptual signature, result, stored_at)
+        self._lock = threading.Lock()
+        self.counters = {'exact_hits': 0, 'perceptual_hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+    def set_version(self, version):
+        """Ties the cache to a feature store build; results from other builds are dropped."""
+        with self._lock:
+            if version != self.version:
+                if self._entries:
+                    self.counters['invalidations'] += 1
+                self._entries.clear()
+                self.version = version
+
+    def _expired(self, stored_at, now):
+        return self.ttl_seconds > 0 and now - stored_at > self.ttl_seconds
+
+    def get_exact(self, key):
+        """Returns the cached result for identical bytes, or None."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if self._expired(entry[2], now):
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            self.counters['exact_hits'] += 1
+            return entry[1]
+
+    def get_similar(self, signature):
+        """
+        Returns the result of the closest cached image within the Hamming
+        tolerance whose thumbnail also agrees, or None (counted as a miss).
+        """
+        dhash, thumbnail = signature
+        now = time.monotonic()
+        with self._lock:
+            best_key, best_distance = None, self.hamming_tolerance + 1
+            for key, ((cached_hash, cached_thumbnail), _, stored_at) in self._entries.items():
+                if self._expired(stored_at, now):
+                    continue
+                distance = int(POPCOUNT_TABLE[np.bitwise_xor(cached_hash, dhash)].sum())
+                if distance < best_distance and np.abs(cached_thumbnail - thumbnail).mean() <= self.max_pixel_diff:
+                    best_key, best_distance = key, distance
+            if best_key is None:
+                self.counters['misses'] += 1
+                return None
+            self._entries.move_to_end(best_key)
+            self.counters['perceptual_hits'] += 1
+            return self._entries[best_key][1]
+
+    def put(self, key, signature, result, version=None):
+        """Stores a result; one computed against another build (version) than the current is dropped."""
+        with self._lock:
+            if version is not None and version != self.version:
+                return
+            self._entries[key] = (signature, result, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.counters['evictions'] += 1
+
+    def stats(self):
+        """Hit/miss counters plus current size, for monitoring."""
+        with self._lock:
+            stats = dict(self.counters)
+            stats['size'] = len(self._entries)
+            stats['version'] = self.version
+        lookups = stats['exact_hits'] + stats['perceptual_hits'] + stats['misses']
+        stats['hit_rate'] = (stats['exact_hits'] + stats['perceptual_hits']) / lookups if lookups else 0.0
+        return stats
@@ -0,0 +1,229 @@
+# src/shard_server.py
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+import socketserver
+import http.client
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Import configuration variables
+try:
+    import config
+except ModuleNotFoundError:
+    print("Error: config.py not found. Make sure it's in the 'src' directory.")
+    sys.exit(1)
+
+import sharding
+from benchmark import apply_overrides
+
+# Matcher process for one shard of a split catalogue (data_preparation.py --shards N).
+# It points config at the shard's files and then loads them through identification.py,
+# exactly as a web worker loads the full catalogue, so the shard matches with the same
+# engine, early termination, geometric verification and catalogue watcher. Web workers
+# reach it with sharding.ShardClient.
+#
+#   python src/shard_server.py                  start a server for every shard on this host
+#   python src/shard_server.py --shard 0 --listen 127.0.0.1:8700
+#   python src/shard_server.py --set MATCHER_ENGINE=per_reference   (passed on to every shard)
+
+identification = None  # Imported by serve(), once config names the shard's files
+
+def score(des_queries, points_queries):
+    """
+    Scores queries against this shard: one query with the configured engine
+    (early termination included), several in one batch pass as identify_batch does.
+
+    Returns:
+        tuple: (catalogue the scores refer to, answer per query, see sharding.top_candidates)
+    """
+    catalogue = identification.current_catalogue()
+    if len(des_queries) == 1:
+        catalogue, scores, n_matched = identification.score_query(des_queries[0], points_queries[0], catalogue)
+        scored = [(scores, n_matched)]
+    else:
+        scored = []
+        for des_query, points_query, votes in zip(des_queries, points_queries,
+                                                  identification.match_batch(catalogue, des_queries)):
+            if config.GEOMETRIC_VERIFICATION and points_query is not None:
+                votes = identification.verify_candidates(catalogue, votes, des_query, points_query)
+            scored.append((votes, len(des_query)))
+    return catalogue, [sharding.top_candidates(catalogue.ids, scores, n_matched) for scores, n_matched in scored]
+
+class ShardRequestHandler(BaseHTTPRequestHandler):
+    """POST /match scores queries (see sharding.py for the format); GET /health describes the shard."""
+
+    def do_GET(self):
+        if self.path != '/health':
+            return self._send_json(404, {'error': 'Not found'})
+        catalogue = identification.current_catalogue()
+        self._send_json(200, {'shard': catalogue.features.shard, 'build_id': catalogue.build_id,
+                              'bottles': len(catalogue), 'descriptors': len(catalogue.descriptors)})
+
+    def do_POST(self):
+        if self.path != '/match':
+            return self._send_json(404, {'error': 'Not found'})
+        try:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            des_queries, points_queries = sharding.decode_queries(body)
+        except (ValueError, OSError, KeyError) as e:
+            return self._send_json(400, {'error': f'Invalid query: {e}'})
+        try:
+            catalogue, results = score(des_queries, points_queries)
+        except Exception as e:
+            print(f"Error: Shard matching failed: {e}")
+            return self._send_json(500, {'error': str(e)})
+        self._send_json(200, {'build_id': catalogue.build_id,
+                              'catalogue_build_id': (catalogue.features.shard or {}).get('catalogue_build_id'),
+                              'results': results})
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        try:
+            self.end_headers()
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # The web worker stopped waiting (SHARD_TIMEOUT) and answered without this shard
+
+    def log_message(self, format, *args):
+        pass  # A line per query would bury the shard's own messages
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def make_server(listen):
+    """HTTP server on 'unix:/path/to/socket' or 'host:port'."""
+    if listen.startswith('unix:'):
+        socket_path = listen[len('unix:'):]
+        os.makedirs(os.path.dirname(socket_path) or '.', exist_ok=True)
+        if os.path.exists(socket_path):
+            os.remove(socket_path)  # Left behind by a previous run
+        return UnixHTTPServer(socket_path, ShardRequestHandler)
+    host, _, port = listen.split('://', 1)[-1].rpartition(':')
+    return ThreadingHTTPServer((host or '127.0.0.1', int(port)), ShardRequestHandler)
+
+def serve(index, listen, cpus=None):
+    """Loads shard index and answers queries on listen until interrupted."""
+    global identification
+    config.FEATURES_FILE = sharding.shard_path(config.FEATURES_FILE, index)
+    config.ANN_INDEX_FILE = sharding.shard_path(config.ANN_INDEX_FILE, index)
+    config.VOCABULARY_FILE = sharding.shard_path(config.VOCABULARY_FILE, index)
+    config.SHARD_ADDRESSES = []          # This process is a shard: match locally
+    config.RESULT_CACHE_ENABLED = False  # Web workers cache the merged results
+    if cpus:
+        config.CPU_BUDGET, config.WEB_WORKERS = cpus, 1
+
+    import identification as shard_identification
+    identification = shard_identification
+    if not identification.INITIALIZATION_SUCCESSFUL:
+        print(f"Error: Shard {index} could not be loaded from '{config.FEATURES_FILE}'.")
+        sys.exit(1)
+
+    server = make_server(listen)
+    print(f"Shard {index}: serving {len(identification.current_catalogue())} bottles on {listen}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if listen.startswith('unix:') and os.path.exists(listen[len('unix:'):]):
+            os.remove(listen[len('unix:'):])
+
+def wait_until_ready(address, process, timeout=120):
+    """Polls a starting shard's /health; returns False if it exits or isn't up within timeout."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline and process.poll() is None:
+        try:
+            sharding.request_shard(address, 'GET', '/health', timeout=1)
+            return True
+        except (OSError, http.client.HTTPException, sharding.ShardError, ValueError):
+            time.sleep(0.2)
+    return False
+
+def start_local_shards(cpus=None, overrides=()):
+    """
+    Starts one server process per shard file on Unix sockets in SHARD_SOCKET_DIR,
+    sharing CPU_BUDGET between them.
+
+    Args:
+        cpus (int): CPU threads per shard (default: CPU_BUDGET shared between shards).
+        overrides (list): NAME=VALUE config settings for every shard (see --set).
+
+    Returns:
+        dict: {address: process} of the started servers, all answering /health.
+
+    Raises:
+        ShardError: If there are no shard files or a server did not start (the others are stopped).
+    """
+    shards = sharding.shard_files(config.FEATURES_FILE)
+    if not shards:
+        raise sharding.ShardError(f"No shards of '{config.FEATURES_FILE}' found. Run data_preparation.py --shards N first.")
+    cpus = cpus or max(1, config.CPU_BUDGET // len(shards))
+    settings = [arg for assignment in overrides for arg in ('--set', assignment)]
+
+    processes = {}
+    for index in shards:
+        address = f"unix:{os.path.join(config.SHARD_SOCKET_DIR, f'shard-{index}.sock')}"
+        processes[address] = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--shard', str(index),
+                                               '--listen', address, '--cpus', str(cpus)] + settings)
+    for address, process in processes.items():
+        if not wait_until_ready(address, process):
+            stop_shards(processes)
+            raise sharding.ShardError(f"Shard server {address} did not start.")
+    return processes
+
+def stop_shards(processes):
+    """Terminates shard server processes started by start_local_shards and waits for them."""
+    for process in processes.values():
+        if process.poll() is None:
+            process.terminate()
+    for process in processes.values():
+        process.wait()
+
+def run_local_shards(cpus=None, overrides=()):
+    """
+    Starts a server for every shard (see start_local_shards) and prints the
+    SHARD_ADDRESSES to start the web app with. Stops them all on Ctrl-C or
+    when one exits.
+    """
+    try:
+        processes = start_local_shards(cpus, overrides)
+    except sharding.ShardError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    try:
+        print(f"\n{len(processes)} shard server(s) ready. Start the web app with:")
+        print(f"  SHARD_ADDRESSES={','.join(processes)} gunicorn --preload app:app")
+        while all(process.poll() is None for process in processes.values()):
+            time.sleep(1)
+        print("Error: A shard server exited; stopping the others.")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_shards(processes)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve shards of a split catalogue to the web workers.")
+    parser.add_argument('--shard', type=int, help="Serve only this shard (default: start a process for every shard)")
+    parser.add_argument('--listen', help="'unix:/path/to/socket' or 'host:port' (with --shard)")
+    parser.add_argument('--cpus', type=int, help="CPU threads per shard (default: CPU_BUDGET shared between shards)")
+    parser.add_argument('--set', dest='overrides', action='append', default=[], metavar='NAME=VALUE',
+                        help="Override a config.py setting, e.g. --set MATCHER_ENGINE=per_reference (repeatable)")
+    args = parser.parse_args()
+    try:
+        apply_overrides(args.overrides)  # Before serve() derives the shard's file names from them
+    except ValueError as e:
+        parser.error(str(e))
+
+    if args.shard is None:
+        run_local_shards(args.cpus, args.overrides)
+    else:
+        serve(args.shard, args.listen or f"unix:{os.path.join(config.SHARD_SOCKET_DIR, f'shard-{args.shard}.sock')}",
+              args.cpus)
@@ -0,0 +1,212 @@
+# src/sharding.py
+
+import io
+import os
+import sys
+import glob
+import json
+import socket
+import threading
+import http.client
+from concurrent.futures import ThreadPoolExecutor, wait
+import numpy as np
+
+# Import configuration variables
+try:
+    import config
+except ModuleNotFoundError:
+    print("Error: config.py not found. Make sure it's in the 'src' directory.")
+    sys.exit(1)
+
+# A split catalogue is a set of shard stores next to the full feature store, written by
+# data_preparation.py --shards N. Each is a complete feature store of its own, with its own
+# descriptor index and bottle signatures, holding every N-th bottle. shard_server.py serves
+# one shard per process; web workers send each query to all of them at once (ShardClient)
+# and merge the best candidates they return, so no process has to hold or scan the
+# whole catalogue.
+#
+# Each shard applies the ratio test against its own references only. The 'shortlist' and
+# 'per_reference' engines ratio-test within each bottle, so a bottle scores the same as
+# unsharded (each shard shortlists among its own bottles, which only widens the shortlist).
+# The 'stacked' engine ratio-tests against the nearest descriptors of any bottle: a query
+# descriptor whose two nearest neighbours are in different shards (near-duplicate artwork
+# across bottles) passes in each shard, where the whole catalogue would reject it, so
+# bottles sharing such descriptors may score higher than unsharded. Early termination
+# likewise stops each shard on its own leader.
+
+class ShardError(RuntimeError):
+    """A shard server could not be reached or answered with an error."""
+
+class ShardUnavailableError(ShardError):
+    """No shard answered a query in time."""
+
+# --- Shard files ---
+def shard_path(path, index):
+    """File of one shard for a catalogue file, e.g. bottle_features.shard0.store."""
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard{index}{ext}"
+
+def shard_files(path):
+    """Existing shard files of a catalogue file, as {shard index: path} in index order."""
+    root, ext = os.path.splitext(path)
+    found = {}
+    for candidate in glob.glob(f"{glob.escape(root)}.shard*{ext}"):
+        index = candidate[len(root) + len('.shard'):len(candidate) - len(ext)]
+        if index.isdigit():
+            found[int(index)] = candidate
+    return dict(sorted(found.items()))
+
+def partition(n_references, count):
+    """
+    Reference indexes of each shard: round-robin over the catalogue, so shards get
+    the same number of bottles (to within one) and similar descriptor counts.
+    """
+    return [list(range(index, n_references, count)) for index in range(count)]
+
+# --- Wire format ---
+# POST /match carries an .npz body with des{i} (uint8 descriptors) and, for geometric
+# verification, points{i} (float32 x/y keypoint coordinates) for each query i. The shard
+# answers with JSON: its build IDs and, per query, the 'ids' and 'scores' of its
+# SHARD_TOP_K best references and 'n_matched', the query descriptors the scores cover.
+
+def encode_queries(des_queries, points_queries):
+    arrays = {}
+    for i, (des_query, points_query) in enumerate(zip(des_queries, points_queries)):
+        arrays[f'des{i}'] = np.ascontiguousarray(des_query, dtype=np.uint8)
+        if points_query is not None:
+            arrays[f'points{i}'] = np.ascontiguousarray(points_query, dtype=np.float32)
+    buffer = io.BytesIO()
+    np.savez(buffer, **arrays)
+    return buffer.getvalue()
+
+def decode_queries(body):
+    """Returns (des_queries, points_queries) from a /match request body; points may be None."""
+    with np.load(io.BytesIO(body), allow_pickle=False) as data:
+        count = sum(1 for name in data.files if name.startswith('des'))
+        des_queries = [data[f'des{i}'] for i in range(count)]
+        points_queries = [data[f'points{i}'] if f'points{i}' in data.files else None for i in range(count)]
+    return des_queries, points_queries
+
+def top_candidates(ids, scores, n_matched, k=None):
+    """A shard's answer for one query: its k best references with a non-zero score."""
+    k = k or config.SHARD_TOP_K
+    best = [int(idx) for idx in np.argsort(-scores, kind='stable')[:k] if scores[idx] > 0]
+    return {'ids': [ids[idx] for idx in best], 'scores': [int(scores[idx]) for idx in best],
+            'n_matched': int(n_matched)}
+
+class ShardScores:
+    """
+    One query's candidates merged from every shard that answered. Has .ids like a
+    catalogue, so identification.best_from_votes can pick the winner from .scores.
+    Scores are per shard as they came (see the ratio test note above), not re-ranked.
+    """
+
+    def __init__(self, answers):
+        self.ids = [bottle_id for answer in answers for bottle_id in answer['ids']]
+        self.scores = np.array([score for answer in answers for score in answer['scores']], dtype=np.int64)
+        self.n_matched = max((answer['n_matched'] for answer in answers), default=0)
+
+# --- Client ---
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTP over a Unix socket, for shard servers on the same host."""
+
+    def __init__(self, socket_path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+def _connection(address, timeout):
+    if address.startswith('unix:'):
+        return UnixHTTPConnection(address[len('unix:'):], timeout)
+    return http.client.HTTPConnection(address.split('://', 1)[-1].rstrip('/'), timeout=timeout)
+
+def request_shard(address, method, path, body=None, timeout=None):
+    """
+    Sends one request to a shard server.
+
+    Args:
+        address (str): 'unix:/path/to/socket' or 'host:port'.
+
+    Returns:
+        dict: The decoded JSON answer.
+
+    Raises:
+        OSError: If the shard can't be reached or times out.
+        ShardError: If it answers with an error status.
+    """
+    connection = _connection(address, timeout or config.SHARD_TIMEOUT)
+    try:
+        headers = {'Content-Type': 'application/octet-stream'} if body is not None else {}
+        connection.request(method, path, body=body, headers=headers)
+        response = connection.getresponse()
+        payload = response.read()
+    except http.client.HTTPException as e:
+        raise ShardError(f"Shard {address}: {e}") from e
+    finally:
+        connection.close()
+    if response.status != 200:
+        raise ShardError(f"Shard {address} answered {response.status}: {payload[:200].decode('utf-8', 'replace')}")
+    return json.loads(payload)
+
+class ShardClient:
+    """
+    Scatter-gather over shard servers: every query goes to all shards at once, and
+    the candidates of those answering within timeout are merged. A shard that
+    fails or is late is left out of that answer and counted in stats().
+    """
+
+    def __init__(self, addresses=None, timeout=None):
+        self.addresses = list(addresses or config.SHARD_ADDRESSES)
+        self.timeout = timeout or config.SHARD_TIMEOUT
+        # Enough threads for every identification job of this worker to reach every shard
+        self._pool = ThreadPoolExecutor(max_workers=len(self.addresses) * config.IDENTIFY_WORKERS,
+                                        thread_name_prefix='shard')
+        self._lock = threading.Lock()
+        self.counters = {address: {'ok': 0, 'error': 0, 'timeout': 0} for address in self.addresses}
+        self.builds = {}  # address -> build ID of the catalogue the shard was split from, as last reported
+
+    def score_batch(self, des_queries, points_queries):
+        """
+        Scores queries against every shard.
+
+        Returns:
+            list: ShardScores for each query.
+
+        Raises:
+            ShardUnavailableError: If no shard answered in time.
+        """
+        body = encode_queries(des_queries, points_queries)
+        futures = {self._pool.submit(request_shard, address, 'POST', '/match', body, self.timeout): address
+                   for address in self.addresses}
+        done, _ = wait(futures, timeout=self.timeout)
+        answers = []
+        for future, address in futures.items():
+            error = future.exception() if future in done else None
+            if future not in done or isinstance(error, socket.timeout):
+                future.cancel()
+                outcome = 'timeout'
+                print(f"Warning: Shard {address} did not answer within {self.timeout}s; answering without it.")
+            elif error is not None:
+                outcome = 'error'
+                print(f"Warning: Shard {address} failed ({error}); answering without it.")
+            else:
+                outcome = 'ok'
+                answers.append(future.result())
+                self.builds[address] = answers[-1].get('catalogue_build_id')
+            with self._lock:
+                self.counters[address][outcome] += 1
+        if not answers:
+            raise ShardUnavailableError(f"None of the {len(self.addresses)} shard(s) answered.")
+        return [ShardScores([answer['results'][i] for answer in answers]) for i in range(len(des_queries))]
+
+    def stats(self):
+        with self._lock:
+            return {address: dict(counts, catalogue_build_id=self.builds.get(address))
+                    for address, counts in self.counters.items()}
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False)
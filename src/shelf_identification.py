@@ -0,0 +1,281 @@
+# src/shelf_identification.py
+
+import os
+import sys
+import math
+import time
+import argparse
+import threading
+from collections import Counter
+import numpy as np
+import cv2
+
+# Import configuration variables
+try:
+    import config
+except ModuleNotFoundError:
+    print("Error: config.py not found. Make sure it's in the 'src' directory.")
+    sys.exit(1)
+
+import feature_pipeline
+import identification
+from matching_engine import locate_reference
+
+# Shelf mode: one photo, many bottles. ORB runs once over the whole photo; its keypoints are
+# clustered into candidate bottle regions, and every region is identified from the keypoints
+# that fall inside it. All regions are matched together in one batched pass, and their
+# geometric checks fan out over the matching engine. Bottles standing close together can end
+# up in one region, so each region is matched again (up to SHELF_MAX_BOTTLES_PER_REGION times)
+# without the keypoints inside the bottles already found there.
+
+_detector = None
+_detector_lock = threading.Lock()
+
+def shelf_detector():
+    """ORB detector with the larger SHELF_N_FEATURES budget, created on first use."""
+    global _detector
+    with _detector_lock:
+        if _detector is None:
+            _detector = feature_pipeline.create_detector(config.SHELF_N_FEATURES)
+        return _detector
+
+def _split_columns(region, cell_x):
+    """
+    Splits a region where its column keypoint profile drops below
+    SHELF_SPLIT_FRACTION of its median column: bottles standing side by side
+    touch, but the gaps between their labels hold few keypoints.
+    """
+    columns = cell_x[region]
+    first = columns.min()
+    profile = np.bincount(columns - first)
+    busy = profile >= config.SHELF_SPLIT_FRACTION * np.median(profile[profile > 0])
+    # Runs of busy columns, as [start, stop) pairs
+    edges = np.flatnonzero(np.diff(np.concatenate([[0], busy.astype(np.int8), [0]])))
+    return [region[(columns >= first + start) & (columns < first + stop)]
+            for start, stop in zip(edges[::2], edges[1::2])]
+
+def segment_regions(points, image_shape):
+    """
+    Splits a shelf photo into candidate bottle regions by clustering its keypoints:
+    a keypoint density grid is thresholded at SHELF_DENSITY_THRESHOLD times its mean,
+    closed vertically (bottles are tall) and split into connected components, which
+    are then cut apart at sparse columns (see _split_columns).
+
+    Args:
+        points (np.ndarray): (n, 2) keypoint x/y coordinates.
+        image_shape (tuple): (height, width) of the image the keypoints were found in.
+
+    Returns:
+        list: Index arrays into points, one per region with at least
+              SHELF_MIN_REGION_KEYPOINTS keypoints.
+    """
+    height, width = image_shape[:2]
+    cell = max(height, width) / config.SHELF_GRID_CELLS
+    rows, cols = max(1, math.ceil(height / cell)), max(1, math.ceil(width / cell))
+    cell_y = np.minimum((points[:, 1] / cell).astype(np.int64), rows - 1)
+    cell_x = np.minimum((points[:, 0] / cell).astype(np.int64), cols - 1)
+
+    density = np.zeros((rows, cols), dtype=np.float32)
+    np.add.at(density, (cell_y, cell_x), 1)
+    density = cv2.GaussianBlur(density, (3, 3), 0)
+    mask = (density >= config.SHELF_DENSITY_THRESHOLD * density.mean()).astype(np.uint8)
+    mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, cv2.getStructuringElement(cv2.MORPH_RECT, (1, 5)))
+
+    n_labels, labels = cv2.connectedComponents(mask, connectivity=8)
+    point_labels = labels[cell_y, cell_x]
+    regions = []
+    for label in range(1, n_labels):
+        component = np.flatnonzero(point_labels == label)
+        if len(component) >= config.SHELF_MIN_REGION_KEYPOINTS:
+            regions += _split_columns(component, cell_x)
+    return [region for region in regions if len(region) >= config.SHELF_MIN_REGION_KEYPOINTS]
+
+def _box_from_corners(corners, points_inliers, image_shape):
+    """
+    Bounding box (x0, y0, x1, y1) of a located bottle: the reference outline mapped
+    into the photo, or the inliers' extent if that outline is implausible (folded,
+    or far larger than the inliers suggest). Clipped to the image.
+    """
+    height, width = image_shape[:2]
+    inlier_box = np.concatenate([points_inliers.min(axis=0), points_inliers.max(axis=0)])
+    box = inlier_box
+    if corners is not None and np.isfinite(corners).all() and cv2.isContourConvex(corners.astype(np.float32)):
+        outline = np.concatenate([corners.min(axis=0), corners.max(axis=0)])
+        outline_area = (outline[2] - outline[0]) * (outline[3] - outline[1])
+        inlier_area = max((inlier_box[2] - inlier_box[0]) * (inlier_box[3] - inlier_box[1]), 1.0)
+        if outline_area <= 16 * inlier_area:
+            box = outline
+    return np.clip(box, 0, [width, height, width, height])
+
+def _overlap(box, other):
+    """Intersection over the smaller of two (x0, y0, x1, y1) boxes."""
+    width = min(box[2], other[2]) - max(box[0], other[0])
+    height = min(box[3], other[3]) - max(box[1], other[1])
+    if width <= 0 or height <= 0:
+        return 0.0
+    smaller = min((box[2] - box[0]) * (box[3] - box[1]), (other[2] - other[0]) * (other[3] - other[1]))
+    return width * height / max(smaller, 1e-9)
+
+def identify_shelf_from_bytes(image_bytes, timings=None):
+    """
+    Identifies every bottle found in an encoded shelf photo.
+
+    Args:
+        image_bytes (bytes): Encoded image.
+        timings (dict): If given, receives the duration in ms of each stage: 'decode',
+            'preprocess', 'detect', 'segment', 'match' (batched over all regions)
+            and 'locate' (geometric verification).
+
+    Returns:
+        dict: 'bottles': one dict per bottle found, left to right, with 'id',
+              'score', 'matches_count' (RANSAC inliers) and 'box' ([x, y, width,
+              height] in pixels of the uploaded image); 'regions': number of
+              candidate regions; 'error': None, or why nothing could be matched.
+    """
+    catalogue = identification.current_catalogue()  # One catalogue for the whole photo (see reload_catalogue)
+    if not identification.INITIALIZATION_SUCCESSFUL or identification.engine is None or catalogue is None:
+        print("Error: Matcher not initialized successfully. Cannot perform matching.")
+        return {'bottles': [], 'regions': 0, 'error': 'Matcher not initialized.'}
+    if identification.shard_client is not None:
+        # Region matching and localisation need the reference keypoints in this process
+        return {'bottles': [], 'regions': 0, 'error': 'Shelf mode is not available with a sharded catalogue.'}
+
+    start = time.perf_counter()
+    try:
+        img = identification.decode_image(image_bytes, config.SHELF_MAX_IMAGE_SIZE)
+    except cv2.error as e:
+        img = None
+        print(f"Error: Could not decode shelf image: {e}")
+    identification._record_stage(timings, 'decode', start)
+    if img is None:
+        return {'bottles': [], 'regions': 0, 'error': 'Could not decode image.'}
+
+    # The pipeline bounds the longest side; boxes are reported in the uploaded image's pixels
+    points, des = feature_pipeline.extract(img, shelf_detector(), timings, config.SHELF_MAX_IMAGE_SIZE)
+    scale = min(1.0, config.SHELF_MAX_IMAGE_SIZE / max(img.shape[:2]))
+    shape = (max(1, round(img.shape[0] * scale)), max(1, round(img.shape[1] * scale)))
+    uploaded_size = identification.jpeg_dimensions(image_bytes)
+    to_upload = (max(uploaded_size) if uploaded_size else max(img.shape[:2])) / max(shape)
+    if des is None:
+        return {'bottles': [], 'regions': 0, 'error': None}
+
+    start = time.perf_counter()
+    regions = segment_regions(points, shape)
+    identification._record_stage(timings, 'segment', start)
+
+    # Except when shortlisting (which depends on the whole query), a descriptor's vote doesn't
+    # depend on the region it is matched with, so each keypoint is matched at most once and
+    # later rounds mostly recount votes
+    shortlisting = config.MATCHER_ENGINE == 'shortlist' and catalogue.vocabulary is not None
+    owners = np.full(len(des), -2, dtype=np.int64)  # Reference voted for, -1 for none, -2 not matched yet
+
+    store = catalogue.features
+    found = []  # (x0, y0, x1, y1) box, bottle ID, score, inliers
+    active = list(regions)
+    for _ in range(config.SHELF_MAX_BOTTLES_PER_REGION):
+        active = [region for region in active if len(region) >= config.SHELF_MIN_REGION_KEYPOINTS]
+        if not active or len(found) >= config.SHELF_MAX_BOTTLES:
+            break
+        # Keypoints are ordered strongest first, so each region is queried with its strongest ones
+        queries = [region[:config.SHELF_REGION_FEATURES] for region in active]
+
+        start = time.perf_counter()
+        if shortlisting:
+            votes = identification.match_batch(catalogue, [des[query] for query in queries])
+        else:
+            pending = np.concatenate(queries)
+            pending = pending[owners[pending] == -2]
+            if len(pending):
+                owners[pending] = identification.descriptor_owners(catalogue, des[pending])
+            votes = [np.bincount(owners[query][owners[query] >= 0], minlength=len(catalogue)) for query in queries]
+        identification._record_stage(timings, 'match', start)
+
+        # Locate the leading candidates of every region in one fan-out over the engine
+        start = time.perf_counter()
+        candidates = [[int(idx) for idx in np.argsort(-query_votes, kind='stable')[:config.GEOMETRIC_TOP_K]
+                       if query_votes[idx] >= config.MIN_MATCH_COUNT] for query_votes in votes]
+        tasks = [(store.path, store.build_id, idx, des[query], points[query])
+                 for query, query_candidates in zip(queries, candidates) for idx in query_candidates]
+        located = iter(identification.engine.map(locate_reference, tasks))
+        identification._record_stage(timings, 'locate', start)
+
+        next_active = []
+        for region, query, query_candidates in zip(active, queries, candidates):
+            results = {idx: next(located) for idx in query_candidates}
+            inliers = np.zeros(len(catalogue), dtype=np.int64)
+            for idx, (query_inliers, _) in results.items():
+                inliers[idx] = len(query_inliers)
+            bottle_id, score, matches_count = identification.best_from_votes(inliers, len(query), catalogue)
+            if bottle_id is None:
+                continue
+            query_inliers, corners = results[int(np.argmax(inliers))]
+            box = _box_from_corners(corners, points[query[query_inliers]], shape)
+            if not any(other_id == bottle_id and _overlap(box, other_box) > 0.5
+                       for other_box, other_id, _, _ in found):
+                found.append((box, bottle_id, score, matches_count))
+
+            # Match the rest of the region again, without the keypoints of the bottle just found
+            region_points = points[region]
+            outside = ((region_points[:, 0] < box[0]) | (region_points[:, 0] > box[2]) |
+                       (region_points[:, 1] < box[1]) | (region_points[:, 1] > box[3]))
+            outside[np.isin(region, query[query_inliers])] = False
+            next_active.append(region[outside])
+        active = next_active
+
+    bottles = [{
+        'id': bottle_id,
+        'score': score,
+        'matches_count': matches_count,
+        'box': [int(round(box[0] * to_upload)), int(round(box[1] * to_upload)),
+                int(round((box[2] - box[0]) * to_upload)), int(round((box[3] - box[1]) * to_upload))],
+    } for box, bottle_id, score, matches_count in sorted(found, key=lambda item: (item[0][0], item[0][1]))]
+    return {'bottles': bottles[:config.SHELF_MAX_BOTTLES], 'regions': len(regions), 'error': None}
+
+def count_bottles(bottles):
+    """Inventory count: (bottle ID, number of times found), most frequent first."""
+    return Counter(bottle['id'] for bottle in bottles).most_common()
+
+# --- Main Execution Block ---
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Identify every bottle in a shelf photo.")
+    parser.add_argument('image', help="Shelf photo to identify")
+    parser.add_argument('--output', help="Write a copy of the photo with the bottles outlined to this file")
+    args = parser.parse_args()
+
+    if not identification.INITIALIZATION_SUCCESSFUL:
+        print("\nExiting because matcher initialization failed. Please check previous errors.")
+        sys.exit(1)
+    if not os.path.exists(args.image):
+        print(f"Error: Shelf image '{args.image}' not found.")
+        sys.exit(1)
+
+    with open(args.image, 'rb') as f:
+        image_bytes = f.read()
+    timings = {}
+    start = time.perf_counter()
+    result = identify_shelf_from_bytes(image_bytes, timings)
+    elapsed = time.perf_counter() - start
+    if result['error']:
+        print(f"Error: {result['error']}")
+        sys.exit(1)
+
+    print(f"\n--- {len(result['bottles'])} bottle(s) in {result['regions']} region(s), {1000 * elapsed:.0f} ms ---")
+    print("  " + ", ".join(f"{stage} {duration:.0f} ms" for stage, duration in timings.items()))
+    for bottle in result['bottles']:
+        details = identification.get_bottle_details(bottle['id']) or {}
+        x, y, w, h = bottle['box']
+        print(f"  [{x:5d},{y:5d} {w:4d}x{h:<4d}] {bottle['id']}: {details.get(config.COL_NAME, '?')} "
+              f"({bottle['matches_count']} inliers, score {bottle['score']:.3f})")
+    print("\n--- Inventory ---")
+    for bottle_id, count in count_bottles(result['bottles']):
+        print(f"  {count} x {bottle_id}")
+
+    if args.output:
+        annotated = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+        for bottle in result['bottles']:
+            x, y, w, h = bottle['box']
+            cv2.rectangle(annotated, (x, y), (x + w, y + h), (0, 255, 0), 3)
+            cv2.putText(annotated, str(bottle['id']), (x + 5, y + 30), cv2.FONT_HERSHEY_SIMPLEX, 1.0,
+                        (0, 255, 0), 2, cv2.LINE_AA)
+        cv2.imwrite(args.output, annotated)
+        print(f"\nAnnotated photo written to '{args.output}'.")
@@ -1,15 +1,16 @@
 # src/webcam_identify.py
 
 import cv2
-import os
 import time
 import sys
-import pandas as pd # Import pandas for type hinting if needed
+import argparse
+import threading
+from collections import deque, Counter
 
 # Try to import the matching function and config
 try:
     # Import the necessary functions and the initialization status flag
-    from identification import find_best_match, get_bottle_details, INITIALIZATION_SUCCESSFUL
+    from identification import find_best_match_from_array, get_bottle_details, INITIALIZATION_SUCCESSFUL
     import config
 except ModuleNotFoundError:
     print("Error: Could not import from 'identification.py' or 'config.py'.")
@@ -22,107 +23,322 @@ except ImportError as e:
 
 # --- Configuration ---
 WEBCAM_INDEX = 0
-TEMP_CAPTURE_FILENAME = "_temp_capture.jpg"
+RESULT_DISPLAY_SECONDS = 5.0  # How long a single-shot result stays on the preview
+
+# --- Live Recognition ---
+# The capture/display loop never matches itself: frames that pass a cheap motion and focus
+# gate are handed to a background thread, which only ever takes the newest one and at most
+# LIVE_MAX_RECOGNITIONS_PER_SECOND of them. In continuous mode a bottle is reported once
+# LIVE_VOTES_TO_CONFIRM of the last LIVE_VOTE_WINDOW recognitions agree on it.
+
+class FrameGate:
+    """
+    Decides whether a frame is worth matching: the view has stopped moving
+    (small mean change from the previous frame) and is in focus (variance of
+    the Laplacian), both measured on a small grayscale copy.
+    """
+
+    def __init__(self, width=None, motion_threshold=None, sharpness_threshold=None):
+        self.width = width or config.LIVE_GATE_WIDTH
+        self.motion_threshold = config.LIVE_MOTION_THRESHOLD if motion_threshold is None else motion_threshold
+        self.sharpness_threshold = config.LIVE_SHARPNESS_THRESHOLD if sharpness_threshold is None else sharpness_threshold
+        self.motion = float('inf')
+        self.sharpness = 0.0
+        self._previous = None
+
+    def check(self, frame):
+        """Measures a frame (BGR or grayscale); True if it is steady and sharp."""
+        height, width = frame.shape[:2]
+        if width > self.width:
+            frame = cv2.resize(frame, (self.width, max(1, round(height * self.width / width))),
+                               interpolation=cv2.INTER_AREA)
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+        if self._previous is not None and self._previous.shape == gray.shape:
+            self.motion = float(cv2.absdiff(gray, self._previous).mean())
+        else:
+            self.motion = float('inf')
+        self._previous = gray
+        self.sharpness = float(cv2.Laplacian(gray, cv2.CV_32F).var())
+        return self.motion <= self.motion_threshold and self.sharpness >= self.sharpness_threshold
+
+class VoteAccumulator:
+    """Confirms an identification once enough recent recognitions agree on it."""
+
+    def __init__(self, window=None, votes_needed=None):
+        self.window = window or config.LIVE_VOTE_WINDOW
+        self.votes_needed = votes_needed or config.LIVE_VOTES_TO_CONFIRM
+        self._recent = deque(maxlen=self.window)
+        self.confirmed = None
+
+    def add(self, bottle_id):
+        """
+        Records one recognition (None for no match).
+
+        Returns:
+            The bottle ID if this vote newly confirms it, else None.
+        """
+        self._recent.append(bottle_id)
+        if self.confirmed is not None and self.confirmed not in self._recent:
+            self.confirmed = None  # The bottle has left the view; it may be confirmed again later
+        if bottle_id is None or bottle_id == self.confirmed:
+            return None
+        if Counter(self._recent)[bottle_id] >= self.votes_needed:
+            self.confirmed = bottle_id
+            return bottle_id
+        return None
+
+    def leader(self):
+        """(bottle ID, votes) of the most recognized bottle in the window, or (None, 0)."""
+        votes = Counter(bottle_id for bottle_id in self._recent if bottle_id is not None)
+        return votes.most_common(1)[0] if votes else (None, 0)
+
+class BackgroundRecognizer:
+    """
+    Identifies frames on a background thread. A frame is only taken when the
+    thread is idle and the rate limit allows, so the caller always hands over
+    its newest frame and never waits.
+    """
+
+    def __init__(self, max_per_second=None):
+        max_per_second = max_per_second or config.LIVE_MAX_RECOGNITIONS_PER_SECOND
+        self._min_interval = 1.0 / max_per_second if max_per_second > 0 else 0.0
+        self._condition = threading.Condition()
+        self._pending = None
+        self._busy = False
+        self._stopped = False
+        self._last_start = 0.0
+        self._results = deque()  # (bottle_id, score, matches_count, seconds) not yet collected
+        self.recognized = 0
+        self._thread = threading.Thread(target=self._run, name='recognizer', daemon=True)
+        self._thread.start()
+
+    def ready(self):
+        """True if a frame submitted now would be matched straight away."""
+        with self._condition:
+            return (not self._busy and self._pending is None
+                    and time.monotonic() - self._last_start >= self._min_interval)
+
+    def submit(self, frame):
+        with self._condition:
+            self._pending = frame
+            self._condition.notify()
+
+    def results(self):
+        """Returns and clears the results finished since the last call."""
+        with self._condition:
+            results = list(self._results)
+            self._results.clear()
+        return results
+
+    def wait_idle(self):
+        """Blocks until the submitted frame, if any, has been matched."""
+        with self._condition:
+            self._condition.wait_for(lambda: not self._busy and self._pending is None)
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._pending is not None or self._stopped)
+                if self._stopped:
+                    return
+                frame, self._pending = self._pending, None
+                self._busy = True
+                self._last_start = time.monotonic()
+            start = time.perf_counter()
+            try:
+                bottle_id, score, matches_count = find_best_match_from_array(frame)
+            except Exception as e:
+                print(f"An error occurred during identification: {e}")
+                bottle_id, score, matches_count = None, 0.0, 0
+            with self._condition:
+                self._results.append((bottle_id, score, matches_count, time.perf_counter() - start))
+                self.recognized += 1
+                self._busy = False
+                self._condition.notify_all()
+
+def bottle_name(bottle_id):
+    """Short label for the preview: the bottle's name if its details are available."""
+    details = get_bottle_details(bottle_id)
+    return details.get(config.COL_NAME, bottle_id) if details else f"ID {bottle_id} (details missing)"
+
+def print_match(bottle_id, score, matches_count):
+    """Prints a match and the bottle's details, names aligned."""
+    print("\n--- Match Found ---")
+    print(f"  Identified Bottle ID: {bottle_id}")
+    print(f"  Good Matches: {matches_count}")
+    print(f"  Confidence Score: {score:.3f}")
+
+    # Get the full details using the ID
+    details = get_bottle_details(bottle_id)
+    if details is not None:
+        print("\n  --- Bottle Details ---")
+        width = max(len(str(key)) for key in details) if details else 0
+        for key, value in details.items():
+            print(f"    {str(key):<{width}}  {value}")
+    else:
+        print(f"  Warning: Could not retrieve details for ID {bottle_id}.")
+
+def report_result(result, continuous, votes, started):
+    """
+    Prints one finished identification: every result when capturing on SPACE,
+    only newly confirmed bottles in continuous mode.
+
+    Args:
+        result (tuple): (bottle_id, score, matches_count, seconds) from BackgroundRecognizer.
+        votes (VoteAccumulator): Recent recognitions (continuous mode).
+        started (float): perf_counter() at startup, for the confirmation timestamp.
+
+    Returns:
+        str: New preview label, or None if it doesn't change.
+    """
+    bottle_id, score, matches_count, seconds = result
+    if not continuous:
+        if bottle_id is None:
+            print("\n--- No matching bottle found. ---")
+            return "No Match Found"
+        print_match(bottle_id, score, matches_count)
+        return f"Match: {bottle_name(bottle_id)}"
+    if votes.add(bottle_id) is None:
+        return None
+    print(f"\n[{time.perf_counter() - started:6.1f}s] Confirmed after "
+          f"{votes.votes_needed} of the last {votes.window} recognitions:")
+    print_match(bottle_id, score, matches_count)
+    return bottle_name(bottle_id)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Identify whisky bottles from a webcam or a video file.")
+    parser.add_argument('--camera', type=int, default=WEBCAM_INDEX, help="Webcam index (default: %(default)s)")
+    parser.add_argument('--video', help="Read frames from this video file instead of the webcam, at its frame rate")
+    parser.add_argument('--continuous', action='store_true',
+                        help="Identify steady, in-focus frames continuously instead of on SPACE")
+    parser.add_argument('--headless', action='store_true',
+                        help="No preview window; print identifications only (implies --continuous)")
+    args = parser.parse_args()
+    args.continuous = args.continuous or args.headless
+    return args
 
 if __name__ == "__main__":
+    args = parse_args()
     print("--- Webcam Whisky Identifier ---")
 
     if not INITIALIZATION_SUCCESSFUL:
         print("\nExiting because matcher initialization failed. Please check previous errors.")
         sys.exit(1)
 
-    print(f"\nInitializing webcam (index {WEBCAM_INDEX})...")
-    cap = cv2.VideoCapture(WEBCAM_INDEX)
+    if args.video:
+        print(f"\nOpening video file '{args.video}'...")
+        cap = cv2.VideoCapture(args.video)
+    else:
+        print(f"\nInitializing webcam (index {args.camera})...")
+        cap = cv2.VideoCapture(args.camera)
 
     if not cap.isOpened():
-        print(f"Error: Could not open webcam at index {WEBCAM_INDEX}.")
+        print(f"Error: Could not open {'video file ' + repr(args.video) if args.video else f'webcam at index {args.camera}'}.")
         sys.exit(1)
 
-    print("Webcam initialized successfully.")
+    # Video files are played back in real time, so frames are skipped as they would be live
+    frame_interval = 1.0 / (cap.get(cv2.CAP_PROP_FPS) or 30.0) if args.video else 0.0
+
+    print("Video source initialized successfully.")
     print("\nInstructions:")
-    print(" - Position the bottle label clearly in front of the webcam.")
-    print(" - Press [SPACEBAR] to capture and identify.")
-    print(" - Press [q] to quit.")
+    print(" - Position the bottle label clearly in front of the camera.")
+    if args.continuous:
+        print(" - Hold the bottle steady; it is identified automatically.")
+    else:
+        print(" - Press [SPACEBAR] to capture and identify.")
+    if not args.headless:
+        print(" - Press [q] to quit.")
+
+    gate = FrameGate()
+    votes = VoteAccumulator()
+    recognizer = BackgroundRecognizer()
+    window_title = 'Webcam - ' + ('Live Recognition' if args.continuous else 'Press SPACE to Capture') + ', Q to Quit'
 
+    frames = gated_frames = 0
+    started = time.perf_counter()
+    next_frame_at = time.perf_counter()
     last_match_time = 0
     match_result_display = "" # Text to display on webcam feed
+    confirmed_name = None      # Preview label of the bottle confirmed in continuous mode
 
-    while True:
-        ret, frame = cap.read()
-        if not ret:
-            print("Error: Can't receive frame. Exiting ...")
-            break
+    try:
+        while True:
+            ret, frame = cap.read()
+            if not ret:
+                if not args.video:
+                    print("Error: Can't receive frame. Exiting ...")
+                break
+            frames += 1
 
-        display_frame = frame.copy()
+            # --- Hand steady, sharp frames to the recognizer (continuous mode) ---
+            steady = gate.check(frame)
+            if args.continuous and steady:
+                gated_frames += 1
+                if recognizer.ready():
+                    recognizer.submit(frame)
 
-        # Display brief result text on screen
-        if time.time() - last_match_time < 5.0:
-            cv2.putText(display_frame, match_result_display, (10, 30),
-                        cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 2, cv2.LINE_AA)
-
-        cv2.imshow('Webcam - Press SPACE to Capture, Q to Quit', display_frame)
-
-        key = cv2.waitKey(1) & 0xFF
-
-        if key == ord('q'):
-            print("\nQuitting...")
-            break
-
-        elif key == ord(' '):
-            print("\nCapturing image...")
-            capture_path = os.path.join(".", TEMP_CAPTURE_FILENAME)
+            # --- Collect finished identifications ---
+            for result in recognizer.results():
+                label = report_result(result, args.continuous, votes, started)
+                if label is None:
+                    continue
+                if args.continuous:
+                    confirmed_name = label
+                else:
+                    match_result_display, last_match_time = label, time.time()
 
-            try:
-                success = cv2.imwrite(capture_path, frame)
-                if not success:
-                     print(f"Error: Failed to save captured image to {capture_path}")
-                     continue
-
-                print(f"Image saved temporarily to {capture_path}")
-                print("Attempting to identify...")
-
-                # --- Perform Identification ---
-                bottle_id, score, matches_count = find_best_match(capture_path)
-
-                # --- Get and Display Details ---
-                if bottle_id is not None:
-                    print(f"\n--- Match Found ---")
-                    print(f"  Identified Bottle ID: {bottle_id}")
-                    print(f"  Good Matches: {matches_count}")
-                    print(f"  Confidence Score (raw): {score}")
-
-                    # Get the full details using the ID
-                    details = get_bottle_details(bottle_id)
-
-                    if details is not None:
-                        print("\n  --- Bottle Details ---")
-                        # Print details neatly (Series to string handles formatting)
-                        details_str = details.to_string()
-                        for line in details_str.split('\n'):
-                            print(f"    {line.strip()}")
-
-                        # Update display text for webcam window (keep it short)
-                        match_result_display = f"Match: {details.get('name', bottle_id)}" # Use name if available
+            # --- Preview ---
+            if not args.headless:
+                display_frame = frame.copy()
+                if args.continuous:
+                    if votes.confirmed is not None:
+                        status, color = f"Match: {confirmed_name}", (0, 255, 0)
                     else:
-                         print(f"  Warning: Could not retrieve details for ID {bottle_id}.")
-                         match_result_display = f"Match: ID {bottle_id} (details missing)"
-
-                else:
-                    print("\n--- No matching bottle found. ---")
-                    match_result_display = "No Match Found"
+                        leader, count = votes.leader()
+                        status = f"Looking... ({count}/{votes.votes_needed} votes)" if leader is not None else "Looking..."
+                        color = (0, 255, 255) if steady else (0, 165, 255)
+                    cv2.putText(display_frame, status, (10, 30),
+                                cv2.FONT_HERSHEY_SIMPLEX, 0.7, color, 2, cv2.LINE_AA)
+                    cv2.putText(display_frame, f"motion {gate.motion:.1f}  sharpness {gate.sharpness:.0f}", (10, 55),
+                                cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 1, cv2.LINE_AA)
+                elif time.time() - last_match_time < RESULT_DISPLAY_SECONDS:
+                    # Display brief result text on screen
+                    cv2.putText(display_frame, match_result_display, (10, 30),
+                                cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 2, cv2.LINE_AA)
 
-                last_match_time = time.time()
+                cv2.imshow(window_title, display_frame)
 
-                # Clean up temp file
-                try:
-                    os.remove(capture_path)
-                except OSError as e:
-                    print(f"Error removing temporary file {capture_path}: {e}")
+                key = cv2.waitKey(1) & 0xFF
+                if key == ord('q'):
+                    print("\nQuitting...")
+                    break
+                elif key == ord(' ') and not args.continuous:
+                    # Matched in the background; the preview keeps running meanwhile
+                    print("\nCapturing image... identifying.")
+                    recognizer.submit(frame)
 
-            except Exception as e:
-                print(f"An error occurred during capture/identification: {e}")
+            if frame_interval:
+                next_frame_at += frame_interval
+                time.sleep(max(0.0, next_frame_at - time.perf_counter()))
+    except KeyboardInterrupt:
+        print("\nQuitting...")
+    finally:
+        recognizer.wait_idle()
+        # Identifications finished after the last frame (end of a video, quitting) still count
+        for result in recognizer.results():
+            report_result(result, args.continuous, votes, started)
+        recognizer.stop()
+        cap.release()
+        if not args.headless:
+            cv2.destroyAllWindows()
 
-    cap.release()
-    cv2.destroyAllWindows()
-    print("Webcam released and windows closed.")
-    
\ No newline at end of file
+    elapsed = time.perf_counter() - started
+    print(f"\n{frames} frames in {elapsed:.1f}s ({frames / max(elapsed, 1e-9):.1f} fps): "
+          f"{gated_frames} steady and in focus, {recognizer.recognized} identified.")
+    print("Video source released and windows closed.")
@@ -16,7 +16,6 @@ const cameraButton = document.getElementById('camera-button');
 const cameraModal = document.getElementById('camera-modal');
 const closeCamera = document.getElementById('close-camera');
 const cameraPreview = document.getElementById('camera-preview');
-const cameraCanvas = document.getElementById('camera-canvas');
 const takePhotoButton = document.getElementById('take-photo');
 const clearHistoryButton = document.getElementById('clear-history');
 const bottleDetailsModal = document.getElementById('bottle-details-modal');
@@ -169,6 +168,116 @@ function toggleHistory() {
     document.body.classList.toggle('overflow-hidden');
 }
 
+// Timing reports
+// Splits the client-perceived time of an /identify call into the server stages listed in
+// its Server-Timing header and the rest (upload, network, queueing), logs the breakdown
+// and sends it to the server's metrics.
+function parseServerTiming(header) {
+    const stages = {};
+    if (!header) return stages;
+    header.split(',').forEach(entry => {
+        const [name, ...params] = entry.trim().split(';');
+        const duration = params.map(p => p.trim()).find(p => p.startsWith('dur='));
+        if (name && duration) stages[name] = parseFloat(duration.slice(4));
+    });
+    return stages;
+}
+
+function reportTiming(response, clientMs) {
+    const stages = parseServerTiming(response.headers.get('Server-Timing'));
+    const serverMs = stages.total || 0;
+    const report = {
+        client_ms: Math.round(clientMs * 10) / 10,
+        server_ms: serverMs,
+        network_ms: Math.round(Math.max(0, clientMs - serverMs) * 10) / 10,
+        status: response.status,
+        stages: stages
+    };
+    console.info('Identification timing (ms):', report);
+    if (navigator.sendBeacon) {
+        navigator.sendBeacon('/metrics/client', new Blob([JSON.stringify(report)], { type: 'application/json' }));
+    }
+}
+
+// Identification requests
+// Posts an image to /identify. A 202 carries a job to poll until it finishes; a 503 means the
+// server's queue is full, so the request is retried a few times after the advised delay.
+const MAX_BUSY_RETRIES = 3;
+
+function retryDelayMs(response) {
+    const seconds = parseFloat(response.headers.get('Retry-After'));
+    return (isNaN(seconds) ? 1 : Math.min(seconds, 30)) * 1000;
+}
+
+async function postIdentify(formData) {
+    let response;
+    for (let attempt = 0; ; attempt++) {
+        response = await fetch('/identify', { method: 'POST', body: formData });
+        if (response.status !== 503 || attempt >= MAX_BUSY_RETRIES) break;
+        await new Promise(resolve => setTimeout(resolve, retryDelayMs(response)));
+    }
+    while (response.status === 202) {
+        const job = await response.json();
+        await new Promise(resolve => setTimeout(resolve, retryDelayMs(response)));
+        response = await fetch(job.poll_url);
+    }
+    return response;
+}
+
+// Upload preparation
+// The server processes images in grayscale, no larger than the size it advertises at
+// /capture-settings; scaling and desaturating before upload sends a fraction of the bytes.
+let captureSettingsPromise = null;
+
+function getCaptureSettings() {
+    if (!captureSettingsPromise) {
+        captureSettingsPromise = fetch('/capture-settings')
+            .then(response => response.ok ? response.json() : null)
+            .catch(() => null);
+    }
+    return captureSettingsPromise;
+}
+
+function canvasToBlob(canvas, type, quality) {
+    return new Promise(resolve => canvas.toBlob(resolve, type, quality));
+}
+
+// Draws source (a video element or ImageBitmap) scaled down and desaturated, and encodes it in
+// the first advertised format the browser can produce. original, if given, is kept when smaller.
+async function prepareUpload(source, width, height, original) {
+    const settings = await getCaptureSettings() || { max_image_size: 1024, grayscale: true,
+                                                     formats: ['image/jpeg'], quality: 0.85 };
+    const scale = Math.min(1, settings.max_image_size / Math.max(width, height));
+    const canvas = document.createElement('canvas');
+    canvas.width = Math.max(1, Math.round(width * scale));
+    canvas.height = Math.max(1, Math.round(height * scale));
+    const context = canvas.getContext('2d');
+    if (settings.grayscale) context.filter = 'grayscale(1)';
+    context.imageSmoothingQuality = 'high';
+    context.drawImage(source, 0, 0, canvas.width, canvas.height);
+
+    for (const type of settings.formats) {
+        const blob = await canvasToBlob(canvas, type, settings.quality);
+        // Browsers that can't encode a format hand back PNG instead
+        if (!blob || blob.type !== type) continue;
+        if (original && original.size <= blob.size) return original;
+        return new File([blob], `capture.${type.split('/')[1]}`, { type });
+    }
+    return original || new File([await canvasToBlob(canvas, 'image/png')], 'capture.png', { type: 'image/png' });
+}
+
+async function prepareFileUpload(file) {
+    try {
+        const bitmap = await createImageBitmap(file);
+        const upload = await prepareUpload(bitmap, bitmap.width, bitmap.height, file);
+        bitmap.close();
+        return upload;
+    } catch (error) {
+        console.warn('Could not downscale the image before upload, sending it as is:', error);
+        return file;
+    }
+}
+
 // Camera functionality
 async function startCamera() {
     try {
@@ -219,18 +328,9 @@ async function takePhoto() {
         return;
     }
 
-    const context = cameraCanvas.getContext('2d');
-    cameraCanvas.width = cameraPreview.videoWidth;
-    cameraCanvas.height = cameraPreview.videoHeight;
-    context.drawImage(cameraPreview, 0, 0, cameraCanvas.width, cameraCanvas.height);
-    
-    // Convert canvas to blob
+    // Capture the frame at the size the server processes, rather than the full sensor resolution
     try {
-        const blob = await new Promise((resolve) => {
-            cameraCanvas.toBlob(resolve, 'image/jpeg', 0.95);
-        });
-        
-        const file = new File([blob], "camera-photo.jpg", { type: "image/jpeg" });
+        const file = await prepareUpload(cameraPreview, cameraPreview.videoWidth, cameraPreview.videoHeight, null);
         
         // Create FormData and append file
         const formData = new FormData();
@@ -241,10 +341,9 @@ async function takePhoto() {
         submitButton.disabled = true;
     
         try {
-            const response = await fetch('/identify', {
-                method: 'POST',
-                body: formData
-            });
+            const requestStart = performance.now();
+            const response = await postIdentify(formData);
+            reportTiming(response, performance.now() - requestStart);
             
             const contentType = response.headers.get("content-type");
             if (contentType && contentType.indexOf("application/json") !== -1) {
@@ -294,14 +393,13 @@ if (form) {
 
         // --- Prepare Form Data for Sending ---
         const formData = new FormData();
-        formData.append('bottle_image', fileInput.files[0]); // 'bottle_image' must match the name Flask expects
+        formData.append('bottle_image', await prepareFileUpload(fileInput.files[0])); // 'bottle_image' must match the name Flask expects
 
         // --- Send Data to Backend API ---
         try {
-            const response = await fetch('/identify', { // URL of your Flask API endpoint
-                method: 'POST',
-                body: formData,
-            });
+            const requestStart = performance.now();
+            const response = await postIdentify(formData); // Flask API endpoint, polled if queued
+            reportTiming(response, performance.now() - requestStart);
 
             // --- Process Backend Response ---
             const contentType = response.headers.get("content-type");
@@ -0,0 +1,77 @@
+# tests/test_catalogue_files.py
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+import ann_index
+from global_signature import VisualVocabulary, load_vocabulary
+
+class Store:
+    """Stand-in for a FeatureStore: references with a build ID."""
+
+    def __init__(self, references, build_id):
+        self.references = references
+        self.ids = [ref['id'] for ref in references]
+        self.build_id = build_id
+
+    def __iter__(self):
+        return iter(self.references)
+
+    def __len__(self):
+        return len(self.references)
+
+class CatalogueFilesTest(unittest.TestCase):
+    """An index or vocabulary saved for one feature store build is not used with another."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        rng = np.random.default_rng(0)
+        self.descriptors = rng.integers(0, 256, (2000, 32), dtype=np.uint8)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def path(self, name):
+        return os.path.join(self.tmp_dir, name)
+
+    def test_flann_index_checks_build(self):
+        path = self.path('index.bin')
+        ann_index.FlannLshIndex(self.descriptors).save(path, 'build-a')
+        index = ann_index.FlannLshIndex.load(self.descriptors, path, 'build-a')
+        rows, _ = index.knn(self.descriptors[:5], 1)
+        self.assertEqual(rows[:, 0].tolist(), list(range(5)))
+        with self.assertRaises(ValueError):
+            ann_index.FlannLshIndex.load(self.descriptors, path, 'build-b')
+
+    def test_flann_sidecar_of_another_save_is_rejected(self):
+        path = self.path('index.bin')
+        ann_index.FlannLshIndex(self.descriptors).save(path, 'build-a')
+        shutil.copy(ann_index.meta_path(path), self.path('old.json'))
+        ann_index.FlannLshIndex(self.descriptors).save(path, 'build-b')
+        shutil.copy(self.path('old.json'), ann_index.meta_path(path))  # Sidecar of the earlier save
+        with self.assertRaises(ValueError):
+            ann_index.FlannLshIndex.load(self.descriptors, path, 'build-a')
+
+    def test_load_index_rebuilds_stale_mih_index(self):
+        path = self.path('index.npz')
+        ann_index.MultiIndexHashingIndex(self.descriptors).save(path, 'build-a')
+        index = ann_index.load_index(self.descriptors, 'mih', path, build_id='build-b')
+        self.assertIsInstance(index, ann_index.MultiIndexHashingIndex)
+        with self.assertRaises(ValueError):
+            ann_index.MultiIndexHashingIndex.load(self.descriptors, path, 'build-b')
+
+    def test_vocabulary_checks_build(self):
+        references = [{'id': idx, 'descriptors': self.descriptors[idx * 100:(idx + 1) * 100]} for idx in range(20)]
+        path = self.path('vocabulary.npz')
+        VisualVocabulary.from_words(self.descriptors[:64], Store(references, 'build-a')).save(path)
+        self.assertIsNotNone(load_vocabulary(Store(references, 'build-a'), path))
+        self.assertIsNone(load_vocabulary(Store(references, 'build-b'), path))
+
+if __name__ == '__main__':
+    unittest.main()
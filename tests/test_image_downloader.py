@@ -0,0 +1,108 @@
+# tests/test_image_downloader.py
+
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+from image_downloader import ImageDownloader
+
+IMAGE = b'\xff\xd8\xff' + b'bottle' * 100
+ETAG = '"v1"'
+
+class ImageHandler(BaseHTTPRequestHandler):
+    """Serves IMAGE with an ETag; /flaky answers 503 (Retry-After: 0) to the first `failures` requests."""
+
+    protocol_version = 'HTTP/1.1'  # Keep-alive, so connection reuse can be observed
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append((self.path, self.client_address[1]))
+            fail = self.path == '/flaky' and server.failures > 0
+            if fail:
+                server.failures -= 1
+        if fail:
+            self._send(503, b'busy', {'Retry-After': '0'})
+        elif self.headers.get('If-None-Match') == ETAG:
+            self._send(304, None, {'ETag': ETAG})
+        else:
+            self._send(200, IMAGE, {'ETag': ETAG, 'Content-Type': 'image/jpeg'})
+
+    def _send(self, status, body, headers):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if body is not None:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if body is not None:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class ImageDownloaderTest(unittest.TestCase):
+    """ImageDownloader against a local HTTP server: downloads, revalidation and retries."""
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), ImageHandler)
+        self.server.lock = threading.Lock()
+        self.server.requests = []
+        self.server.failures = 0
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp_dir)
+
+    def downloader(self, **kwargs):
+        kwargs.setdefault('max_workers', 1)
+        kwargs.setdefault('backoff', 0)
+        return ImageDownloader(download_dir=self.tmp_dir, manifest_path=os.path.join(self.tmp_dir, 'manifest.json'),
+                               **kwargs)
+
+    def test_downloads_and_records_etag(self):
+        downloader = self.downloader()
+        path, status = downloader.download_one(1, f"{self.base_url}/1.jpg")
+        self.assertEqual(status, 'downloaded')
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), IMAGE)
+        self.assertEqual(downloader.manifest['1']['etag'], ETAG)
+
+    def test_unchanged_image_is_not_modified_and_connection_reused(self):
+        downloader = self.downloader()
+        url = f"{self.base_url}/1.jpg"
+        downloader.download_one(1, url)
+        path, status = downloader.download_one(1, url)
+        self.assertEqual(status, 'not_modified')
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), IMAGE)
+        downloader.download_one(2, f"{self.base_url}/2.jpg")  # Must get the connection the 304 used back
+        self.assertEqual(len({port for _, port in self.server.requests}), 1)
+
+    def test_retries_server_errors(self):
+        self.server.failures = 2
+        path, status = self.downloader(max_retries=3).download_one(1, f"{self.base_url}/flaky")
+        self.assertEqual(status, 'downloaded')
+        self.assertEqual([p for p, _ in self.server.requests], ['/flaky'] * 3)
+
+    def test_gives_up_after_max_retries(self):
+        self.server.failures = 5
+        downloader = self.downloader(max_retries=1)
+        with self.assertRaises(Exception):
+            downloader.download_one(1, f"{self.base_url}/flaky")
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir, '1.jpg')))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+# tests/test_job_queue.py
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+from job_queue import JobQueue
+
+class JobSweepTest(unittest.TestCase):
+    """Persisted jobs are swept by the time they finished, never while they are queued or running."""
+
+    def setUp(self):
+        self.job_dir = tempfile.mkdtemp()
+        self.queue = JobQueue(workers=1, max_depth=4, ttl_seconds=60, job_dir=self.job_dir)
+        self.release = threading.Event()
+
+    def tearDown(self):
+        self.release.set()
+        shutil.rmtree(self.job_dir)
+
+    def slow_job(self, timings=None):
+        self.release.wait(10)
+        return 'done'
+
+    def sweep(self, seconds_later):
+        """Runs a sweep as if seconds_later had passed since every file was written."""
+        self.queue._last_sweep = time.monotonic() - self.queue.ttl_seconds
+        real_time = time.time
+        time.time = lambda: real_time() + seconds_later
+        try:
+            self.queue._sweep()
+        finally:
+            time.time = real_time
+
+    def test_running_job_outlives_ttl(self):
+        job, _ = self.queue.submit(self.slow_job)
+        self.queue.keep(job)
+        self.sweep(10 * self.queue.ttl_seconds)
+        self.assertEqual(self.queue.get(job.id)['status'], 'running')
+        self.assertTrue(os.path.exists(self.queue._path(job.id)))
+
+    def test_finished_job_swept_after_ttl(self):
+        self.release.set()
+        job, _ = self.queue.submit(self.slow_job)
+        self.queue.keep(job)
+        job.wait(10)
+        self.sweep(self.queue.ttl_seconds / 2)
+        self.assertTrue(os.path.exists(self.queue._path(job.id)))
+        self.sweep(2 * self.queue.ttl_seconds)
+        self.assertFalse(os.path.exists(self.queue._path(job.id)))
+
+    def test_orphaned_job_swept(self):
+        job_id = 'f' * 32
+        with open(self.queue._path(job_id), 'w', encoding='utf-8') as f:
+            json.dump({'id': job_id, 'status': 'running', 'finished_at': None, 'pid': 2 ** 22 + 1}, f)
+        self.sweep(0)
+        self.assertFalse(os.path.exists(self.queue._path(job_id)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+# tests/test_sharding.py
+
+import os
+import sys
+import shutil
+import socket
+import tempfile
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+import config
+import sharding
+import shard_server
+from feature_store import write_feature_store, open_feature_store
+from details_store import record_body
+from data_preparation import write_shards
+
+N_BOTTLES = 12
+N_SHARDS = 3
+DESCRIPTORS_PER_BOTTLE = 300
+
+def noisy_copy(rng, descriptors, bits=2):
+    """Descriptors with a few bits flipped, as a query photo of the same label would give."""
+    copy = descriptors.copy()
+    rows = np.arange(len(copy))
+    for _ in range(bits):
+        copy[rows, rng.integers(0, copy.shape[1], len(copy))] ^= np.uint8(1) << rng.integers(0, 8, len(copy)).astype(np.uint8)
+    return copy
+
+@unittest.skipUnless(hasattr(socket, 'AF_UNIX'), "Local shard servers listen on Unix sockets")
+class ShardingTest(unittest.TestCase):
+    """
+    Scatter-gather over local shard servers gives the ranking of the whole catalogue.
+    The bottles have unrelated (random) descriptors, so the ratio test decides the same
+    in each shard as over the whole catalogue (see the note in sharding.py).
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.mkdtemp()
+        settings = {
+            'FEATURES_FILE': os.path.join(cls.tmp_dir, 'features.store'),
+            'ANN_INDEX_FILE': os.path.join(cls.tmp_dir, 'index.bin'),
+            'VOCABULARY_FILE': os.path.join(cls.tmp_dir, 'vocabulary.npz'),
+            'DETAILS_FILE': os.path.join(cls.tmp_dir, 'details.json'),
+            'SHARD_SOCKET_DIR': os.path.join(cls.tmp_dir, 'sockets'),
+            'ANN_INDEX_TYPE': 'brute',
+            'MATCHER_ENGINE': 'stacked',
+            'EARLY_TERMINATION': False,  # Shards would stop on their own leaders
+            'RESULT_CACHE_ENABLED': False,
+        }
+        cls.saved_settings = {name: getattr(config, name) for name in settings}
+        for name, value in settings.items():
+            setattr(config, name, value)
+
+        rng = np.random.default_rng(0)
+        cls.references = [{'id': str(100 + idx), 'name': f'Bottle {idx}',
+                           'descriptors': rng.integers(0, 256, (DESCRIPTORS_PER_BOTTLE, 32), dtype=np.uint8),
+                           'keypoints': rng.uniform(0, 500, (DESCRIPTORS_PER_BOTTLE, 2)).astype(np.float32),
+                           'details': record_body({config.COL_NAME: f'Bottle {idx}'})}
+                          for idx in range(N_BOTTLES)]
+        write_feature_store(config.FEATURES_FILE, cls.references)
+        write_shards(open_feature_store(config.FEATURES_FILE), N_SHARDS)
+
+        # Bottles 4, 2 and 9 (one per shard) share 80, 40 and 20 descriptors with the query
+        cls.des_query = np.vstack([noisy_copy(rng, cls.references[4]['descriptors'][:80]),
+                                   noisy_copy(rng, cls.references[2]['descriptors'][:40]),
+                                   noisy_copy(rng, cls.references[9]['descriptors'][:20]),
+                                   rng.integers(0, 256, (100, 32), dtype=np.uint8)])
+
+        # The unsharded catalogue is matched in this process, the shards by their own servers
+        import identification
+        cls.identification = identification
+        cls.processes = shard_server.start_local_shards(
+            cpus=1, overrides=[f'{name}={value}' for name, value in settings.items()])
+        cls.addresses = list(cls.processes)
+
+    @classmethod
+    def tearDownClass(cls):
+        shard_server.stop_shards(cls.processes)
+        for name, value in cls.saved_settings.items():
+            setattr(config, name, value)
+        shutil.rmtree(cls.tmp_dir)
+
+    def setUp(self):
+        self.clients = []
+        self.assertTrue(self.identification.INITIALIZATION_SUCCESSFUL)
+
+    def tearDown(self):
+        self.identification.shard_client = None
+        for client in self.clients:
+            client.shutdown()
+
+    def client(self, addresses, timeout=None):
+        client = sharding.ShardClient(addresses, timeout)
+        self.clients.append(client)
+        return client
+
+    def unsharded_scores(self):
+        catalogue, votes, _ = self.identification.score_query(self.des_query)
+        return {bottle_id: int(votes[idx]) for idx, bottle_id in enumerate(catalogue.ids) if votes[idx] > 0}
+
+    def test_merged_scores_equal_unsharded(self):
+        merged = self.client(self.addresses).score_batch([self.des_query], [None])[0]
+        self.assertEqual(dict(zip(merged.ids, merged.scores.tolist())), self.unsharded_scores())
+        self.assertEqual(merged.n_matched, len(self.des_query))
+
+    def test_match_descriptors_equals_unsharded(self):
+        expected = self.identification.match_descriptors(self.des_query)
+        self.assertEqual(expected[0], '104')
+        self.identification.shard_client = self.client(self.addresses)
+        self.assertEqual(self.identification.match_descriptors(self.des_query), expected)
+
+    def test_timed_out_shard_is_left_out(self):
+        # Accepts connections but never answers
+        silent = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        silent.bind(('127.0.0.1', 0))
+        silent.listen(1)
+        self.addCleanup(silent.close)
+        silent_address = f'127.0.0.1:{silent.getsockname()[1]}'
+
+        client = self.client(self.addresses + [silent_address], timeout=1.0)
+        merged = client.score_batch([self.des_query], [None])[0]
+        self.assertEqual(dict(zip(merged.ids, merged.scores.tolist())), self.unsharded_scores())
+        self.assertEqual(client.stats()[silent_address]['timeout'], 1)
+        self.assertTrue(all(client.stats()[address]['ok'] == 1 for address in self.addresses))
+
+        with self.assertRaises(sharding.ShardUnavailableError):
+            self.client([silent_address], timeout=0.5).score_batch([self.des_query], [None])
+
+if __name__ == '__main__':
+    unittest.main()